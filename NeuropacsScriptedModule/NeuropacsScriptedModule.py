@@ -1,6 +1,6 @@
 import logging
 import os
-import json
+import time
 
 import slicer
 from slicer.i18n import tr as _
@@ -12,9 +12,55 @@ from slicer.util import VTKObservationMixin
 import qt
 import ctk
 
+from NeuropacsScriptedModuleLib import (
+    COLUMN_DELETE,
+    COLUMN_DOWNLOAD,
+    COLUMN_INFO,
+    DEFAULT_COMPRESSION_LEVEL,
+    DOWNLOAD_DONE,
+    DOWNLOAD_FAILED,
+    MIN_REPORT_CACHE_SIZE,
+    REPORT_FORMATS,
+    STATE_COMPLETE,
+    STATE_EXPIRED,
+    STATE_RUNNING,
+    TEXT_FORMATS,
+    BulkExportJob,
+    ButtonDelegate,
+    ConnectJob,
+    CredentialStore,
+    DatasetIndex,
+    FingerprintJob,
+    JobEngine,
+    OrderStore,
+    OrderTableModel,
+    ReportCache,
+    ReportDownloadJob,
+    ReportPrefetcher,
+    ReportViewerDock,
+    ReportVolumes,
+    ResultsDialog,
+    ResultsTable,
+    StatusFetcher,
+    StartupTimings,
+    StatusPoller,
+    SubmissionQueue,
+    VersionCheckJob,
+    installArguments,
+    installedVersion,
+    isNewer,
+    terminalState,
+    wheelVersions,
+)
+
 # neuropacs module
 neuropacs = None
 
+NEUROPACS_SERVER_URL = "https://jdfkdttvlf.execute-api.us-east-1.amazonaws.com/prod"
+
+# neuropacs product run on uploaded datasets
+NEUROPACS_PRODUCT = "Atypical/MSAp/PSP-v1.0"
+
 #
 # NeuropacsScriptedModule
 #
@@ -65,26 +111,27 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
         ScriptedLoadableModuleWidget.__init__(self, parent)
         VTKObservationMixin.__init__(self)  # needed for parameter node observation
         self.logic = None
-        self.neuropacsOrderMap = {}
-        self.neuropacsConfigPath = ""
-
-        default_path = slicer.util.settingsValue("neuropacs/configPath", default = None)
-        if  default_path == None:
-            default_path = os.path.join(qt.QStandardPaths.writableLocation(qt.QStandardPaths.DocumentsLocation), "slicer_neuropacs.config")
-            qt.QSettings().setValue("neuropacs/configPath", default_path)
-
-        self.neuropacsConfigPath = default_path
-        #     # self.load_npcs_file_selector(qt.QStandardPaths.writableLocation(qt.QStandardPaths.DocumentsLocation) + "/slicer_neuropacs.config")
-        # else:
-        #     self.load_npcs_file_selector(last_used_path)
-        #     self.neuropacsConfigPath = last_used_path
-        self.load_npcs_file_selector(default_path)
-
+        self.startupTimings = StartupTimings()
+        self.neuropacsConfigPath = NeuropacsScriptedModuleLogic.defaultConfigPath()
 
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
+        with self.startupTimings.measure("widget setup"):
+            self.__setupWidgets()
+
+    def __setupWidgets(self):
         ScriptedLoadableModuleWidget.setup(self)
 
+        # Network, file and state handling is done by the logic, the widget only shows it
+        self.logic = NeuropacsScriptedModuleLogic()
+        self.logic.onStatuses = self.applyPolledStatuses
+        self.logic.onQueueChanged = self.__onQueueChanged
+        self.logic.onOrderStarted = self.__onOrderStarted
+        self.logic.datasetIndex.onChanged = self.__fillDatasetDropdown
+        self.logic.datasetIndex.onFinished = lambda: self.startupTimings.finish("dataset index")
+
+        # Parameters are built with the rest of the widget, once the module is opened
+        self.load_npcs_file_selector(self.neuropacsConfigPath)
 
         # Load widget from .ui file (created by Qt Designer).
         # Additional widgets can be instantiated manually and added to self.layout.
@@ -99,15 +146,68 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
 
         self.__setNeuropacsImage()
 
+        # Order table, download/delete buttons are painted by delegates instead of per-row widgets
+        self.orderTableModel = OrderTableModel()
+        self.ui.orderTableView.setModel(self.orderTableModel)
+        self.downloadButtonDelegate = ButtonDelegate(self.ui.orderTableView, self.__onDownloadClicked, hasMenu=True)
+        self.deleteButtonDelegate = ButtonDelegate(self.ui.orderTableView, self.__onDeleteClicked)
+        self.ui.orderTableView.setItemDelegateForColumn(COLUMN_DOWNLOAD, self.downloadButtonDelegate)
+        self.ui.orderTableView.setItemDelegateForColumn(COLUMN_DELETE, self.deleteButtonDelegate)
+        self.ui.orderTableView.horizontalHeader().setSectionResizeMode(COLUMN_INFO, qt.QHeaderView.Stretch)
+
+        # Download format menu, shared by all rows
+        self.downloadMenu = qt.QMenu(self.ui.orderTableView)
+        for format in REPORT_FORMATS:
+            action = self.downloadMenu.addAction(f"View {format.upper()}")
+            action.setData(f"view:{format}")
+        self.downloadMenu.addSeparator()
+        for format in REPORT_FORMATS:
+            action = self.downloadMenu.addAction(f"Save {format.upper()}...")
+            action.setData(f"save:{format}")
+        self.reportViewer = None
+        self.reportVolumes = ReportVolumes(slicer.mrmlScene, *self.__reportVolumeLimits())
+        self.downloadMenu.addSeparator()
+        action = self.downloadMenu.addAction("Show PNG in slice views")
+        action.setData("slices:png")
+
         # Buttons
         self.ui.neuropacsButton.connect("clicked(bool)", self.onNeuropacsButton)
         self.ui.refreshButton.connect("clicked(bool)", self.onRefreshButton)
         self.ui.validateKeyButton.connect("clicked(bool)", self.onValidateKeyButton)
         self.ui.helpButton.connect("clicked(bool)", self.onHelpButton)
+        self.ui.cancelButton.connect("clicked(bool)", self.onCancelButton)
+        self.ui.queueButton.connect("clicked(bool)", self.onQueueButton)
+        self.ui.exportButton.connect("clicked(bool)", self.onExportButton)
+        self.ui.resultsButton.connect("clicked(bool)", self.onResultsButton)
+
+        # Upload progress is only shown while a dataset is submitted
+        self.ui.uploadProgressBar.setVisible(False)
+        self.ui.cancelButton.setVisible(False)
 
         # Disable actions before API key validation
         self.__disableActions()
 
+        # Connect with the stored credentials once the widget is shown
+        qt.QTimer.singleShot(0, self.__restoreSession)
+
+    def cleanup(self) -> None:
+        """Called when the application closes and the module widget is destroyed."""
+        if self.reportViewer is not None:
+            slicer.util.mainWindow().removeDockWidget(self.reportViewer)
+            self.reportViewer.deleteLater()
+        self.logic.shutdown()
+
+    def enter(self) -> None:
+        """Called each time the user opens this module."""
+        # Resume background progress updates once the API key is validated
+        if self.logic.npcs is not None:
+            self.logic.statusPoller.poll()
+            self.logic.statusPoller.start()
+
+    def exit(self) -> None:
+        """Called each time the user opens a different module."""
+        self.logic.statusPoller.stop()
+
     def load_npcs_file_selector(self, default_path):
         parametersCollapsibleButton = ctk.ctkCollapsibleButton()
         parametersCollapsibleButton.text = "Parameters"
@@ -130,123 +230,277 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
 
         parametersFormLayout.addRow("Config file location:", self.configPathFileSelector)
 
+        # Order status fetching
+        self.statusConcurrencySpinBox = qt.QSpinBox()
+        self.statusConcurrencySpinBox.setRange(1, 64)
+        self.statusConcurrencySpinBox.value = self.logic.statusFetcher.maxWorkers
+        self.statusConcurrencySpinBox.toolTip = "Maximum number of order status requests sent in parallel."
+        self.statusConcurrencySpinBox.valueChanged.connect(self.on_status_concurrency_changed)
+        parametersFormLayout.addRow("Parallel status requests:", self.statusConcurrencySpinBox)
+
+        self.statusTimeoutSpinBox = qt.QSpinBox()
+        self.statusTimeoutSpinBox.setRange(1, 600)
+        self.statusTimeoutSpinBox.suffix = " s"
+        self.statusTimeoutSpinBox.value = int(self.logic.statusFetcher.timeout)
+        self.statusTimeoutSpinBox.toolTip = "Time after which a single order status request is given up."
+        self.statusTimeoutSpinBox.valueChanged.connect(self.on_status_timeout_changed)
+        parametersFormLayout.addRow("Status request timeout:", self.statusTimeoutSpinBox)
+
+        self.statusPollIntervalSpinBox = qt.QSpinBox()
+        self.statusPollIntervalSpinBox.setRange(5, 3600)
+        self.statusPollIntervalSpinBox.suffix = " s"
+        self.statusPollIntervalSpinBox.value = self.logic.statusPoller.timer.interval // 1000
+        self.statusPollIntervalSpinBox.toolTip = "How often the progress of running orders is checked in the background."
+        self.statusPollIntervalSpinBox.valueChanged.connect(self.on_status_poll_interval_changed)
+        parametersFormLayout.addRow("Progress update interval:", self.statusPollIntervalSpinBox)
+
+        # Dataset submission
+        self.maxParallelUploadsSpinBox = qt.QSpinBox()
+        self.maxParallelUploadsSpinBox.setRange(1, 16)
+        self.maxParallelUploadsSpinBox.value = self.logic.submissionQueue.maxUploads
+        self.maxParallelUploadsSpinBox.toolTip = "Maximum number of datasets uploaded at the same time."
+        self.maxParallelUploadsSpinBox.valueChanged.connect(self.on_max_parallel_uploads_changed)
+        parametersFormLayout.addRow("Parallel uploads:", self.maxParallelUploadsSpinBox)
+
+        self.compressionLevelSpinBox = qt.QSpinBox()
+        self.compressionLevelSpinBox.setRange(0, 9)
+        self.compressionLevelSpinBox.value = self.logic.submissionQueue.compressionLevel
+        self.compressionLevelSpinBox.toolTip = ("Compression of uploaded datasets, from 0 (none, least CPU) "
+                                                "to 9 (smallest upload, most CPU).")
+        self.compressionLevelSpinBox.valueChanged.connect(self.on_compression_level_changed)
+        parametersFormLayout.addRow("Upload compression level:", self.compressionLevelSpinBox)
+
+        # Reports
+        self.reportCacheSizeSpinBox = qt.QSpinBox()
+        self.reportCacheSizeSpinBox.setRange(MIN_REPORT_CACHE_SIZE // 2**20, 100000)
+        self.reportCacheSizeSpinBox.suffix = " MB"
+        self.reportCacheSizeSpinBox.value = self.logic.reportCacheSize() // 2**20
+        self.reportCacheSizeSpinBox.toolTip = "Disk space used to keep downloaded reports, least recently used reports are removed first."
+        self.reportCacheSizeSpinBox.valueChanged.connect(self.on_report_cache_size_changed)
+        parametersFormLayout.addRow("Report cache size:", self.reportCacheSizeSpinBox)
+
+        self.prefetchReportsCheckBox = qt.QCheckBox()
+        self.prefetchReportsCheckBox.checked = self.logic.reportPrefetcher.enabled
+        self.prefetchReportsCheckBox.toolTip = "Download the reports of orders into the report cache as soon as they complete."
+        self.prefetchReportsCheckBox.toggled.connect(self.on_prefetch_reports_toggled)
+        parametersFormLayout.addRow("Prefetch reports:", self.prefetchReportsCheckBox)
+
+        prefetchFormatsLayout = qt.QHBoxLayout()
+        self.prefetchFormatCheckBoxes = {}
+        for format in REPORT_FORMATS:
+            checkBox = qt.QCheckBox(format.upper())
+            checkBox.checked = format in self.logic.reportPrefetcher.formats
+            checkBox.toggled.connect(self.on_prefetch_formats_changed)
+            prefetchFormatsLayout.addWidget(checkBox)
+            self.prefetchFormatCheckBoxes[format] = checkBox
+        parametersFormLayout.addRow("Prefetched formats:", prefetchFormatsLayout)
+
+        self.maxOpenReportsSpinBox = qt.QSpinBox()
+        self.maxOpenReportsSpinBox.setRange(1, 100)
+        self.maxOpenReportsSpinBox.value = self.__maxOpenReports()
+        self.maxOpenReportsSpinBox.toolTip = "Number of reports kept open in the report viewer, the least recently viewed report is closed first."
+        self.maxOpenReportsSpinBox.valueChanged.connect(self.on_max_open_reports_changed)
+        parametersFormLayout.addRow("Open reports:", self.maxOpenReportsSpinBox)
+
+        maxReportVolumes, maxReportVolumeMemory = self.__reportVolumeLimits()
+        self.maxReportVolumesSpinBox = qt.QSpinBox()
+        self.maxReportVolumesSpinBox.setRange(1, 100)
+        self.maxReportVolumesSpinBox.value = maxReportVolumes
+        self.maxReportVolumesSpinBox.toolTip = "Number of PNG reports kept in the scene, the least recently shown report is removed first."
+        self.maxReportVolumesSpinBox.valueChanged.connect(self.on_report_volume_limits_changed)
+        parametersFormLayout.addRow("Report volumes in scene:", self.maxReportVolumesSpinBox)
+
+        self.reportVolumeMemorySpinBox = qt.QSpinBox()
+        self.reportVolumeMemorySpinBox.setRange(1, 100000)
+        self.reportVolumeMemorySpinBox.suffix = " MB"
+        self.reportVolumeMemorySpinBox.value = maxReportVolumeMemory // 2**20
+        self.reportVolumeMemorySpinBox.toolTip = "Memory used by PNG reports in the scene, the least recently shown reports are removed first."
+        self.reportVolumeMemorySpinBox.valueChanged.connect(self.on_report_volume_limits_changed)
+        parametersFormLayout.addRow("Report volume memory:", self.reportVolumeMemorySpinBox)
+
+        # neuropacs package updates
+        self.offlineCheckBox = qt.QCheckBox()
+        self.offlineCheckBox.checked = self.logic.isOffline()
+        self.offlineCheckBox.toolTip = "Never contact PyPI, neuropacs is only installed and updated from the local wheel directory."
+        self.offlineCheckBox.toggled.connect(self.on_offline_toggled)
+        parametersFormLayout.addRow("Offline mode:", self.offlineCheckBox)
+
+        self.rememberSessionCheckBox = qt.QCheckBox()
+        self.rememberSessionCheckBox.checked = self.logic.rememberSession()
+        self.rememberSessionCheckBox.toolTip = ("Keep the API key and session in the OS keyring and connect automatically when the module "
+                                                "is opened. Without a keyring they are kept in a file only readable by your user account, "
+                                                "encrypted with a key stored next to it: anyone who can read your files can read the API key.")
+        self.rememberSessionCheckBox.toggled.connect(self.on_remember_session_toggled)
+        parametersFormLayout.addRow("Remember API key:", self.rememberSessionCheckBox)
+
+        self.wheelDirectorySelector = ctk.ctkPathLineEdit()
+        self.wheelDirectorySelector.filters = ctk.ctkPathLineEdit.Dirs
+        self.wheelDirectorySelector.setCurrentPath(slicer.util.settingsValue("neuropacs/wheelDirectory", ""))
+        self.wheelDirectorySelector.toolTip = "Directory of neuropacs wheel files, used instead of PyPI to install and update neuropacs."
+        self.wheelDirectorySelector.currentPathChanged.connect(self.on_wheel_directory_changed)
+        parametersFormLayout.addRow("Local wheel directory:", self.wheelDirectorySelector)
+
+        self.versionCheckIntervalSpinBox = qt.QSpinBox()
+        self.versionCheckIntervalSpinBox.setRange(0, 24 * 30)
+        self.versionCheckIntervalSpinBox.suffix = " h"
+        self.versionCheckIntervalSpinBox.value = slicer.util.settingsValue("neuropacs/versionCheckInterval", 24, converter=int)
+        self.versionCheckIntervalSpinBox.toolTip = "Time between checks for a new neuropacs version, 0 checks on every API key validation."
+        self.versionCheckIntervalSpinBox.valueChanged.connect(self.on_version_check_interval_changed)
+        parametersFormLayout.addRow("Update check interval:", self.versionCheckIntervalSpinBox)
+
     def on_config_path_changed(self, new_path):
         if not new_path:
             return
         self.neuropacsConfigPath = new_path  
         qt.QSettings().setValue("neuropacs/configPath", new_path)
 
-    def create_config(self, path):
-        default_config = {
-            "TEST": "TEST",
-        }
-        try:
-            self.neuropacsOrderMap = default_config
-            with open(path, 'w') as config_file:
-                json.dump(default_config, config_file)
-        except Exception as e:
-            slicer.util.errorDisplay(f"Failed to create configuration file '{path}': {str(e)}")
-            raise e  # Re-raise the exception if necessary
+    def on_status_concurrency_changed(self, value):
+        self.logic.statusFetcher.setMaxWorkers(value)
+        qt.QSettings().setValue("neuropacs/statusConcurrency", value)
 
-    def configure_config(self, path):
-        directory = os.path.dirname(path)
-        if not os.path.isdir(directory):
-            try:
-                os.makedirs(directory)
-                print(f"Created directory '{directory}'.")
-            except Exception as e:
-                slicer.util.errorDisplay(f"Failed to create directory '{directory}': {str(e)}")
-                return
+    def on_status_timeout_changed(self, value):
+        self.logic.statusFetcher.setTimeout(value)
+        qt.QSettings().setValue("neuropacs/statusTimeout", value)
 
-        if not os.access(directory, os.W_OK):
-            slicer.util.warningDisplay(f"No write permission in the directory '{directory}'.")
-            return
+    def on_status_poll_interval_changed(self, value):
+        self.logic.statusPoller.setInterval(value)
+        qt.QSettings().setValue("neuropacs/statusPollInterval", value)
 
-        if os.path.isfile(path):
-            # Load existing config
-            try:
-                if os.path.getsize(path) == 0:
-                    self.create_config(path)
-                else:
-                    self.load_config(path)
-                qt.QApplication.processEvents()
-                print(f"Configuration file loaded from '{path}'.")
-            except Exception as e:
-                slicer.util.errorDisplay(f"Failed to load configuration: {str(e)}")
+    def on_max_parallel_uploads_changed(self, value):
+        self.logic.submissionQueue.setMaxUploads(value)
+        qt.QSettings().setValue("neuropacs/maxParallelUploads", value)
+
+    def on_report_cache_size_changed(self, value):
+        qt.QSettings().setValue("neuropacs/reportCacheSize", value)
+        if self.logic.reportCache is not None:
+            self.logic.reportCache.setMaxSize(self.logic.reportCacheSize())
+
+    def on_prefetch_reports_toggled(self, checked):
+        self.logic.reportPrefetcher.setEnabled(checked)
+        qt.QSettings().setValue("neuropacs/prefetchReports", checked)
+
+    def on_prefetch_formats_changed(self, checked):
+        formats = [format for format, checkBox in self.prefetchFormatCheckBoxes.items() if checkBox.checked]
+        self.logic.reportPrefetcher.setFormats(formats)
+        qt.QSettings().setValue("neuropacs/prefetchFormats", ",".join(formats))
+
+    def on_offline_toggled(self, checked):
+        qt.QSettings().setValue("neuropacs/offline", checked)
+
+    def on_remember_session_toggled(self, checked):
+        if checked and not self.logic.credentialStore().isAvailable():
+            if not slicer.util.confirmOkCancelDisplay(
+                    "Storing the API key requires the keyring or the cryptography Python package. Install cryptography now?"):
+                self.rememberSessionCheckBox.checked = False
+                return
+            with slicer.util.tryWithErrorDisplay(_("Failed to install cryptography."), waitCursor=True):
+                slicer.util.pip_install("cryptography")
+        if checked and self.logic.credentialStore().backend() == "file":
+            if not slicer.util.confirmOkCancelDisplay(
+                    "No OS keyring is available. The API key will be kept in a file only readable by your user account. "
+                    "The file is encrypted with a key stored next to it, so anyone who can read your files can read the API key. "
+                    "Remember the API key anyway?"):
+                self.rememberSessionCheckBox.checked = False
+                return
+        qt.QSettings().setValue("neuropacs/rememberSession", checked)
+        if not checked:
+            self.logic.credentialStore().clear()
         else:
-            # Create new config file
-            try:
-                self.create_config(path)
-                print(f"Configuration file created at '{path}'.")
-            except Exception as e:
-                slicer.util.errorDisplay(f"Failed to create configuration file: {str(e)}")
+            self.logic.saveSession(self.ui.apiKeyLineEdit.text)
 
-    def setup_python_requirements(self):
-        # install neuropacs pip module if not already installed
-        global neuropacs
+    def __restoreSession(self):
+        """Connect in the background with the stored credentials, if the user opted in"""
+        if not self.logic.rememberSession() or self.logic.npcs is not None:
+            return
+        if installedVersion("neuropacs") is None:
+            # Installing blocks the application, it is only done when the user validates the API key
+            self.ui.infoLabel.setText("neuropacs is not installed, please validate the API key to install it.")
+            return
         try:
-            self.ensure_latest_neuropacs_installed()
-            import neuropacs
+            with self.startupTimings.measure("configuration"):
+                self.configure_config(self.neuropacsConfigPath)
+            with self.startupTimings.measure("neuropacs import"):
+                self.setup_python_requirements()
+            self.startupTimings.start("connect")
+            future = self.logic.restoreSession(onFinished=self.__onSessionRestored)
         except Exception as e:
-            print(str(e))
+            logging.warning(f"Failed to restore the neuropacs session: {str(e)}")
+            return
+        if future is not None:
+            self.ui.infoLabel.setText("Connecting with the stored API key... ")
+            self.ui.validateKeyButton.setEnabled(False)
 
-    def ensure_latest_neuropacs_installed(self):
-        import importlib.metadata
-        import importlib.util
-        import packaging.version
-        import requests
+    def __onSessionRestored(self, job):
+        self.startupTimings.finish("connect")
+        if self.logic.npcs is not job.npcs:
+            # Failed, or the API key was validated meanwhile
+            self.ui.validateKeyButton.setEnabled(self.logic.npcs is None)
+            self.ui.infoLabel.setText("" if self.logic.npcs is not None else "Stored API key could not be used, please validate the API key.")
+            return
+        self.ui.apiKeyLineEdit.text = job.credentials["api_key"]
+        self.__onConnected()
+        logging.info(f"Connected with the stored API key ({self.startupTimings.summary()})")
 
-        needToInstallNeuropacs = True
-        installed_version = None
-        latest_version = None
+    def on_wheel_directory_changed(self, path):
+        qt.QSettings().setValue("neuropacs/wheelDirectory", path)
 
-        # Check the installed version of neuropacs
-        try:
-            installed_version = importlib.metadata.version("neuropacs")
-        except Exception:
-            pass  # Neuropacs is not installed or there was an error getting the version
+    def on_version_check_interval_changed(self, value):
+        qt.QSettings().setValue("neuropacs/versionCheckInterval", value)
 
-        # Get the latest version of neuropacs from PyPI
-        try:
-            response = requests.get("https://pypi.org/pypi/neuropacs/json")
-            latest_version = response.json()["info"]["version"]
-        except Exception:
-            print("Error fetching the latest version of neuropacs from PyPI.")
-            return
+    def on_max_open_reports_changed(self, value):
+        qt.QSettings().setValue("neuropacs/maxOpenReports", value)
+        if self.reportViewer is not None:
+            self.reportViewer.setMaxDocuments(value)
 
-        # Compare versions and decide if we need to install/upgrade
-        if installed_version is not None and packaging.version.parse(installed_version) >= packaging.version.parse(latest_version):
-            # The installed version is up to date
-            needToInstallNeuropacs = False
+    def on_report_volume_limits_changed(self, value):
+        qt.QSettings().setValue("neuropacs/maxReportVolumes", self.maxReportVolumesSpinBox.value)
+        qt.QSettings().setValue("neuropacs/reportVolumeMemory", self.reportVolumeMemorySpinBox.value)
+        self.reportVolumes.setLimits(*self.__reportVolumeLimits())
 
-        if needToInstallNeuropacs:
-            print(f"Upgrading neuropacs to version {latest_version}...")
-            slicer.util.pip_install(f"neuropacs=={latest_version}")
-        else:
-            print(f"Neuropacs is already up to date (version {installed_version}).")
-
-    def save_config(self):
-        """Save the neuropacs order map to a JSON file."""
-        with open(self.neuropacsConfigPath, 'w') as orderFile:
-            json.dump(self.neuropacsOrderMap, orderFile)
-
-    def load_config(self, path):
-        """Load the neuropacs order map from a JSON file."""
-        if os.path.exists(path):
-            with open(path, 'r') as orderFile:
-                self.neuropacsOrderMap = json.load(orderFile)
-        else:
-            with open(self.neuropacsConfigPath, "a") as file:
-                json.dump({}, file)
+    def __reportVolumeLimits(self):
+        """Maximum number and memory size in bytes of report volumes in the scene"""
+        return (slicer.util.settingsValue("neuropacs/maxReportVolumes", 10, converter=int),
+                slicer.util.settingsValue("neuropacs/reportVolumeMemory", 512, converter=int) * 2**20)
+
+    def __maxOpenReports(self):
+        return slicer.util.settingsValue("neuropacs/maxOpenReports", 8, converter=int)
 
-    def storeNeuropacsOrder(self, patientId, orderId):
+    def on_compression_level_changed(self, value):
+        self.logic.submissionQueue.setCompressionLevel(value)
+        qt.QSettings().setValue("neuropacs/compressionLevel", value)
+
+    def configure_config(self, path):
+        with slicer.util.tryWithErrorDisplay(_("Failed to load configuration.")):
+            self.logic.configure(path)
+
+    def setup_python_requirements(self):
+        # install neuropacs pip module if not already installed
+        try:
+            self.logic.setupPythonRequirements()
+            self.logic.checkNeuropacsVersion(onFinished=self.__onNeuropacsVersionChecked)
+        except Exception as e:
+            print(str(e))
+
+    def __onNeuropacsVersionChecked(self, job):
+        if job.error is not None:
+            return
+        if not isNewer(job.latestVersion, job.installedVersion):
+            print(f"Neuropacs is already up to date (version {job.installedVersion}).")
+            return
+        if slicer.util.confirmYesNoDisplay(
+                f"neuropacs {job.latestVersion} is available (installed: {job.installedVersion}). Install it now?\n\n"
+                "The new version is used after restarting Slicer."):
+            with slicer.util.tryWithErrorDisplay(_("Failed to install neuropacs."), waitCursor=True):
+                self.logic.installNeuropacs(job.latestVersion, fromWheels=job.fromWheels)
+
+    def storeNeuropacsOrder(self, patientId, orderId, datasetPath=None, product=None):
         """Associate an orderId with the patient."""
-        self.neuropacsOrderMap[orderId] = patientId  # Store the order associated with the dataset
-        self.save_config()  # Save the updated map to a file
+        self.logic.orderStore.addOrder(orderId, patientId, datasetPath, product)
 
     def getNeuropacsOrder(self, orderId):
         """Retrieve the neuropacs order associated with a patient."""
-        return self.neuropacsOrderMap.get(orderId, "No order found")
+        patientId = self.logic.orderStore.patient(orderId)
+        return "No order found" if patientId is None else patientId
 
     def _checkCanNeuropacs(self, caller=None, event=None) -> None:
         """Can neuropacs be pressed""" 
@@ -258,73 +512,190 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
             self.ui.neuropacsButton.enabled = False
 
     def __downloadReport(self, orderId, format):
-        """Download neuropacs biomarker report png"""
+        """Download a neuropacs report to a file in the background, then display it"""
         with slicer.util.tryWithErrorDisplay(_("Failed to download report."), waitCursor=True):
+            # Open file save dialog to let the user select where to save the report
+            file_path = qt.QFileDialog.getSaveFileName(None, "Save Report", f"neuropacs_{orderId}.{format}")
+            if not file_path:
+                return
+            self.__startReportDownload(orderId, format, file_path)
 
-            results = self.npcs.get_results(orderId, format)
-
-            # Open file save dialog to let the user select where to save the image
-            file_dialog = qt.QFileDialog()
-            file_path = file_dialog.getSaveFileName(None, "Save Report", f"neuropacs_{orderId}.{format}")
-
-            if file_path:
-                if format == "txt" or format == "json" or format == "xml":
-                    with open(file_path, "w") as report_file:
-                        report_file.write(str(results))
-                elif format == "png":
-                    # Get results in png bytes
-                    results_bytes = results.getvalue()
-                    # Save the raw PNG image data to the selected file
-                    with open(file_path, "wb") as report_file:
-                        report_file.write(results_bytes)
-
-            # Display the image/txt in a Slicer viewer
-            if format == "png":
-                self.display_png_in_slicer(file_path)
-            elif format == "txt" or format == "json" or format == "xml":
-                self.display_text_in_slicer(file_path)
-
-            
-            # Notify the user that the download is complete
-            qt.QMessageBox.information(None, "Download Complete", f"Report neuropacs_{orderId}.{format} downloaded successfully at {file_path}")
-        
-    def display_png_in_slicer(self, file_path):
-        # Load the PNG as a volume
-        success, volume_node = slicer.util.loadVolume(file_path, returnNode=True)
-        
-        if success:
-            # Set up the slice viewer to show the PNG image
-            slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
-            red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
-            red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(volume_node.GetID())
-        else:
-            print("Failed to load and display the PNG image.")
+    def __viewReport(self, orderId, format, inSlices=False):
+        """Display a neuropacs report, it is only kept in the report cache"""
+        if inSlices and self.reportVolumes.node(orderId) is not None:
+            self.display_png_in_slice_views(None, orderId)
+            return
+        if not inSlices and self.reportViewer is not None and self.reportViewer.hasDocument((orderId, format)):
+            self.reportViewer.showDocument((orderId, format))
+            return
+        with slicer.util.tryWithErrorDisplay(_("Failed to download report."), waitCursor=True):
+            self.__startReportDownload(orderId, format, None, inSlices)
+
+    def __startReportDownload(self, orderId, format, path, inSlices=False):
+        future = self.logic.downloadReport(
+            orderId, format, path,
+            onProgress=lambda job: self.__onReportDownloadProgress(job, progressDialog),
+            onFinished=lambda job: self.__onReportDownloaded(job, progressDialog, saved=path is not None, inSlices=inSlices))
+        progressDialog = slicer.util.createProgressDialog(
+            windowTitle="Downloading report", labelText=future.job.statusText(), maximum=0)
+        progressDialog.canceled.connect(future.job.cancel)
+
+    def __onReportDownloadProgress(self, job, progressDialog):
+        if job.bytesTotal:
+            progressDialog.maximum = 100
+            progressDialog.value = job.progressPercent()
+        progressDialog.labelText = job.statusText()
+
+    def __onReportDownloaded(self, job, progressDialog, saved, inSlices=False):
+        progressDialog.close()
+        if job.stage == DOWNLOAD_FAILED:
+            slicer.util.errorDisplay(f"Failed to download report: {job.error}")
+            return
+        if job.stage != DOWNLOAD_DONE:
+            return
 
-    def display_text_in_slicer(self, file_path):
-        # Read the file content
-        with open(file_path, 'r') as file:
-            content = file.read()
+        # Display the image/txt in a Slicer viewer, the report cache keeps the file until it has been read
+        with slicer.util.tryWithErrorDisplay(_("Failed to display report.")):
+            if job.format == "png":
+                try:
+                    with open(job.path, "rb") as reportFile:
+                        data = reportFile.read()
+                finally:
+                    job.release()
+                if inSlices:
+                    self.display_png_in_slice_views(data, job.orderId)
+                else:
+                    self.display_png_in_slicer(data, job.orderId)
+            elif job.format in TEXT_FORMATS:
+                try:
+                    # Large reports are read in chunks after this returns
+                    self.display_text_in_slicer(job.path, job.orderId, job.format, onLoaded=job.release)
+                except Exception:
+                    job.release()
+                    raise
+
+        # Notify the user that the download is complete
+        if saved:
+            qt.QMessageBox.information(None, "Download Complete", f"Report neuropacs_{job.orderId}.{job.format} downloaded successfully at {job.path}")
+
+    def onExportButton(self) -> None:
+        """Export the reports of all completed orders"""
+        with slicer.util.tryWithErrorDisplay(_("Failed to export reports."), waitCursor=True):
+            orders = self.logic.completedOrders()
+            if not orders:
+                slicer.util.infoDisplay("There are no completed orders to export.")
+                return
+
+            options = self.__selectExportOptions(len(orders))
+            if options is None:
+                return
+            formats, asZip, maxWorkers = options
+            if asZip:
+                destination = qt.QFileDialog.getSaveFileName(None, "Export Reports", "neuropacs_reports.zip", "Zip files (*.zip)")
+                if destination and not destination.lower().endswith(".zip"):
+                    destination += ".zip"
+            else:
+                destination = qt.QFileDialog.getExistingDirectory(None, "Export Reports")
+            if not destination:
+                return
 
-        # Create a new QTextEdit widget to display the content
-        text_edit = qt.QTextEdit()
-        text_edit.setPlainText(content)
-        text_edit.setReadOnly(True)  # Make the text read-only
+            future = self.logic.exportReports(
+                orders, formats, destination, maxWorkers=maxWorkers,
+                onProgress=lambda job: self.__onExportProgress(job, progressDialog),
+                onFinished=lambda job: self.__onExported(job, progressDialog))
+            progressDialog = slicer.util.createProgressDialog(
+                windowTitle="Exporting reports", labelText=future.job.statusText(), maximum=future.job.filesTotal)
+            progressDialog.canceled.connect(future.job.cancel)
+
+    def onResultsButton(self) -> None:
+        """Show the cohort results of the downloaded JSON reports"""
+        with slicer.util.tryWithErrorDisplay(_("Failed to show results."), waitCursor=True):
+            if not self.logic.resultsTable.orderIds():
+                slicer.util.infoDisplay("No results yet. Results are collected from downloaded JSON reports "
+                                        "(enable prefetching of JSON reports to collect them automatically).")
+                return
+            ResultsDialog(self.logic.resultsTable, slicer.util.mainWindow()).exec_()
+
+    def __selectExportOptions(self, orderCount):
+        """Let the user choose formats and destination type, returns (formats, asZip, maxWorkers) or None"""
+        dialog = qt.QDialog(slicer.util.mainWindow())
+        dialog.setWindowTitle("Export reports")
+        layout = qt.QFormLayout(dialog)
+        layout.addRow(qt.QLabel(f"Export the reports of {orderCount} completed orders."))
+
+        formatsLayout = qt.QHBoxLayout()
+        formatCheckBoxes = {}
+        for format in REPORT_FORMATS:
+            checkBox = qt.QCheckBox(format.upper())
+            checkBox.checked = format in slicer.util.settingsValue("neuropacs/exportFormats", "png,json").split(",")
+            formatsLayout.addWidget(checkBox)
+            formatCheckBoxes[format] = checkBox
+        layout.addRow("Formats:", formatsLayout)
+
+        zipCheckBox = qt.QCheckBox("Single zip file")
+        zipCheckBox.checked = slicer.util.settingsValue("neuropacs/exportAsZip", False, converter=slicer.util.toBool)
+        layout.addRow("Output:", zipCheckBox)
+
+        workersSpinBox = qt.QSpinBox()
+        workersSpinBox.setRange(1, 16)
+        workersSpinBox.value = slicer.util.settingsValue("neuropacs/exportConcurrency", 4, converter=int)
+        layout.addRow("Parallel downloads:", workersSpinBox)
+
+        buttonBox = qt.QDialogButtonBox(qt.QDialogButtonBox.Ok | qt.QDialogButtonBox.Cancel)
+        buttonBox.accepted.connect(dialog.accept)
+        buttonBox.rejected.connect(dialog.reject)
+        layout.addRow(buttonBox)
+
+        if dialog.exec_() != qt.QDialog.Accepted:
+            return None
+        formats = [format for format, checkBox in formatCheckBoxes.items() if checkBox.checked]
+        if not formats:
+            raise ValueError("No report format selected.")
+        qt.QSettings().setValue("neuropacs/exportFormats", ",".join(formats))
+        qt.QSettings().setValue("neuropacs/exportAsZip", zipCheckBox.checked)
+        qt.QSettings().setValue("neuropacs/exportConcurrency", workersSpinBox.value)
+        return formats, zipCheckBox.checked, workersSpinBox.value
+
+    def __onExportProgress(self, job, progressDialog):
+        progressDialog.value = job.filesDone
+        progressDialog.labelText = job.statusText()
+
+    def __onExported(self, job, progressDialog):
+        progressDialog.close()
+        if job.cancelled:
+            return
+        if job.error is not None:
+            slicer.util.errorDisplay(f"Failed to export reports: {job.error}")
+            return
+        message = f"{job.filesDone} reports exported to {job.destination}"
+        if job.filesSkipped:
+            message += f" ({job.filesSkipped} exported earlier)"
+        if job.failed:
+            message += "\n\nFailed reports:\n" + "\n".join(f"{orderId} ({format}): {error}" for orderId, format, error in job.failed)
+            slicer.util.warningDisplay(message)
+        else:
+            slicer.util.infoDisplay(message)
 
-        # Add the text widget to the Slicer layout
-        main_window = slicer.util.mainWindow()
-        central_widget = main_window.centralWidget()
+    def display_png_in_slicer(self, data, orderId):
+        """Show a PNG report (bytes) in the report viewer, the view layout is left alone"""
+        self.__getReportViewer().showImage((orderId, "png"), f"{orderId} (PNG)", data)
 
-        # Create a layout if not already present
-        layout = central_widget.layout()
-        if not layout:
-            layout = qt.QVBoxLayout(central_widget)
-            central_widget.setLayout(layout)
+    def display_png_in_slice_views(self, data, orderId):
+        """Show a PNG report (bytes) as a volume in the slice views, its volume node is reused when shown again"""
+        node = self.reportVolumes.show(orderId, data)
+        slicer.util.setSliceViewerLayers(background=node, fit=True)
 
-        # Add the QTextEdit to the main window's layout
-        layout.addWidget(text_edit)
+    def display_text_in_slicer(self, file_path, orderId, format="txt", onLoaded=None):
+        """Show a TXT/JSON/XML report in the report viewer, onLoaded() is called once the file has been read"""
+        self.__getReportViewer().showText((orderId, format), f"{orderId} ({format.upper()})", file_path, format, onLoaded)
 
-        # Optionally print a message confirming the text was displayed
-        print("Text content loaded into Slicer's main window.")
+    def __getReportViewer(self):
+        """The report viewer dock, created the first time a report is shown"""
+        if self.reportViewer is None:
+            mainWindow = slicer.util.mainWindow()
+            self.reportViewer = ReportViewerDock(mainWindow, self.__maxOpenReports())
+            mainWindow.addDockWidget(qt.Qt.RightDockWidgetArea, self.reportViewer)
+        return self.reportViewer
 
     def __deleteOrder(self, order_id):
         """Delete an order from the table"""
@@ -333,18 +704,15 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
                 self.ui.infoLabel.setText(f"Deleting order {order_id}... ")
                 qt.QApplication.processEvents()
 
-                # Delete from neuropacs map
-                if order_id in self.neuropacsOrderMap:
-                    del self.neuropacsOrderMap[order_id]
-
-                # Write new neuropacs map
-                self.save_config()
+                # Delete from the order store
+                self.logic.deleteOrders([order_id])
+                self.reportVolumes.removeOrders([order_id])
 
                 self.ui.infoLabel.setText(f"Order {order_id} deleted.")
                 qt.QApplication.processEvents()
 
-                # Re-render table
-                self.populateOrderTable()
+                # Remove the row, the other orders need no new status check
+                self.orderTableModel.removeOrders([order_id])
 
                 self.ui.infoLabel.setText("")
                 qt.QApplication.processEvents()
@@ -353,115 +721,92 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
 
     def __deleteExpiredOrders(self, expired_orders):
         """Delete expired orders after table population"""
-        for exp in expired_orders:
-            # Delete from neuropacs map
-            if exp in self.neuropacsOrderMap:
-                del self.neuropacsOrderMap[exp]
-
-        # Write new neuropacs map
-        self.save_config()
-
-    
-    def __extractInfoFromStatus(self, statusObj):
-        return statusObj['info']
-
-    def __extractProgressFromStatus(self, statusObj):
-        return str(statusObj['progress']) + '%'
+        if expired_orders:
+            self.logic.deleteOrders(expired_orders)
+            self.reportVolumes.removeOrders(expired_orders)
 
     def populateOrderTable(self):
-        """Populate the TableView with existing orders"""
-        self.ui.tableWidget.setRowCount(len(self.neuropacsOrderMap))
-        self.ui.tableWidget.setColumnCount(6) # orderId, datasetId/patientId, info, progress, download report, delete
-        self.ui.tableWidget.setHorizontalHeaderLabels(["Order ID", "Patient ID", "Info", "Progress", "Download Report", "Delete"])
-
-        rowCount = 0
-        exp_orders = []
-        for order in self.neuropacsOrderMap:
-            patientId = self.neuropacsOrderMap[order]
-
-            # Get status params
-            try:
-                status = self.npcs.check_status(order)  
-            except Exception as e:
-                if ("Bucket not found") in str(e):
-                    exp_orders.append(order)
-                    continue
+        """Populate the TableView with existing orders.
 
-            status_info = self.__extractInfoFromStatus(status)
-            status_progress = self.__extractProgressFromStatus(status)
+        Orders are shown with their last known status from the order store, the status of
+        active orders is then fetched in the background (see applyPolledStatuses).
+        """
+        orders = self.logic.orders()
 
-            # Download button
-            downloadButton = qt.QPushButton("Download")
-
-            # Set button disabled if job is not done (100%)
-            if not status_progress == "100%":
-                downloadButton.setEnabled(False)
-
-            # Create a QMenu to hold the download options
-            downloadMenu = qt.QMenu(downloadButton)
-
-            # Add the options to the menu
-            downloadMenu.addAction("PNG", lambda _, order=order: self.__downloadReport(order, "png"))
-            downloadMenu.addAction("TXT", lambda _, order=order: self.__downloadReport(order, "txt"))
-            downloadMenu.addAction("JSON", lambda _, order=order: self.__downloadReport(order, "json"))
-            downloadMenu.addAction("XML", lambda _, order=order: self.__downloadReport(order, "xml"))
-
-            # Attach the menu to the download button
-            downloadButton.setMenu(downloadMenu)
-
-
-            # Populate table contents
-            dataset_text = qt.QTableWidgetItem(patientId)
-            order_id_text = qt.QTableWidgetItem(order)
-            status_info_text = qt.QTableWidgetItem(status_info)
-            status_progress_text = qt.QTableWidgetItem(status_progress)
-            
-            deleteButton = qt.QPushButton("Delete")
-            deleteButton.clicked.connect(lambda _, order=order: self.__deleteOrder(order))
-
-            self.ui.tableWidget.setItem(rowCount, 0, order_id_text)
-            self.ui.tableWidget.setItem(rowCount, 1, dataset_text)
-            self.ui.tableWidget.setItem(rowCount, 2, status_info_text)
-            self.ui.tableWidget.setItem(rowCount, 3, status_progress_text)
-            self.ui.tableWidget.setCellWidget(rowCount, 4, downloadButton)
-            self.ui.tableWidget.setCellWidget(rowCount, 5, deleteButton)
-
-            rowCount+=1
+        rows = []
+        exp_orders = []
+        for order in orders:
+            orderId = order["order_id"]
+            if order["last_status"] == STATE_EXPIRED:
+                exp_orders.append(orderId)
+                continue
+            if order["last_info"] is None:
+                # Never fetched yet
+                rows.append([orderId, order["patient"], "Checking status...", ""])
+            else:
+                rows.append([orderId, order["patient"], order["last_info"], order["last_progress"]])
+
+        self.orderTableModel.setOrders(rows)
 
         # Delete found expired orders
         self.__deleteExpiredOrders(exp_orders)
 
-    def populateDatasetDropdown(self):
-        """Populate the ComboBox with available datasets (series in the DICOM database)."""
-        dicomDatabase = slicer.dicomDatabase
-
-        # Clear existing items in the dropdown
+        self.logic.statusPoller.poll()
+
+    def __onDownloadClicked(self, index, rect):
+        """Show the report format menu below the clicked download button"""
+        order = self.orderTableModel.orderAt(index.row())
+        action = self.downloadMenu.exec_(self.ui.orderTableView.viewport().mapToGlobal(rect.bottomLeft()))
+        if action:
+            mode, format = action.data().split(":")
+            if mode == "view":
+                self.__viewReport(order, format)
+            elif mode == "slices":
+                self.__viewReport(order, format, inSlices=True)
+            else:
+                self.__downloadReport(order, format)
+
+    def __onDeleteClicked(self, index, rect):
+        self.__deleteOrder(self.orderTableModel.orderAt(index.row()))
+
+    def applyPolledStatuses(self, statuses):
+        """Update the rows of polled orders in place, without rebuilding the table.
+
+        The statuses are recorded and expired orders deleted by the logic already.
+        """
+        self.startupTimings.finish("order statuses")
+        exp_orders = []
+        for order, (status, error) in statuses.items():
+            texts = statusTexts(order, status, error)
+            if texts is None:
+                exp_orders.append(order)
+                continue
+            # Orders deleted meanwhile are ignored by the model
+            self.orderTableModel.updateOrder(order, *texts)
+
+        if exp_orders:
+            self.orderTableModel.removeOrders(exp_orders)
+            self.reportVolumes.removeOrders(exp_orders)
+
+    def populateDatasetDropdown(self, force=False):
+        """Populate the ComboBox with the indexed datasets and update the index in the background."""
+        self.__fillDatasetDropdown()
+        self.logic.refreshDatasets(force=force)
+
+    def __fillDatasetDropdown(self):
+        """Fill the ComboBox from the dataset index, keeping the current selection"""
+        selectedStudyUid = self.ui.datasetComboBox.currentData
+        self.ui.datasetComboBox.blockSignals(True)
         self.ui.datasetComboBox.clear()
-
-        # Get all patient UIDs
-        patientUIDs = dicomDatabase.patients()
-        for patientUID in patientUIDs:
-            # Get the patient's name
-            patientName = dicomDatabase.nameForPatient(patientUID)
-
-            # Get studies for the patient
-            studies = dicomDatabase.studiesForPatient(patientUID)
-            for study in studies:
-                # Get series for the study
-                series = dicomDatabase.seriesForStudy(study)
-
-                first_series = series[0]
-
-                files = dicomDatabase.filesForSeries(first_series)
-
-                # Get the first file path and then get the directory
-                first_file_path = files[0]
-                
-                # Get the dataset folder (assumes that the dataset is one level above the DICOM files)
-                dataset_folder = os.path.dirname(first_file_path)
-
-                # Add the dataset name and file path to the dropdown
-                self.ui.datasetComboBox.addItem(patientName, dataset_folder)
+        for patientName, studyUid in self.logic.datasetIndex.datasets():
+            self.ui.datasetComboBox.addItem(patientName, studyUid)
+            dataset = self.logic.datasetIndex.dataset(studyUid)
+            if not dataset["series_uids"]:
+                self.ui.datasetComboBox.setItemData(self.ui.datasetComboBox.count - 1,
+                    "No diffusion series found, all series of the study are uploaded", qt.Qt.ToolTipRole)
+        if selectedStudyUid:
+            self.ui.datasetComboBox.setCurrentIndex(max(0, self.ui.datasetComboBox.findData(selectedStudyUid)))
+        self.ui.datasetComboBox.blockSignals(False)
 
     def onHelpButton(self) -> None:
         """Help button"""
@@ -474,7 +819,7 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
             self.ui.infoLabel.setText("Refreshing... ")
             qt.QApplication.processEvents()
 
-            self.populateDatasetDropdown()
+            self.populateDatasetDropdown(force=True)
             self.populateOrderTable()
 
             self.ui.infoLabel.setText("")
@@ -483,49 +828,60 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
 
     def onValidateKeyButton(self) -> None:
         """Validate API key on button press"""
-        global neuropacs
         with slicer.util.tryWithErrorDisplay(_("Failed to validate API key."), waitCursor=True):
             enteredKey = self.ui.apiKeyLineEdit.text
             # Initialize neuropacs
             try:
-                self.configure_config(self.neuropacsConfigPath)
+                with self.startupTimings.measure("configuration"):
+                    self.configure_config(self.neuropacsConfigPath)
 
                 self.ui.infoLabel.setText("Setting up Python requirements... ")
                 qt.QApplication.processEvents()
-                # Setup python requirements
-                self.setup_python_requirements()
+                # Setup python requirements, neuropacs is imported on first use
+                with self.startupTimings.measure("neuropacs import"):
+                    self.setup_python_requirements()
 
                 self.ui.infoLabel.setText("Validating API key... ")
                 qt.QApplication.processEvents()
 
                 # initialize neuropacs
-                self.npcs = neuropacs.init("https://jdfkdttvlf.execute-api.us-east-1.amazonaws.com/prod", enteredKey, "Slicer")
-                self.npcs.connect()
+                with self.startupTimings.measure("connect"):
+                    self.logic.connect(enteredKey)
+
+                self.__onConnected()
 
-                self.ui.infoLabel.setText("API key validated, populating... ")
+                logging.info(f"API key validated ({self.startupTimings.summary()})")
+            except Exception as e:
+                print(str(e))
+                self.ui.infoLabel.setText("API key validation failed.")
                 qt.QApplication.processEvents()
+                logging.error("API key validation failed")
 
-                # # Load the neuropacs order map from the file
-                # self.load_config()
+    def __onConnected(self):
+        """Show datasets and orders and start the background work once the client is connected"""
+        # Enable user to run jobs
+        self.__enableActions()
 
-                # Populate the dropdown with available datasets
-                self.populateDatasetDropdown()
+        # Datasets and orders are shown from the order store right away, the dataset
+        # index and the order statuses are updated in the background
+        self.startupTimings.start("dataset index")
+        self.populateDatasetDropdown()
+        if not self.logic.datasetIndex.isBuilding():
+            self.startupTimings.finish("dataset index")
 
-                # Populate the table with existing orders
-                self.populateOrderTable()
+        with self.startupTimings.measure("order table"):
+            self.populateOrderTable()
+        if self.logic.activeOrderIds():
+            self.startupTimings.start("order statuses")
 
-                # Enable user to run jobs
-                self.__enableActions()
+        # Keep progress of running orders up to date in the background
+        self.logic.statusPoller.start()
 
-                self.ui.infoLabel.setText("")
-                qt.QApplication.processEvents()
+        # Resume submissions interrupted by the end of the previous session
+        self.logic.resumeSubmissions()
 
-                logging.info("API key validated")
-            except Exception as e:
-                print(str(e))
-                self.ui.infoLabel.setText("API key validation failed.")
-                qt.QApplication.processEvents()
-                logging.error("API key validation failed")
+        self.ui.infoLabel.setText("")
+        qt.QApplication.processEvents()
 
     def openPDF(self):
         """Open the PDF file in the system's default viewer."""
@@ -544,7 +900,10 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
             """Disable actions"""
             self.ui.datasetComboBox.setEnabled(False)
             self.ui.neuropacsButton.setEnabled(False)
+            self.ui.queueButton.setEnabled(False)
             self.ui.refreshButton.setEnabled(False)
+            self.ui.exportButton.setEnabled(False)
+            self.ui.resultsButton.setEnabled(False)
 
     def __enableActions(self):
             """Enabled actions"""
@@ -552,7 +911,10 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
             self.ui.apiKeyLineEdit.setEnabled(False)
             self.ui.datasetComboBox.setEnabled(True)
             self.ui.neuropacsButton.setEnabled(True)
+            self.ui.queueButton.setEnabled(True)
             self.ui.refreshButton.setEnabled(True)
+            self.ui.exportButton.setEnabled(True)
+            self.ui.resultsButton.setEnabled(True)
 
     def __setNeuropacsImage(self):
         # Path to the image in the Resources/Icons folder
@@ -568,54 +930,499 @@ class NeuropacsScriptedModuleWidget(ScriptedLoadableModuleWidget, VTKObservation
     def onNeuropacsButton(self) -> None:
         """Run processing when user clicks "Apply" button."""
         with slicer.util.tryWithErrorDisplay(_("Failed to run neuropacs analysis."), waitCursor=True):
+            # Get the study associated with the selected item in the dropdown
+            selectedStudyUid = self.ui.datasetComboBox.currentData
+            selectedPatient = self.ui.datasetComboBox.currentText
+
+            if not selectedStudyUid or not selectedPatient:
+                raise ValueError("Invalid patient selection.")
+
+            # Create the order, upload the dataset and run the order in the background
+            self.__submitDatasets([(selectedPatient, selectedStudyUid)])
+
+    def onQueueButton(self) -> None:
+        """Submit several datasets at once"""
+        with slicer.util.tryWithErrorDisplay(_("Failed to queue neuropacs analyses."), waitCursor=True):
+            datasets = self.__selectDatasets()
+            self.__submitDatasets(datasets)
+            if datasets:
+                logging.info(f"{len(datasets)} datasets queued for neuropacs analysis")
+
+    def __submitDatasets(self, datasets):
+        """Queue datasets for submission once they are checked against the datasets submitted before"""
+        errors = []
+        checking = False
+        for patient, studyUid in datasets:
+            # A dataset that cannot be submitted does not stop the others
             try:
-            # Get the folder path associated with the selected item in the dropdown
-                selectedFolderPath = self.ui.datasetComboBox.currentData
-                selectedPatient = self.ui.datasetComboBox.currentText
+                self.logic.fingerprintDataset(patient, studyUid, onFinished=self.__onFingerprinted)
+                checking = True
+            except ValueError as e:
+                logging.error(f"Failed to submit the dataset of {patient}: {str(e)}")
+                errors.append(str(e))
+        if checking:
+            self.ui.infoLabel.setText("Checking for previously submitted datasets...")
+        if errors:
+            slicer.util.errorDisplay("Some datasets could not be submitted:\n\n" + "\n".join(errors))
+
+    def __onFingerprinted(self, job):
+        """Offer to reuse an earlier order of an identical dataset, queue the dataset otherwise"""
+        if not self.logic.fingerprintEngine.activeJobs() and not self.logic.submissionQueue.isActive():
+            self.ui.infoLabel.setText("")
+        if job.fingerprint is None:
+            # Checking is best effort, the dataset is submitted anyway
+            self.logic.enqueue(job.patientId, job.datasetPath, files=job.files)
+            return
 
-                if not selectedFolderPath or not selectedPatient:
-                    raise Exception("Invalid patient selection.")
+        earlierOrders = self.logic.earlierOrders(job.fingerprint)
+        if earlierOrders:
+            earlierOrder = earlierOrders[0]
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(earlierOrder["created"]))
+            if slicer.util.confirmYesNoDisplay(
+                    f"The dataset of {job.patientId} was already submitted as order {earlierOrder['order_id']} on {created}.\n\n"
+                    "Show the existing order instead of uploading the dataset again?"):
+                self.__showExistingOrder(earlierOrder["order_id"], job.patientId)
+                return
 
-                # If selected folder path exists, continue
-                if selectedFolderPath:
+        self.logic.enqueue(job.patientId, job.datasetPath, fingerprint=job.fingerprint, files=job.files)
+
+    def __showExistingOrder(self, orderId, patient):
+        """Select an order in the table, restoring it if it was deleted from the table"""
+        status = self.logic.restoreOrder(orderId, patient)
+        if orderId not in self.orderTableModel.orderIds():
+            if status is not None:
+                self.orderTableModel.addOrder([orderId, patient, status["info"], status["progress"]])
+            else:
+                self.orderTableModel.addOrder([orderId, patient, "Order restored", "0%"])
+                self.logic.statusPoller.poll()
+        row = self.orderTableModel.orderIds().index(orderId)
+        self.ui.orderTableView.selectRow(row)
+        self.ui.orderTableView.scrollTo(self.orderTableModel.index(row, 0))
+        logging.info(f"Reusing order {orderId} for an identical dataset of {patient}")
+
+    def __selectDatasets(self):
+        """Let the user pick datasets from the dropdown, returns a list of (patient, study UID)"""
+        dialog = qt.QDialog(slicer.util.mainWindow())
+        dialog.setWindowTitle("Run analysis on multiple datasets")
+        layout = qt.QVBoxLayout(dialog)
+        layout.addWidget(qt.QLabel("Select the datasets to analyze:"))
+
+        datasetList = qt.QListWidget()
+        datasetList.setSelectionMode(qt.QAbstractItemView.ExtendedSelection)
+        for index in range(self.ui.datasetComboBox.count):
+            item = qt.QListWidgetItem(self.ui.datasetComboBox.itemText(index))
+            item.setData(qt.Qt.UserRole, self.ui.datasetComboBox.itemData(index))
+            datasetList.addItem(item)
+        layout.addWidget(datasetList)
+
+        buttonBox = qt.QDialogButtonBox(qt.QDialogButtonBox.Ok | qt.QDialogButtonBox.Cancel)
+        buttonBox.accepted.connect(dialog.accept)
+        buttonBox.rejected.connect(dialog.reject)
+        layout.addWidget(buttonBox)
+
+        if dialog.exec_() != qt.QDialog.Accepted:
+            return []
+        return [(item.text(), item.data(qt.Qt.UserRole)) for item in datasetList.selectedItems()]
+
+    def onCancelButton(self) -> None:
+        """Cancel the running and queued submissions"""
+        self.logic.submissionQueue.cancelAll()
+        self.ui.cancelButton.setEnabled(False)
+        self.ui.infoLabel.setText("Cancelling...")
+
+    def __onQueueChanged(self):
+        """Show the progress of the submission queue"""
+        active = self.logic.submissionQueue.isActive()
+        self.ui.uploadProgressBar.setVisible(active)
+        self.ui.cancelButton.setVisible(active)
+        if active:
+            bytesDone, bytesTotal = self.logic.submissionQueue.progress()
+            self.ui.uploadProgressBar.setValue(int(100 * bytesDone / bytesTotal) if bytesTotal else 0)
+            if self.ui.cancelButton.enabled:
+                self.ui.infoLabel.setText(self.logic.submissionQueue.statusText())
+            return
 
-                    self.ui.infoLabel.setText("Uploading... (this may take a few minutes)")
-                    qt.QApplication.processEvents()
+        self.ui.cancelButton.setEnabled(True)
+        failedJobs = self.logic.submissionQueue.failedJobs
+        self.logic.submissionQueue.failedJobs = []
+        if failedJobs:
+            self.ui.infoLabel.setText("Failed to run analysis.")
+            message = "Failed to run neuropacs analysis:\n" + "\n".join(f"{job.patientId}: {job.error}" for job in failedJobs)
+            if any(job.orderId is not None for job in failedJobs):
+                # Failed uploads are kept in the queue and resume with the files not uploaded yet
+                if slicer.util.confirmRetryCloseDisplay(message + "\n\nFiles already uploaded will not be sent again."):
+                    self.logic.submissionQueue.resume()
+            else:
+                slicer.util.errorDisplay(message)
+        else:
+            self.ui.infoLabel.setText("")
 
-                    # Create a new neuropacs order               
-                    orderId = self.npcs.new_job()
-                    logging.info(f"neuropacs order '{orderId}' created")
+    def __onOrderStarted(self, job):
+        """Show a newly started order, its progress is picked up by the status poller"""
+        self.orderTableModel.addOrder([job.orderId, job.patientId, "Order started", "0%"])
 
-                    # Upload dataset
-                    self.npcs.upload_dataset_from_path(orderId, selectedFolderPath)
-                    logging.info(f"dataset uploaded")
 
-                    self.ui.infoLabel.setText("Running order...")
-                    qt.QApplication.processEvents()
+#
+# NeuropacsScriptedModuleLogic
+#
 
-                    # Run neuropacs order
-                    self.npcs.run_job(orderId, 'Atypical/MSAp/PSP-v1.0')
-                    logging.info(f"order {orderId} started")
 
-                    self.ui.infoLabel.setText(f"Order {orderId} started...")
-                    qt.QApplication.processEvents()
+def statusTexts(orderId, status, error):
+    """Info and progress texts of a fetched status, None if the order has expired"""
+    if error is not None:
+        if isExpired(error):
+            return None
+        logging.warning(f"Failed to check status of order '{orderId}': {str(error)}")
+        return "Status unavailable", "N/A"
+    return status["info"], str(status["progress"]) + "%"
 
-                    # Store neuropacs order
-                    self.storeNeuropacsOrder(selectedPatient, orderId)
-                    logging.info(f"order {orderId} successfully saved")
 
-                    # Reload table
-                    self.populateOrderTable()
+def isExpired(error):
+    """Whether a failed status request means that the order has expired"""
+    return error is not None and "Bucket not found" in str(error)
 
-                    self.ui.infoLabel.setText(f"")
-                    qt.QApplication.processEvents()
 
-                else:
-                    slicer.util.errorDisplay("No dataset selected.")
-            except Exception as e:
-                self.ui.infoLabel.setText("Failed to run analysis.")
-                qt.QApplication.processEvents()
-                logging.error("Failed to run neuropacs analysis: ", str(e))
+class NeuropacsScriptedModuleLogic(ScriptedLoadableModuleLogic):
+    """Client, order store and background workers of the neuropacs module.
+
+    The logic does not depend on the module widget, so that batch scripts can use it without
+    a main window. Long operations run on worker pools: they return the
+    concurrent.futures.Future of their job (see JobEngine) and report progress through
+    onProgress(job)/onFinished(job) on the GUI thread. PythonQt classes cannot declare Qt
+    signals, so listeners are set as callbacks instead: onStatuses(statuses) after every
+    status poll, onQueueChanged() and onOrderStarted(job) for the submission queue.
+    """
+
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        self.npcs = None
+        self.configPath = None
+        self.orderStore = None
+        self.reportCache = None
+        self.resultsTable = None
+
+        # Listeners, called on the GUI thread
+        self.onStatuses = None
+        self.onQueueChanged = None
+        self.onOrderStarted = None
+
+        self.statusFetcher = StatusFetcher(
+            maxWorkers=slicer.util.settingsValue("neuropacs/statusConcurrency", 8, converter=int),
+            timeout=slicer.util.settingsValue("neuropacs/statusTimeout", 30, converter=int))
+        self.statusPoller = StatusPoller(
+            self.statusFetcher,
+            getClient=lambda: self.npcs,
+            getOrderIds=self.activeOrderIds,
+            onStatuses=self._onPolledStatuses,
+            interval=slicer.util.settingsValue("neuropacs/statusPollInterval", 30, converter=int))
+        self.submissionQueue = SubmissionQueue(
+            None,
+            maxUploads=slicer.util.settingsValue("neuropacs/maxParallelUploads", 2, converter=int),
+            compressionLevel=slicer.util.settingsValue("neuropacs/compressionLevel", DEFAULT_COMPRESSION_LEVEL, converter=int),
+            onChanged=self._onQueueChanged,
+            onOrderStarted=self._onOrderStarted)
+        self.fingerprintEngine = JobEngine(maxWorkers=2)
+        self.reportEngine = JobEngine(maxWorkers=2)
+        self.versionCheckEngine = JobEngine()
+        self.connectEngine = JobEngine()
+        self.reportPrefetcher = ReportPrefetcher(
+            getClient=lambda: self.npcs,
+            getCache=lambda: self.reportCache,
+            formats=self.prefetchFormats(),
+            isBusy=lambda: bool(self.reportEngine.activeJobs()))
+        self.reportPrefetcher.setEnabled(slicer.util.settingsValue("neuropacs/prefetchReports", False, converter=slicer.util.toBool))
+        self.datasetIndex = DatasetIndex(slicer.dicomDatabase)
+
+    def shutdown(self):
+        """Stop the background work and close the order store"""
+        self.statusPoller.stop()
+        self.statusFetcher.shutdown()
+        self.submissionQueue.shutdown()
+        self.fingerprintEngine.shutdown()
+        self.reportEngine.shutdown()
+        self.versionCheckEngine.shutdown()
+        self.connectEngine.shutdown()
+        self.reportPrefetcher.shutdown()
+        self.datasetIndex.disconnectDatabase()
+        self.datasetIndex.timer.stop()
+        if self.orderStore is not None:
+            self.orderStore.close()
+            self.orderStore = None
+
+    # Settings
+
+    def prefetchFormats(self):
+        formats = slicer.util.settingsValue("neuropacs/prefetchFormats", ",".join(REPORT_FORMATS))
+        return [format for format in formats.split(",") if format in REPORT_FORMATS]
+
+    def reportCacheSize(self):
+        """Maximum size of the report cache in bytes"""
+        size = slicer.util.settingsValue("neuropacs/reportCacheSize", 500, converter=int) * 2**20
+        return max(size, MIN_REPORT_CACHE_SIZE)
+
+    def isOffline(self):
+        return slicer.util.settingsValue("neuropacs/offline", False, converter=slicer.util.toBool)
+
+    def wheelDirectory(self):
+        return slicer.util.settingsValue("neuropacs/wheelDirectory", "")
+
+    # Configuration
+
+    def configure(self, path):
+        """Open the order store, report cache and results table kept next to the config file"""
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            print(f"Created directory '{directory}'.")
+        if not os.access(directory, os.W_OK):
+            raise PermissionError(f"No write permission in the directory '{directory}'.")
+
+        # Orders are kept in an SQLite database next to the config file. The JSON order map
+        # of the config file (written by earlier versions) is imported once.
+        basePath = os.path.splitext(path)[0]
+        if self.orderStore is not None:
+            self.orderStore.close()
+        self.configPath = path
+        self.orderStore = OrderStore(basePath + ".db")
+        self.submissionQueue.setStore(self.orderStore)
+        self.datasetIndex.setStore(self.orderStore)
+        self.reportCache = ReportCache(basePath + ".reports", self.orderStore, self.reportCacheSize(), onAdded=self._onReportCached)
+        self.resultsTable = ResultsTable(self.orderStore)
+        self.resultsTable.addCachedReports(self.reportCache)
+        if not self.orderStore.isMigrated():
+            imported = self.orderStore.migrateFromJson(path, basePath + ".status.json", defaultOrders={"TEST": "TEST"})
+            print(f"Imported {imported} orders from '{path}'.")
+        print(f"Order store loaded from '{self.orderStore.path}'.")
+
+    def _onReportCached(self, orderId, format, path):
+        """Add the results of every downloaded JSON report to the results table (called from worker threads)"""
+        if format == "json":
+            self.resultsTable.addReportFile(orderId, path)
+
+    # neuropacs package
+
+    def setupPythonRequirements(self):
+        """Import neuropacs, it is installed first if needed"""
+        global neuropacs
+        if installedVersion("neuropacs") is None:
+            # Nothing works without it, the installation cannot be run in the background
+            self.installNeuropacs()
+        import neuropacs
+        return neuropacs
+
+    def installNeuropacs(self, version=None, fromWheels=None):
+        """Install neuropacs from PyPI, or from the local wheel directory if one is set"""
+        wheelDirectory = self.wheelDirectory()
+        if fromWheels is None:
+            fromWheels = bool(wheelDirectory) and (self.isOffline() or bool(wheelVersions(wheelDirectory, "neuropacs")))
+        if not fromWheels and self.isOffline():
+            raise RuntimeError("neuropacs is not installed. Set a local wheel directory to install it in offline mode.")
+        print(f"Installing neuropacs {version or ''}...")
+        slicer.util.pip_install(installArguments("neuropacs", version, wheelDirectory if fromWheels else None))
+
+    def checkNeuropacsVersion(self, onFinished=None, force=False):
+        """Look for a newer neuropacs version in the background, at most once per check interval.
+
+        Returns the future of the VersionCheckJob, or None if no check is due.
+        """
+        wheelDirectory = self.wheelDirectory()
+        if self.isOffline() and not wheelDirectory:
+            return None
+        lastCheck = slicer.util.settingsValue("neuropacs/versionCheckTime", 0, converter=float)
+        interval = slicer.util.settingsValue("neuropacs/versionCheckInterval", 24, converter=int) * 3600
+        if not force and time.time() - lastCheck < interval:
+            logging.debug(f"Latest neuropacs version checked recently: {slicer.util.settingsValue('neuropacs/latestVersion', '')}")
+            return None
+        job = VersionCheckJob("neuropacs", timeout=5, offline=self.isOffline(), wheelDirectory=wheelDirectory)
+        return self.versionCheckEngine.submit(job, onFinished=lambda job: self._onNeuropacsVersionChecked(job, onFinished))
+
+    def _onNeuropacsVersionChecked(self, job, onFinished):
+        # Failed checks are not retried before the next interval either (e.g. without network)
+        qt.QSettings().setValue("neuropacs/versionCheckTime", time.time())
+        if job.error is None:
+            qt.QSettings().setValue("neuropacs/latestVersion", job.latestVersion or "")
+        if onFinished:
+            onFinished(job)
+
+    # Connection
+
+    def createClient(self, apiKey):
+        """A new neuropacs client, not connected yet"""
+        return neuropacs.init(NEUROPACS_SERVER_URL, apiKey, "Slicer")
+
+    def connect(self, apiKey):
+        """Connect a new client with an API key"""
+        npcs = self.createClient(apiKey)
+        npcs.connect()
+        self.setClient(npcs)
+        self.saveSession(apiKey)
+
+    def setClient(self, npcs):
+        self.npcs = npcs
+        self.submissionQueue.setClient(npcs)
+
+    def rememberSession(self):
+        return slicer.util.settingsValue("neuropacs/rememberSession", False, converter=slicer.util.toBool)
+
+    def credentialStore(self):
+        return CredentialStore(os.path.splitext(self.configPath or self.defaultConfigPath())[0] + ".credentials")
+
+    def saveSession(self, apiKey):
+        """Store the API key and the session of the connected client, if the user opted in"""
+        if not self.rememberSession() or not apiKey or self.npcs is None:
+            return
+        try:
+            self.credentialStore().save(apiKey, getattr(self.npcs, "connection_id", None), getattr(self.npcs, "aes_key", None))
+        except Exception as e:
+            logging.warning(f"Failed to store the neuropacs credentials: {str(e)}")
+
+    def restoreSession(self, onFinished=None):
+        """Connect in the background with the stored credentials, if the user opted in.
+
+        Returns the future of the ConnectJob, or None if there is nothing to restore. The
+        client is set before onFinished(job) is called.
+        """
+        if not self.rememberSession() or self.npcs is not None:
+            return None
+        credentials = self.credentialStore().load()
+        if credentials is None:
+            return None
+        # The TEST order always exists, checking its status is the cheapest authenticated request
+        job = ConnectJob(self.createClient, credentials, validate=lambda npcs: npcs.check_status("TEST"))
+        return self.connectEngine.submit(job, onFinished=lambda job: self._onSessionRestored(job, onFinished))
+
+    def _onSessionRestored(self, job, onFinished):
+        if job.error is None and self.npcs is None:
+            self.setClient(job.npcs)
+            if not job.reused:
+                self.saveSession(job.credentials["api_key"])
+        if onFinished:
+            onFinished(job)
+
+    @staticmethod
+    def defaultConfigPath():
+        path = slicer.util.settingsValue("neuropacs/configPath", None)
+        if path is None:
+            path = os.path.join(qt.QStandardPaths.writableLocation(qt.QStandardPaths.DocumentsLocation), "slicer_neuropacs.config")
+            qt.QSettings().setValue("neuropacs/configPath", path)
+        return path
+
+    # Orders
+
+    def orders(self):
+        return self.orderStore.orders() if self.orderStore is not None else []
+
+    def activeOrderIds(self):
+        """Orders that have not reached a terminal state yet"""
+        return self.orderStore.activeOrderIds() if self.orderStore is not None else []
+
+    def completedOrders(self):
+        """Completed orders as a list of (order ID, patient)"""
+        return [(order["order_id"], order["patient"]) for order in self.orders() if order["last_status"] == STATE_COMPLETE]
+
+    def restoreOrder(self, orderId, patient):
+        """Add an order to the store unless it is there, returns its terminal status or None"""
+        if orderId not in self.orderStore:
+            self.orderStore.addOrder(orderId, patient, product=NEUROPACS_PRODUCT)
+        return self.orderStore.terminalStatus(orderId)
+
+    def deleteOrders(self, orderIds):
+        """Delete orders and their cached reports"""
+        if not orderIds:
+            return
+        self.orderStore.deleteOrders(orderIds)
+        if self.reportCache is not None:
+            self.reportCache.removeOrders(orderIds)
+
+    def fetchStatuses(self, orderIds):
+        """Fetch and record the status of orders, blocks until done, returns {orderId: (status, error)}"""
+        statuses = self.statusFetcher.fetch(self.npcs, orderIds)
+        self.recordStatuses(statuses)
+        return statuses
+
+    def recordStatuses(self, statuses):
+        """Store the last status of fetched orders, orders in a terminal state are never fetched again"""
+        records = []
+        completed = []
+        for order, (status, error) in statuses.items():
+            # Expired orders are deleted, failed requests are retried on the next check
+            if error is not None:
+                continue
+            state = terminalState(status) or STATE_RUNNING
+            info, progress = statusTexts(order, status, error)
+            records.append((order, state, info, progress))
+            if state == STATE_COMPLETE:
+                completed.append(order)
+        if records:
+            self.orderStore.recordStatuses(records)
+        # Only non-terminal orders are fetched, so these orders have just completed
+        self.reportPrefetcher.enqueue(completed)
+
+    def _onPolledStatuses(self, statuses):
+        self.recordStatuses(statuses)
+        self.deleteOrders([order for order, (status, error) in statuses.items() if isExpired(error)])
+        if self.onStatuses:
+            self.onStatuses(statuses)
+
+    # Datasets and submissions
+
+    def refreshDatasets(self, force=False):
+        """Follow the DICOM database and update the dataset index in the background"""
+        self.datasetIndex.connectDatabase()
+        self.datasetIndex.refresh(force=force)
+
+    def fingerprintDataset(self, patient, studyUid, onFinished=None):
+        """Fingerprint the dataset of a study in the background, returns the future of the FingerprintJob"""
+        # Only the diffusion series of the study are uploaded
+        files = self.datasetIndex.datasetFiles(studyUid)
+        dataset = self.datasetIndex.dataset(studyUid)
+        if not files or dataset is None:
+            raise ValueError(f"No files of the dataset of {patient} found in the DICOM database.")
+        datasetPath = dataset["dataset_path"]
+        return self.fingerprintEngine.submit(FingerprintJob(patient, datasetPath, files), onFinished=onFinished)
+
+    def earlierOrders(self, fingerprint):
+        """Orders of datasets with the same fingerprint, newest first"""
+        if fingerprint is None or self.orderStore is None:
+            return []
+        return self.orderStore.ordersForFingerprint(fingerprint)
+
+    def enqueue(self, patient, datasetPath, fingerprint=None, files=None):
+        """Queue a dataset for submission, returns the SubmissionJob"""
+        return self.submissionQueue.enqueue(patient, datasetPath, NEUROPACS_PRODUCT, fingerprint=fingerprint, files=files)
+
+    def resumeSubmissions(self):
+        """Resume submissions interrupted by the end of the previous session, returns the number of queued submissions"""
+        resumed = self.submissionQueue.resume()
+        if resumed:
+            logging.info(f"Resumed {resumed} queued neuropacs submissions")
+        return resumed
+
+    def _onQueueChanged(self):
+        if self.onQueueChanged:
+            self.onQueueChanged()
+
+    def _onOrderStarted(self, job):
+        if self.onOrderStarted:
+            self.onOrderStarted(job)
+
+    # Reports
+
+    def downloadReport(self, orderId, format, path=None, onProgress=None, onFinished=None):
+        """Download a report in the background (into the report cache only if path is None).
+
+        Returns the future of the ReportDownloadJob.
+        """
+        job = ReportDownloadJob(self.npcs, orderId, format, path, cache=self.reportCache)
+        return self.reportEngine.submit(job, onProgress=onProgress, onFinished=onFinished)
+
+    def exportReports(self, orders, formats, destination, maxWorkers=4, onProgress=None, onFinished=None):
+        """Export the reports of orders (list of (order ID, patient)) in the background.
+
+        Returns the future of the BulkExportJob.
+        """
+        job = BulkExportJob(self.npcs, self.reportCache, orders, formats, destination, maxWorkers=maxWorkers)
+        return self.reportEngine.submit(job, onProgress=onProgress, onFinished=onFinished)
 
 
 #
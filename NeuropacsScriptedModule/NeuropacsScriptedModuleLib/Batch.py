@@ -0,0 +1,462 @@
+import argparse
+import csv
+import datetime
+import json
+import logging
+import os
+import sys
+
+import qt
+
+from .Fingerprint import FingerprintJob
+from .Jobs import STAGE_DONE, STAGE_UPLOADING
+from .OrderStatus import STATE_COMPLETE, STATE_EXPIRED, STATE_FAILED, terminalState
+from .Reports import REPORT_FORMATS
+
+# Exit codes of the batch script
+EXIT_OK = 0
+EXIT_FAILED = 1  # some datasets or reports failed
+EXIT_TIMEOUT = 2  # orders were still running when the run timed out
+EXIT_ERROR = 3  # the run could not start
+
+# Hours a run waits for its orders unless --timeout is given
+DEFAULT_TIMEOUT_HOURS = 48
+# Consecutive failed status checks after which an order is given up
+MAX_STATUS_FAILURES = 10
+
+# Environment variable read if no API key is given
+API_KEY_VARIABLE = "NEUROPACS_API_KEY"
+
+# Accepted names of the study UID column of a study list
+STUDY_UID_COLUMNS = ("study_uid", "studyinstanceuid", "study instance uid")
+
+
+class ProgressLog:
+    """Machine-readable progress of a batch run, one JSON object per line.
+
+    Every record has the time (ISO 8601, UTC) and the event name. Records are appended to the
+    file at path, "-" writes them to stdout.
+    """
+
+    def __init__(self, path="-"):
+        self.path = path
+        self._file = sys.stdout if path == "-" else open(path, "a", encoding="utf-8")
+
+    def write(self, event, **fields):
+        record = {"time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"), "event": event}
+        record.update(fields)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+def readStudyList(path):
+    """Studies of a CSV file as a list of (patient or None, study UID).
+
+    UIDs are read from a study_uid (or StudyInstanceUID) column, or from the first column of
+    a file without header. An optional patient column names the studies.
+    """
+    with open(path, "r", newline="", encoding="utf-8-sig") as csvFile:
+        rows = [row for row in csv.reader(csvFile) if any(cell.strip() for cell in row)]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    uidColumn = next((header.index(name) for name in STUDY_UID_COLUMNS if name in header), None)
+    if uidColumn is None:
+        return [(None, row[0].strip()) for row in rows]
+    patientColumn = header.index("patient") if "patient" in header else None
+    studies = []
+    for row in rows[1:]:
+        studyUid = row[uidColumn].strip() if uidColumn < len(row) else ""
+        if not studyUid:
+            continue
+        patient = row[patientColumn].strip() if patientColumn is not None and patientColumn < len(row) else ""
+        studies.append((patient or None, studyUid))
+    return studies
+
+
+def directoryDatasets(path):
+    """Dataset folders of a directory as a list of (name, path).
+
+    Every subdirectory is a dataset, unless the directory holds files itself: then it is
+    the only dataset.
+    """
+    path = os.path.abspath(path)
+    entries = sorted(os.listdir(path))
+    if any(os.path.isfile(os.path.join(path, entry)) for entry in entries):
+        return [(os.path.basename(path), path)]
+    return [(entry, os.path.join(path, entry)) for entry in entries if os.path.isdir(os.path.join(path, entry))]
+
+
+def indexDatasets(datasetIndex):
+    """Bring the dataset index up to date with the DICOM database, processing events until done"""
+    datasetIndex.refresh()
+    while datasetIndex.isBuilding():
+        qt.QCoreApplication.processEvents(qt.QEventLoop.AllEvents, 100)
+
+
+class BatchDataset:
+    """A dataset of a batch run and the order it is analyzed in"""
+
+    def __init__(self, patient, datasetPath, files=None, studyUid=None):
+        self.patient = patient
+        self.datasetPath = datasetPath
+        self.files = files
+        self.studyUid = studyUid
+        self.fingerprint = None
+        self.job = None  # SubmissionJob while the dataset is queued or uploaded
+        self.orderId = None
+        self.state = None  # terminal state (see OrderStatus) once the dataset is done
+        self.error = None
+        self.lastStage = None
+        self.lastUploadStep = None
+        self.lastStatus = None
+        self.statusFailures = 0  # consecutive failed status checks
+
+    def fields(self):
+        """Fields identifying the dataset in the progress log"""
+        fields = {"patient": self.patient, "dataset": self.datasetPath}
+        if self.studyUid:
+            fields["study_uid"] = self.studyUid
+        if self.orderId:
+            fields["order_id"] = self.orderId
+        return fields
+
+
+class BatchRun:
+    """Submit datasets, wait for their orders and export their reports, without the module widget.
+
+    logic is a NeuropacsScriptedModuleLogic with a configured order store and a connected
+    client. The run processes events in a local event loop, so that the submission queue,
+    the job engines and the status poller of the logic work as in the module. Orders are
+    kept in the order store of the logic and are shown in the module afterwards.
+
+    Datasets submitted before (same fingerprint) reuse their order unless resubmit is set,
+    datasets of this run still queued from an interrupted run are resumed, other queued
+    submissions are left in the order store. An order whose status could not
+    be checked maxStatusFailures times in a row is failed. Once every order has finished (or
+    after timeout seconds, None waits without limit), the reports of the completed orders are
+    exported to destination (a directory or a zip file, see BulkExportJob).
+
+    Progress log events: start, fingerprinted, queued, resumed, reused, stage, upload, started,
+    status, finished, failed, skipped, timeout, export, exported and done.
+    """
+
+    # Upload progress is logged in steps of this many percent
+    uploadLogStep = 10
+
+    def __init__(self, logic, datasets, log, destination=None, formats=REPORT_FORMATS, resubmit=False, exportWorkers=4,
+                 timeout=DEFAULT_TIMEOUT_HOURS * 3600, maxStatusFailures=MAX_STATUS_FAILURES):
+        self.logic = logic
+        self.datasets = list(datasets)
+        self.log = log
+        self.destination = destination
+        self.formats = list(formats)
+        self.resubmit = resubmit
+        self.exportWorkers = exportWorkers
+        self.timeout = timeout
+        self.maxStatusFailures = maxStatusFailures
+        self.timedOut = False
+        self.exportJob = None
+        self._loop = None
+
+    def run(self):
+        """Process the datasets, returns the exit code"""
+        logic = self.logic
+        listeners = (logic.onQueueChanged, logic.onOrderStarted, logic.onStatuses)
+        logic.onQueueChanged = self._onQueueChanged
+        logic.onOrderStarted = self._onOrderStarted
+        logic.onStatuses = self._onStatuses
+        self._loop = qt.QEventLoop()
+        deadline = qt.QTimer()
+        deadline.setSingleShot(True)
+        deadline.timeout.connect(self._onTimeout)
+        try:
+            pending = [dataset for dataset in self.datasets if dataset.state is None]
+            self.log.write("start", datasets=len(self.datasets), max_uploads=logic.submissionQueue.maxUploads,
+                           formats=self.formats, destination=self.destination)
+            for dataset in self.datasets:
+                if dataset.state is not None:
+                    self.log.write("skipped", error=dataset.error, **dataset.fields())
+            if pending:
+                for dataset in pending:
+                    logic.fingerprintEngine.submit(FingerprintJob(dataset.patient, dataset.datasetPath, dataset.files),
+                                                   onFinished=lambda job, dataset=dataset: self._onFingerprinted(dataset, job))
+                logic.statusPoller.start()
+                if self.timeout:
+                    deadline.start(int(self.timeout * 1000))
+                self._loop.exec_()
+        finally:
+            deadline.stop()
+            logic.statusPoller.stop()
+            logic.onQueueChanged, logic.onOrderStarted, logic.onStatuses = listeners
+        self._export()
+        return self._summarize()
+
+    def isDone(self):
+        return all(dataset.state is not None for dataset in self.datasets)
+
+    def _checkDone(self):
+        if self.isDone():
+            self._loop.quit()
+
+    def _onTimeout(self):
+        self.timedOut = True
+        running = [dataset.orderId or dataset.datasetPath for dataset in self.datasets if dataset.state is None]
+        self.log.write("timeout", running=running)
+        self._loop.quit()
+
+    # Submission
+
+    def _earlierOrder(self, fingerprint):
+        """Order of an earlier submission of the same dataset that has not expired, or None"""
+        for earlierOrder in self.logic.earlierOrders(fingerprint):
+            order = self.logic.orderStore.order(earlierOrder["order_id"])
+            if order is None or order["last_status"] != STATE_EXPIRED:
+                return earlierOrder["order_id"]
+        return None
+
+    def _onFingerprinted(self, dataset, job):
+        if self.timedOut:
+            # Not submitted anymore, reports are being exported
+            return
+        dataset.fingerprint = job.fingerprint
+        if job.fingerprint is not None:
+            self.log.write("fingerprinted", fingerprint=job.fingerprint, **dataset.fields())
+            # Only the unfinished submissions of this run's datasets are resumed, others stay in the store
+            self.logic.submissionQueue.resume(fingerprints={job.fingerprint})
+            queued = next((queuedJob for queuedJob in self.logic.submissionQueue.jobs() if queuedJob.fingerprint == job.fingerprint), None)
+            if queued is not None:
+                dataset.job = queued
+                self.log.write("resumed", **dataset.fields())
+                return
+            orderId = self._earlierOrder(job.fingerprint)
+            if orderId is not None and not self.resubmit:
+                dataset.orderId = orderId
+                status = self.logic.restoreOrder(orderId, dataset.patient)
+                self.log.write("reused", **dataset.fields())
+                if status is not None:
+                    self._setFinished(dataset, status["state"], info=status["info"])
+                else:
+                    self.logic.statusPoller.poll()
+                return
+        # Checking is best effort, the dataset is submitted anyway
+        dataset.job = self.logic.enqueue(dataset.patient, dataset.datasetPath, fingerprint=job.fingerprint, files=dataset.files)
+        self.log.write("queued", **dataset.fields())
+
+    def _onQueueChanged(self):
+        for dataset in self.datasets:
+            job = dataset.job
+            if job is None:
+                continue
+            if job.stage != dataset.lastStage:
+                dataset.lastStage = job.stage
+                self.log.write("stage", stage=job.stage, **dataset.fields())
+            if job.stage == STAGE_UPLOADING:
+                step = job.progressPercent() // self.uploadLogStep * self.uploadLogStep
+                if step != dataset.lastUploadStep:
+                    dataset.lastUploadStep = step
+                    self.log.write("upload", percent=step, files_done=job.filesDone, files_total=job.filesTotal,
+                                   bytes_done=job.bytesDone, bytes_total=job.bytesTotal, **dataset.fields())
+            if job.isFinished() and job.stage != STAGE_DONE:
+                dataset.job = None
+                dataset.orderId = job.orderId
+                self._setFinished(dataset, STATE_FAILED, error=job.error or job.stage)
+
+    def _onOrderStarted(self, job):
+        for dataset in self.datasets:
+            if dataset.job is job:
+                dataset.job = None
+                dataset.orderId = job.orderId
+                self.log.write("started", **dataset.fields())
+        # Started orders are picked up by the next poll
+        self.logic.statusPoller.poll()
+
+    # Orders
+
+    def _onStatuses(self, statuses):
+        """Log the progress of polled orders, the statuses are recorded by the logic already"""
+        for dataset in self.datasets:
+            if dataset.state is not None or dataset.orderId not in statuses:
+                continue
+            status, error = statuses[dataset.orderId]
+            state = terminalState(status, error)
+            if error is not None:
+                if state is None:
+                    dataset.statusFailures += 1
+                    if dataset.statusFailures >= self.maxStatusFailures:
+                        self._setFinished(dataset, STATE_FAILED,
+                                          error=f"Status unavailable after {dataset.statusFailures} attempts: {str(error)}")
+                        continue
+                    # Retried on the next poll
+                    self.log.write("status", error=str(error), failures=dataset.statusFailures, **dataset.fields())
+                    continue
+                self._setFinished(dataset, state, error=str(error))
+                continue
+            dataset.statusFailures = 0
+            current = (status.get("info"), str(status.get("progress")))
+            if current != dataset.lastStatus:
+                dataset.lastStatus = current
+                self.log.write("status", info=current[0], progress=current[1], **dataset.fields())
+            if state is not None:
+                self._setFinished(dataset, state, info=status.get("info"))
+
+    def _setFinished(self, dataset, state, info=None, error=None):
+        dataset.state = state
+        dataset.error = error
+        if state == STATE_COMPLETE:
+            self.log.write("finished", state=state, info=info, **dataset.fields())
+        else:
+            self.log.write("failed", state=state, error=error or info, **dataset.fields())
+        self._checkDone()
+
+    # Reports
+
+    def _export(self):
+        """Export the reports of the completed orders, blocks until done"""
+        orders = []
+        for dataset in self.datasets:
+            if dataset.state == STATE_COMPLETE and (dataset.orderId, dataset.patient) not in orders:
+                orders.append((dataset.orderId, dataset.patient))
+        if not self.destination or not orders:
+            return
+        lastFilesDone = [None]
+
+        def onProgress(job):
+            if job.filesDone != lastFilesDone[0]:
+                lastFilesDone[0] = job.filesDone
+                self.log.write("export", files_done=job.filesDone, files_total=job.filesTotal, failed=len(job.failed))
+
+        self._loop = qt.QEventLoop()
+        future = self.logic.exportReports(orders, self.formats, self.destination, maxWorkers=self.exportWorkers,
+                                          onProgress=onProgress, onFinished=lambda job: self._loop.quit())
+        self._loop.exec_()
+        self.exportJob = future.job
+        self.log.write("exported", destination=self.destination, files_done=self.exportJob.filesDone,
+                       files_skipped=self.exportJob.filesSkipped, error=self.exportJob.error,
+                       failed=[{"order_id": orderId, "format": format, "error": error} for orderId, format, error in self.exportJob.failed])
+
+    def _summarize(self):
+        """Log the outcome of the run, returns the exit code"""
+        states = {}
+        for dataset in self.datasets:
+            state = dataset.state or "running"
+            states[state] = states.get(state, 0) + 1
+        exportFailed = self.exportJob is not None and (self.exportJob.error is not None or bool(self.exportJob.failed))
+        if self.timedOut:
+            exitCode = EXIT_TIMEOUT
+        elif exportFailed or any(dataset.state != STATE_COMPLETE for dataset in self.datasets):
+            exitCode = EXIT_FAILED
+        else:
+            exitCode = EXIT_OK
+        self.log.write("done", states=states, exit_code=exitCode)
+        return exitCode
+
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="NeuropacsBatch",
+        description="Submit studies to neuropacs, wait for the orders and export their reports. "
+                    "Run with: Slicer --no-main-window --python-script NeuropacsBatch.py [options]")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--directory", help="Directory of dataset folders (one per subdirectory) to submit.")
+    source.add_argument("--dicom-database", nargs="?", const="", metavar="DIRECTORY",
+                        help="Submit all studies of a DICOM database (default: the database of Slicer).")
+    source.add_argument("--studies", metavar="CSV",
+                        help="CSV file of the study UIDs to submit from the DICOM database (study_uid column, optional patient column).")
+    parser.add_argument("--database", metavar="DIRECTORY", help="DICOM database of the studies of --studies (default: the database of Slicer).")
+    parser.add_argument("--output", help="Directory or .zip file the reports of completed orders are exported to.")
+    parser.add_argument("--formats", default=",".join(REPORT_FORMATS),
+                        help=f"Comma separated report formats to export (default: {','.join(REPORT_FORMATS)}).")
+    parser.add_argument("--api-key", help=f"neuropacs API key (default: the {API_KEY_VARIABLE} environment variable or the remembered API key).")
+    parser.add_argument("--config", help="Config file of the order store (default: the one of the module).")
+    parser.add_argument("--max-uploads", type=int, help="Maximum number of datasets uploaded at the same time (default: module setting).")
+    parser.add_argument("--poll-interval", type=int, default=60, help="Seconds between order status checks (default: 60).")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_HOURS,
+                        help="Hours after which the run stops waiting for orders and exports the completed ones "
+                             f"(default: {DEFAULT_TIMEOUT_HOURS}, 0 waits without limit).")
+    parser.add_argument("--max-status-failures", type=int, default=MAX_STATUS_FAILURES,
+                        help=f"Consecutive failed status checks after which an order is failed (default: {MAX_STATUS_FAILURES}).")
+    parser.add_argument("--export-workers", type=int, default=4, help="Reports downloaded in parallel (default: 4).")
+    parser.add_argument("--resubmit", action="store_true", help="Submit datasets again even if they were submitted before.")
+    parser.add_argument("--log", default="-", help="JSON lines progress log, appended to (default: stdout).")
+    args = parser.parse_args(argv)
+    args.formats = [format.strip().lower() for format in args.formats.split(",") if format.strip()]
+    unknownFormats = [format for format in args.formats if format not in REPORT_FORMATS]
+    if unknownFormats:
+        parser.error(f"unknown report formats: {', '.join(unknownFormats)}")
+    return args
+
+
+def collectDatasets(args, datasetIndex, dicomDatabase):
+    """Datasets selected by the command line arguments, studies missing from the DICOM database are failed"""
+    if args.directory:
+        return [BatchDataset(name, path) for name, path in directoryDatasets(args.directory)]
+
+    if dicomDatabase is None or not dicomDatabase.isOpen:
+        raise RuntimeError("No DICOM database is open.")
+    indexDatasets(datasetIndex)
+    if args.studies:
+        studies = readStudyList(args.studies)
+    else:
+        studies = [(None, studyUid) for _, studyUid in datasetIndex.datasets()]
+    datasets = []
+    for patient, studyUid in studies:
+        row = datasetIndex.dataset(studyUid)
+        if row is None:
+            dataset = BatchDataset(patient, None, studyUid=studyUid)
+            dataset.state = STATE_FAILED
+            dataset.error = "Study not found in the DICOM database."
+        else:
+            dataset = BatchDataset(patient or row["patient_name"], row["dataset_path"], datasetIndex.datasetFiles(studyUid), studyUid)
+        datasets.append(dataset)
+    return datasets
+
+
+def main(argv=None):
+    """Entry point of the batch script (see parseArguments), returns the exit code"""
+    import slicer
+    from NeuropacsScriptedModule import NeuropacsScriptedModuleLogic
+
+    try:
+        args = parseArguments(argv)
+    except SystemExit as e:
+        # --help and argument errors
+        return e.code
+
+    log = ProgressLog(args.log)
+    logic = NeuropacsScriptedModuleLogic()
+    try:
+        logic.configure(args.config or logic.defaultConfigPath())
+        logic.setupPythonRequirements()
+        apiKey = args.api_key or os.environ.get(API_KEY_VARIABLE)
+        if not apiKey:
+            credentials = logic.credentialStore().load() if logic.rememberSession() else None
+            apiKey = credentials["api_key"] if credentials else None
+        if not apiKey:
+            raise RuntimeError(f"No API key given, use --api-key or set {API_KEY_VARIABLE}.")
+        logic.connect(apiKey)
+        if args.max_uploads:
+            logic.submissionQueue.setMaxUploads(args.max_uploads)
+        logic.statusPoller.setInterval(args.poll_interval)
+
+        databaseDirectory = args.dicom_database or args.database
+        if databaseDirectory:
+            from DICOMLib import DICOMUtils
+            DICOMUtils.openDatabase(databaseDirectory)
+        datasets = collectDatasets(args, logic.datasetIndex, slicer.dicomDatabase)
+
+        run = BatchRun(logic, datasets, log, destination=args.output, formats=args.formats, resubmit=args.resubmit,
+                       exportWorkers=args.export_workers, timeout=args.timeout * 3600 if args.timeout else None,
+                       maxStatusFailures=max(1, args.max_status_failures))
+        return run.run()
+    except Exception as e:
+        logging.error(f"neuropacs batch run failed: {str(e)}")
+        log.write("error", error=str(e))
+        return EXIT_ERROR
+    finally:
+        logic.shutdown()
+        log.close()
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import time
+
+# Service name of the entries in the OS keyring
+KEYRING_SERVICE = "SlicerNeuropacs"
+
+# Stored sessions are reused for this long before connecting again, in seconds
+SESSION_LIFETIME = 12 * 3600
+
+
+def _keyring():
+    """The keyring module if it is installed and has a usable backend, else None"""
+    try:
+        import keyring
+        import keyring.backends.fail
+    except ImportError:
+        return None
+    if isinstance(keyring.get_keyring(), keyring.backends.fail.Keyring):
+        return None
+    return keyring
+
+
+def _fernet():
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        return None
+    return Fernet
+
+
+def _writePrivate(path, data):
+    """Write a file readable by the current user only"""
+    partialPath = path + ".part"
+    fd = os.open(partialPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as privateFile:
+        privateFile.write(data)
+    os.replace(partialPath, path)
+
+
+class CredentialStore:
+    """Encrypted store of the API key and the last session (connection ID and AES key).
+
+    The OS keyring is used when the keyring package has a usable backend. Otherwise the data is
+    encrypted with Fernet (cryptography package) in a file only readable by the user, its key is
+    kept in a second such file. As the key is stored next to the data, the file backend only
+    protects the data through the file permissions: anyone who can read the user's files can
+    decrypt it. path identifies the store (keyring entry) and is the base name of these files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def backend(self):
+        """Name of the storage used, None if neither keyring nor cryptography is available"""
+        if _keyring() is not None:
+            return "keyring"
+        if _fernet() is not None:
+            return "file"
+        return None
+
+    def isAvailable(self):
+        return self.backend() is not None
+
+    def load(self):
+        """Stored credentials as a dict (api_key, connection_id, aes_key, connected), None if nothing is stored"""
+        try:
+            keyring = _keyring()
+            if keyring is not None:
+                data = keyring.get_password(KEYRING_SERVICE, self.path)
+                return json.loads(data) if data else None
+            Fernet = _fernet()
+            if Fernet is None or not os.path.isfile(self.path):
+                return None
+            with open(self.path + ".key", "rb") as keyFile, open(self.path, "rb") as dataFile:
+                return json.loads(Fernet(keyFile.read()).decrypt(dataFile.read()))
+        except Exception as e:
+            logging.warning(f"Failed to load the stored neuropacs credentials: {str(e)}")
+            return None
+
+    def save(self, apiKey, connectionId=None, aesKey=None):
+        """Store the API key and its session, a session without connection ID is not reused"""
+        data = json.dumps({"api_key": apiKey, "connection_id": connectionId, "aes_key": aesKey, "connected": time.time()})
+        keyring = _keyring()
+        if keyring is not None:
+            keyring.set_password(KEYRING_SERVICE, self.path, data)
+            return
+        Fernet = _fernet()
+        if Fernet is None:
+            raise RuntimeError("Storing credentials requires the keyring or the cryptography Python package.")
+        keyPath = self.path + ".key"
+        if not os.path.isfile(keyPath):
+            _writePrivate(keyPath, Fernet.generate_key())
+        with open(keyPath, "rb") as keyFile:
+            _writePrivate(self.path, Fernet(keyFile.read()).encrypt(data.encode("utf-8")))
+
+    def clear(self):
+        keyring = _keyring()
+        if keyring is not None:
+            try:
+                keyring.delete_password(KEYRING_SERVICE, self.path)
+            except Exception:
+                pass  # Nothing stored
+        for path in (self.path, self.path + ".key"):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def sessionIsValid(credentials, lifetime=SESSION_LIFETIME):
+    """Whether the stored session of credentials can be reused"""
+    return (bool(credentials.get("connection_id")) and bool(credentials.get("aes_key"))
+            and time.time() - credentials.get("connected", 0) < lifetime)
+
+
+class ConnectJob:
+    """Create a neuropacs client with stored credentials (see JobEngine).
+
+    The stored session is reused while it is valid, otherwise the client connects again.
+    createClient(apiKey) returns a new, not connected client. validate(npcs) makes a cheap
+    request with a reused session, the client connects again if it fails (session expired or
+    revoked on the server), reused is then False.
+    """
+
+    def __init__(self, createClient, credentials, lifetime=SESSION_LIFETIME, validate=None):
+        self.createClient = createClient
+        self.credentials = credentials
+        self.lifetime = lifetime
+        self.validate = validate
+        self.npcs = None
+        self.reused = False
+        self.error = None
+
+    def cancel(self):
+        # connect() cannot be interrupted, the result is ignored by the caller
+        pass
+
+    def run(self):
+        try:
+            npcs = self.createClient(self.credentials["api_key"])
+            if sessionIsValid(self.credentials, self.lifetime):
+                npcs.connection_id = self.credentials["connection_id"]
+                npcs.aes_key = self.credentials["aes_key"]
+                self.reused = self._validate(npcs)
+            if not self.reused:
+                npcs.connect()
+            self.npcs = npcs
+        except Exception as e:
+            self.error = str(e)
+            logging.warning(f"Failed to connect with the stored neuropacs credentials: {str(e)}")
+        return self
+
+    def _validate(self, npcs):
+        if self.validate is None:
+            return True
+        try:
+            self.validate(npcs)
+            return True
+        except Exception as e:
+            logging.info(f"Stored neuropacs session cannot be used, connecting again: {str(e)}")
+            return False
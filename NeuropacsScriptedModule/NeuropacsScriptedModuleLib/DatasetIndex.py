@@ -0,0 +1,326 @@
+import collections
+import logging
+import os
+import re
+import time
+
+import qt
+
+# Tags used to find the diffusion series of a study, added to the tag cache of the DICOM database
+TAG_MODALITY = "0008,0060"
+TAG_IMAGE_TYPE = "0008,0008"
+TAG_SERIES_DESCRIPTION = "0008,103E"
+TAG_DIFFUSION_DIRECTIONALITY = "0018,9075"
+TAG_DIFFUSION_B_VALUE = "0018,9087"
+# Vendor specific b-value tags of classic (not enhanced) MR images: Siemens, GE, Philips
+VENDOR_B_VALUE_TAGS = ("0019,100C", "0043,1039", "2001,1003")
+SERIES_TAGS = (TAG_MODALITY, TAG_IMAGE_TYPE, TAG_SERIES_DESCRIPTION, TAG_DIFFUSION_DIRECTIONALITY,
+               TAG_DIFFUSION_B_VALUE) + VENDOR_B_VALUE_TAGS
+
+_DIFFUSION_DESCRIPTION = re.compile(r"dwi|dti|diff|\bdw\b|\btrace\b", re.IGNORECASE)
+# Parameter maps computed from the diffusion images
+_DERIVED_MAP_TYPES = {"ADC", "EADC", "FA"}
+
+
+def seriesKey(seriesUids):
+    """Series of a study as stored in the index, to notice when they change"""
+    return " ".join(sorted(seriesUids))
+
+
+def isDiffusionSeries(tagValues):
+    """Whether a series holds diffusion weighted MR images, tagValues maps tags of one of its files to values"""
+    if tagValues.get(TAG_MODALITY, "").strip().upper() != "MR":
+        return False
+    imageType = {value.strip().upper() for value in tagValues.get(TAG_IMAGE_TYPE, "").split("\\")}
+    if imageType & _DERIVED_MAP_TYPES:
+        return False
+    if any(tagValues.get(tag, "").strip() for tag in (TAG_DIFFUSION_B_VALUE, TAG_DIFFUSION_DIRECTIONALITY) + VENDOR_B_VALUE_TAGS):
+        return True
+    return bool(_DIFFUSION_DESCRIPTION.search(tagValues.get(TAG_SERIES_DESCRIPTION, "")))
+
+
+class DatasetIndex:
+    """Index of the datasets (one per study) in the Slicer DICOM database.
+
+    The dataset of a study is the list of files of its diffusion series (see isDiffusionSeries),
+    or of all its series if none of them looks like a diffusion series.
+
+    The index is kept in the order store so that it is available instantly. It is reconciled
+    with the DICOM database in short time slices on the GUI thread (the DICOM database must not
+    be used from other threads): every patient's studies are listed and only studies missing
+    from the index, or whose series changed since they were indexed, are looked up. Afterwards
+    the index follows the change notifications of the DICOM database: a study is classified again
+    whenever series are added to it, so a study indexed in the middle of its import is completed.
+    A full pass only runs again when the number of patients or studies dropped (something was
+    removed), series removed from a remaining study are found by the next forced refresh.
+
+    onChanged() is called when datasets were added or removed, onFinished() at the end of a pass.
+    """
+
+    # Time spent indexing per timer tick, in seconds
+    timeSlice = 0.02
+    # Minimum time between onChanged calls while the index is built, in seconds
+    notifyInterval = 1.0
+
+    def __init__(self, dicomDatabase, store=None, onChanged=None, onFinished=None):
+        self.dicomDatabase = dicomDatabase
+        self.store = None
+        self.onChanged = onChanged
+        self.onFinished = onFinished
+        self._datasets = {}
+        self._pendingPatients = collections.deque()
+        self._pendingStudies = collections.deque()
+        self._seenStudies = None
+        self._added = []
+        self._removed = []
+        self._changed = False
+        self._lastNotified = 0.0
+        self._connected = False
+
+        self.timer = qt.QTimer()
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self._processSlice)
+
+        # Imports emit a burst of notifications, they are handled once the burst is over
+        self._updateTimer = qt.QTimer()
+        self._updateTimer.setSingleShot(True)
+        self._updateTimer.setInterval(500)
+        self._updateTimer.timeout.connect(self._onUpdateTimeout)
+        self._fullUpdateRequested = False
+        self._changedStudies = set()
+        self._databaseCounts = None  # (patients, studies) when last checked
+        self._studiesAdded = 0  # studyAdded notifications since then
+
+        self.setStore(store)
+
+    def setStore(self, store):
+        """Load the index kept in the store"""
+        self.store = store
+        self._datasets = {row["study_uid"]: row for row in store.indexedDatasets()} if store is not None else {}
+
+    def datasets(self):
+        """Indexed datasets as a list of (patient name, study UID), sorted by patient name"""
+        rows = sorted(self._datasets.values(), key=lambda row: ((row["patient_name"] or "").lower(), row["dataset_path"]))
+        return [(row["patient_name"], row["study_uid"]) for row in rows]
+
+    def dataset(self, studyUid):
+        """Indexed dataset as a dict (study_uid, patient_uid, patient_name, dataset_path, series_uids,
+        study_series_uids), or None"""
+        return self._datasets.get(studyUid)
+
+    def datasetFiles(self, studyUid):
+        """Files to upload for a study"""
+        row = self._datasets.get(studyUid)
+        if row is None:
+            raise ValueError(f"Study {studyUid} is not in the DICOM database.")
+        seriesUids = row["series_uids"].split() if row["series_uids"] else self.dicomDatabase.seriesForStudy(studyUid)
+        files = []
+        for seriesUid in seriesUids:
+            files.extend(self.dicomDatabase.filesForSeries(seriesUid))
+        return files
+
+    def isBuilding(self):
+        return self.timer.isActive()
+
+    # DICOM database notifications
+
+    def connectDatabase(self):
+        if self._connected or self.dicomDatabase is None:
+            return
+        # Series are classified from the tag cache instead of reading the files
+        tagsToPrecache = list(self.dicomDatabase.tagsToPrecache)
+        missingTags = [tag for tag in SERIES_TAGS if tag not in tagsToPrecache]
+        if missingTags:
+            self.dicomDatabase.tagsToPrecache = tagsToPrecache + missingTags
+        self.dicomDatabase.connect("studyAdded(QString)", self._onStudyAdded)
+        self.dicomDatabase.connect("seriesAdded(QString)", self._onSeriesAdded)
+        self.dicomDatabase.connect("databaseChanged()", self._onDatabaseChanged)
+        self._connected = True
+
+    def disconnectDatabase(self):
+        if not self._connected:
+            return
+        self.dicomDatabase.disconnect("studyAdded(QString)", self._onStudyAdded)
+        self.dicomDatabase.disconnect("seriesAdded(QString)", self._onSeriesAdded)
+        self.dicomDatabase.disconnect("databaseChanged()", self._onDatabaseChanged)
+        self._connected = False
+
+    def _onStudyAdded(self, studyUid):
+        # The series of the study are inserted after the study itself, they are looked up when the burst is over
+        self._changedStudies.add(studyUid)
+        self._studiesAdded += 1
+        self._updateTimer.start()
+
+    def _onSeriesAdded(self, seriesUid):
+        # Series may be added to a study indexed already (later in a long import, or by another import)
+        self._changedStudies.add(self.dicomDatabase.studyForSeries(seriesUid))
+        self._updateTimer.start()
+
+    def _onDatabaseChanged(self):
+        # Emitted for imports too, a full pass only runs if something was removed (see _onUpdateTimeout)
+        self._fullUpdateRequested = True
+        self._updateTimer.start()
+
+    def _onUpdateTimeout(self):
+        changedStudies = self._changedStudies
+        self._changedStudies = set()
+        if self._fullUpdateRequested:
+            self._fullUpdateRequested = False
+            if self._isRemovalDetected():
+                self.refresh(force=True)
+                return
+        for studyUid in changedStudies:
+            if not studyUid:
+                continue
+            seriesUids = self.dicomDatabase.seriesForStudy(studyUid)
+            row = self._datasets.get(studyUid)
+            if row is None or seriesKey(seriesUids) != row.get("study_series_uids"):
+                self._pendingStudies.append((studyUid, None, None, seriesUids))
+        if self._pendingStudies and not self.timer.isActive():
+            self.timer.start()
+
+    def _countDatabase(self):
+        """Number of patients and studies in the DICOM database"""
+        patients = self.dicomDatabase.patients()
+        return len(patients), sum(len(self.dicomDatabase.studiesForPatient(patientUid)) for patientUid in patients)
+
+    def _isRemovalDetected(self):
+        """Whether patients or studies were removed since the last check, imports only add some"""
+        patientCount, studyCount = self._countDatabase()
+        removed = (self._databaseCounts is None or patientCount < self._databaseCounts[0]
+                   or studyCount < self._databaseCounts[1] + self._studiesAdded)
+        self._databaseCounts = (patientCount, studyCount)
+        self._studiesAdded = 0
+        return removed
+
+    # Indexing
+
+    def _databaseSource(self):
+        """Identifies the DICOM database and its last modification"""
+        path = self.dicomDatabase.databaseFilename
+        try:
+            return f"{path}:{os.path.getmtime(path)}"
+        except OSError:
+            return f"{path}:"
+
+    def refresh(self, force=False):
+        """Reconcile the index with the DICOM database in the background.
+
+        Unless force is set, nothing is done if the DICOM database is unchanged since the last pass.
+        """
+        if self.dicomDatabase is None or not self.dicomDatabase.isOpen:
+            return
+        if self.store is not None:
+            source = self._databaseSource()
+            indexedPath = self.store.getMeta("datasetIndexSource", ":").rsplit(":", 1)[0]
+            if indexedPath != self.dicomDatabase.databaseFilename:
+                # Another DICOM database was opened
+                self.store.clearIndexedDatasets()
+                if self._datasets:
+                    self._datasets = {}
+                    self._notify()
+            elif not force and source == self.store.getMeta("datasetIndexSource"):
+                return
+        if self._seenStudies is not None:
+            # A pass is running already, start over to see the latest changes
+            self._pendingPatients.clear()
+        self._pendingPatients.extend(self.dicomDatabase.patients())
+        self._seenStudies = set()
+        self.timer.start()
+
+    def _processSlice(self):
+        try:
+            deadline = time.monotonic() + self.timeSlice
+            while time.monotonic() < deadline:
+                if self._pendingPatients:
+                    self._listPatientStudies(self._pendingPatients.popleft())
+                elif self._pendingStudies:
+                    self._indexStudy(*self._pendingStudies.popleft())
+                else:
+                    self._finishPass()
+                    return
+            self._flush()
+        except Exception as e:
+            logging.error(f"Failed to index the DICOM database: {str(e)}")
+            self.timer.stop()
+            self._seenStudies = None
+
+    def _listPatientStudies(self, patientUid):
+        patientName = self.dicomDatabase.nameForPatient(patientUid)
+        for studyUid in self.dicomDatabase.studiesForPatient(patientUid):
+            self._seenStudies.add(studyUid)
+            row = self._datasets.get(studyUid)
+            if row is None:
+                self._pendingStudies.append((studyUid, patientUid, patientName, None))
+                continue
+            # Series added or removed since the study was indexed (re-import, partial delete)
+            seriesUids = self.dicomDatabase.seriesForStudy(studyUid)
+            if seriesKey(seriesUids) != row.get("study_series_uids"):
+                self._pendingStudies.append((studyUid, patientUid, patientName, seriesUids))
+
+    def _indexStudy(self, studyUid, patientUid, patientName, seriesUids=None):
+        """Add a study with its diffusion series, the dataset folder is the folder of its first file.
+
+        Studies indexed already are only indexed again with their current seriesUids.
+        """
+        if self._seenStudies is not None:
+            self._seenStudies.add(studyUid)
+        if seriesUids is None:
+            if studyUid in self._datasets:
+                return
+            seriesUids = self.dicomDatabase.seriesForStudy(studyUid)
+        if patientUid is None:
+            patientUid = self.dicomDatabase.patientForStudy(studyUid)
+            patientName = self.dicomDatabase.nameForPatient(patientUid)
+        firstFile = None
+        firstDiffusionFile = None
+        diffusionSeries = []
+        for seriesUid in seriesUids:
+            files = self.dicomDatabase.filesForSeries(seriesUid, 1)
+            if not files:
+                continue
+            firstFile = firstFile or files[0]
+            if isDiffusionSeries({tag: self.dicomDatabase.fileValue(files[0], tag) for tag in SERIES_TAGS}):
+                diffusionSeries.append(seriesUid)
+                firstDiffusionFile = firstDiffusionFile or files[0]
+        if firstFile is None:
+            if self._datasets.pop(studyUid, None) is not None:
+                self._removed.append(studyUid)
+            return
+        row = {"study_uid": studyUid, "patient_uid": patientUid, "patient_name": patientName,
+               "dataset_path": os.path.dirname(firstDiffusionFile or firstFile), "series_uids": " ".join(diffusionSeries),
+               "study_series_uids": seriesKey(seriesUids)}
+        self._datasets[studyUid] = row
+        self._added.append(row)
+
+    def _finishPass(self):
+        self.timer.stop()
+        if self._seenStudies is not None:
+            self._removed.extend(studyUid for studyUid in self._datasets if studyUid not in self._seenStudies)
+            for studyUid in self._removed:
+                self._datasets.pop(studyUid, None)
+            self._seenStudies = None
+            self._databaseCounts = self._countDatabase()
+            self._studiesAdded = 0
+            if self.store is not None:
+                self.store.setMeta("datasetIndexSource", self._databaseSource())
+        self._flush(finished=True)
+        if self.onFinished:
+            self.onFinished()
+
+    def _flush(self, finished=False):
+        """Write the changes of the last time slice to the store, notify at most every notifyInterval"""
+        if self._added or self._removed:
+            if self.store is not None:
+                self.store.updateIndexedDatasets(self._added, self._removed)
+            self._added = []
+            self._removed = []
+            self._changed = True
+        if self._changed and (finished or time.monotonic() - self._lastNotified >= self.notifyInterval):
+            self._notify()
+
+    def _notify(self):
+        self._changed = False
+        self._lastNotified = time.monotonic()
+        if self.onChanged:
+            self.onChanged()
@@ -0,0 +1,242 @@
+import concurrent.futures
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import zipfile
+
+from .Jobs import JobCancelled
+from .Reports import DOWNLOAD_DONE, ReportDownloadJob, copyChunked
+
+INDEX_FILENAME = "index.csv"
+MANIFEST_FILENAME = "manifest.json"
+INDEX_COLUMNS = ["order_id", "patient", "format", "file", "sha256"]
+
+
+def exportFilename(orderId, patient, format):
+    """Name of an exported report, unsafe characters of the patient name are replaced"""
+    safePatient = re.sub(r"[^A-Za-z0-9._-]+", "_", patient or "").strip("_") or "unknown"
+    return f"{safePatient}_{orderId}.{format}"
+
+
+class BulkExportJob:
+    """Export the reports of many orders to a directory or a zip file (see JobEngine).
+
+    Reports are downloaded into the report cache by up to maxWorkers threads and then copied
+    to the destination, they stay pinned in the cache until copied. Every exported file is recorded in a manifest, a re-run with the same
+    destination skips the files exported already. The manifest is kept in the directory, or
+    next to the zip file. Once done, an index CSV maps every order and format to its file.
+
+    A zip file is written as destination + ".part" and renamed when the run ends. The partial zip
+    of an interrupted run has no central directory and is discarded, its reports are exported again
+    (from the report cache) on the next run.
+
+    orders is a list of (orderId, patient).
+    """
+
+    def __init__(self, npcs, cache, orders, formats, destination, maxWorkers=4):
+        self.npcs = npcs
+        self.cache = cache
+        self.orders = list(orders)
+        self.formats = list(formats)
+        self.destination = destination
+        self.asZip = destination.lower().endswith(".zip")
+        self.maxWorkers = max(1, int(maxWorkers))
+        self.filesTotal = len(self.orders) * len(self.formats)
+        self.filesDone = 0
+        self.filesSkipped = 0
+        self.failed = []  # list of (orderId, format, error)
+        self.error = None
+        self.cancelled = False
+        self._cancelRequested = threading.Event()
+        self._downloads = []
+
+    def cancel(self):
+        self._cancelRequested.set()
+        for download in list(self._downloads):
+            download.cancel()
+
+    def _checkCancelled(self):
+        if self._cancelRequested.is_set():
+            raise JobCancelled()
+
+    def manifestPath(self):
+        if self.asZip:
+            return os.path.splitext(self.destination)[0] + "." + MANIFEST_FILENAME
+        return os.path.join(self.destination, MANIFEST_FILENAME)
+
+    def statusText(self):
+        text = f"Exported {self.filesDone} of {self.filesTotal} reports"
+        if self.failed:
+            text += f", {len(self.failed)} failed"
+        return text
+
+    def _loadManifest(self):
+        path = self.manifestPath()
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path, "r") as manifestFile:
+                return json.load(manifestFile)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable export manifest '{path}': {str(e)}")
+            return {}
+
+    def _saveManifest(self, manifest):
+        path = self.manifestPath()
+        with open(path + ".part", "w") as manifestFile:
+            json.dump(manifest, manifestFile, indent=1)
+        os.replace(path + ".part", path)
+
+    def partialPath(self):
+        return self.destination + ".part"
+
+    def _isExported(self, filename, archive):
+        if archive is not None:
+            return filename in archive.NameToInfo
+        return os.path.isfile(os.path.join(self.destination, filename))
+
+    def _openArchive(self):
+        """Open the partial zip file, starting from the zip file of the previous run"""
+        partialPath = self.partialPath()
+        if os.path.isfile(partialPath):
+            try:
+                with zipfile.ZipFile(partialPath, "r"):
+                    pass
+            except (zipfile.BadZipFile, OSError) as e:
+                logging.warning(f"Discarding interrupted report export '{partialPath}': {str(e)}")
+                os.remove(partialPath)
+        if not os.path.isfile(partialPath) and os.path.isfile(self.destination):
+            shutil.copyfile(self.destination, partialPath)
+        if os.path.isfile(partialPath):
+            # The index is written again at the end
+            self._removeFromZip(partialPath, INDEX_FILENAME)
+        return zipfile.ZipFile(partialPath, "a", zipfile.ZIP_DEFLATED)
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as e:
+            if self._cancelRequested.is_set():
+                self.cancelled = True
+                logging.info("Report export cancelled")
+            else:
+                self.error = str(e)
+                logging.error(f"Failed to export reports: {str(e)}")
+        return self
+
+    def _run(self):
+        if not self.asZip:
+            os.makedirs(self.destination, exist_ok=True)
+        manifest = self._loadManifest()
+        archive = None
+        if self.asZip:
+            archive = self._openArchive()
+
+        try:
+            pending = []
+            for orderId, patient in self.orders:
+                for format in self.formats:
+                    filename = exportFilename(orderId, patient, format)
+                    entry = manifest.get(filename)
+                    if archive is not None and entry is None and self._isExported(filename, archive):
+                        # Exported by a run that could not save its manifest, a zip member cannot be replaced
+                        entry = manifest[filename] = {"order_id": orderId, "patient": patient, "format": format,
+                                                      "sha256": self._memberHash(filename, archive)}
+                        self._saveManifest(manifest)
+                    if entry is not None and self._isExported(filename, archive):
+                        self.filesDone += 1
+                        self.filesSkipped += 1
+                    else:
+                        pending.append((orderId, patient, format, filename))
+            if self.filesSkipped:
+                logging.info(f"Resuming report export: {self.filesSkipped} reports exported already")
+
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                    futures = {}
+                    for orderId, patient, format, filename in pending:
+                        download = ReportDownloadJob(self.npcs, orderId, format, None, cache=self.cache)
+                        self._downloads.append(download)
+                        futures[executor.submit(download.run)] = (orderId, patient, format, filename)
+                    try:
+                        # Files are added to the destination by this thread only, as they arrive
+                        for future in concurrent.futures.as_completed(futures):
+                            self._checkCancelled()
+                            orderId, patient, format, filename = futures[future]
+                            download = future.result()
+                            try:
+                                if download.stage != DOWNLOAD_DONE:
+                                    self.failed.append((orderId, format, download.error))
+                                    continue
+                                self._exportFile(download, filename, archive)
+                            except OSError as e:
+                                # Only this report is missing, the export goes on
+                                logging.error(f"Failed to export {format} report of order {orderId}: {str(e)}")
+                                self.failed.append((orderId, format, str(e)))
+                                continue
+                            finally:
+                                # The cached report may be evicted now
+                                download.release()
+                            manifest[filename] = {"order_id": orderId, "patient": patient, "format": format, "sha256": download.sha256}
+                            self._saveManifest(manifest)
+                            self.filesDone += 1
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            finally:
+                for download in self._downloads:
+                    download.release()
+        finally:
+            if archive is not None:
+                if not self._cancelRequested.is_set():
+                    archive.writestr(INDEX_FILENAME, self._indexCsv(manifest))
+                archive.close()
+                os.replace(self.partialPath(), self.destination)
+
+        if archive is None:
+            with open(os.path.join(self.destination, INDEX_FILENAME), "w", newline="") as indexFile:
+                indexFile.write(self._indexCsv(manifest))
+        logging.info(f"Exported {self.filesDone - self.filesSkipped} reports to '{self.destination}'"
+                     f" ({self.filesSkipped} already exported, {len(self.failed)} failed)")
+
+    def _exportFile(self, download, filename, archive):
+        if archive is not None:
+            archive.write(download.path, filename)
+        else:
+            copyChunked(download.path, os.path.join(self.destination, filename), checkCancelled=self._checkCancelled)
+
+    def _indexCsv(self, manifest):
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(INDEX_COLUMNS)
+        for filename, entry in sorted(manifest.items(), key=lambda item: (item[1]["patient"] or "", item[0])):
+            writer.writerow([entry["order_id"], entry["patient"], entry["format"], filename, entry["sha256"]])
+        return output.getvalue()
+
+    def _memberHash(self, filename, archive):
+        digest = hashlib.sha256()
+        with archive.open(filename) as memberFile:
+            for chunk in iter(lambda: memberFile.read(2**20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _removeFromZip(self, path, name):
+        """Remove a member from a zip file (zip files cannot be changed in place)"""
+        with zipfile.ZipFile(path, "r") as source:
+            if name not in source.NameToInfo:
+                return
+            partialPath = path + ".tmp"
+            with zipfile.ZipFile(partialPath, "w", zipfile.ZIP_DEFLATED) as target:
+                for info in source.infolist():
+                    if info.filename == name:
+                        continue
+                    with source.open(info) as sourceFile, target.open(info, "w") as targetFile:
+                        shutil.copyfileobj(sourceFile, targetFile, 2**20)
+        os.replace(partialPath, path)
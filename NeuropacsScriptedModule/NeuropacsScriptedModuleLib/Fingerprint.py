@@ -0,0 +1,73 @@
+import hashlib
+import logging
+import threading
+
+from .Jobs import JobCancelled, datasetFiles
+
+
+def fileHash(path, chunkSize=2**20):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sopInstanceUid(path):
+    """SOPInstanceUID of a DICOM file, empty string for other files"""
+    try:
+        import pydicom
+        dataset = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=["SOPInstanceUID"])
+        return str(dataset.get("SOPInstanceUID", ""))
+    except Exception:
+        return ""
+
+
+def datasetFingerprint(files, checkCancelled=None):
+    """Fingerprint of a dataset, independent of file names and order.
+
+    files is a list of file paths. The fingerprint hashes the sorted pairs of
+    SOPInstanceUID and file content hash.
+    """
+    entries = []
+    for path in files:
+        if checkCancelled:
+            checkCancelled()
+        entries.append((sopInstanceUid(path), fileHash(path)))
+    digest = hashlib.sha256()
+    for uid, contentHash in sorted(entries):
+        digest.update(f"{uid}:{contentHash}\n".encode())
+    return digest.hexdigest()
+
+
+class FingerprintJob:
+    """Compute the fingerprint of a dataset in a worker thread (see JobEngine).
+
+    The dataset is the given list of files, or all files of the dataset folder.
+    """
+
+    def __init__(self, patientId, datasetPath, files=None):
+        self.patientId = patientId
+        self.datasetPath = datasetPath
+        self.files = files
+        self.fingerprint = None
+        self.error = None
+        self._cancelRequested = threading.Event()
+
+    def cancel(self):
+        self._cancelRequested.set()
+
+    def _checkCancelled(self):
+        if self._cancelRequested.is_set():
+            raise JobCancelled()
+
+    def run(self):
+        try:
+            files = self.files or [path for path, _ in datasetFiles(self.datasetPath)]
+            self.fingerprint = datasetFingerprint(files, self._checkCancelled)
+        except Exception as e:
+            if not self._cancelRequested.is_set():
+                self.error = str(e)
+                logging.warning(f"Failed to fingerprint dataset '{self.datasetPath}': {str(e)}")
+        return self
@@ -0,0 +1,446 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+import qt
+
+from .OrderStatus import STATE_CANCELLED
+from .Upload import DEFAULT_COMPRESSION_LEVEL, DatasetUploader
+
+
+class JobCancelled(Exception):
+    """Raised in a worker thread when the user cancelled the job"""
+
+
+# Job stages
+STAGE_QUEUED = "queued"
+STAGE_CREATING = "creating"
+STAGE_CREATED = "created"
+STAGE_UPLOADING = "uploading"
+STAGE_UPLOADED = "uploaded"
+STAGE_STARTING = "starting"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+STAGE_CANCELLED = "cancelled"
+
+
+def datasetFiles(path):
+    """Files of a dataset folder with their sizes"""
+    files = []
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            filePath = os.path.join(dirpath, filename)
+            if os.path.isfile(filePath):
+                files.append((filePath, os.path.getsize(filePath)))
+    return files
+
+
+def fileSizes(paths):
+    """Files of a file list with their sizes"""
+    return [(path, os.path.getsize(path)) for path in paths]
+
+
+class SubmissionJob:
+    """Create a neuropacs order, upload a dataset and run the product on it.
+
+    The stages are executed in worker threads, either all at once by run() or separately by
+    createOrder() and uploadAndStart(). Progress attributes are updated from there and only
+    read by the GUI thread, cancel() can be called from any thread. If a journal is given
+    (see DatasetUploader), an interrupted upload resumes with the files not yet uploaded.
+    If files is given, only these files are uploaded instead of the whole dataset folder.
+    """
+
+    def __init__(self, npcs, patientId, datasetPath, product, orderId=None, stage=None, submissionId=None, journal=None,
+                 fingerprint=None, files=None):
+        self.npcs = npcs
+        self.files = files
+        self.compressionLevel = DEFAULT_COMPRESSION_LEVEL
+        self.journal = journal
+        self.fingerprint = fingerprint
+        self.patientId = patientId
+        self.datasetPath = datasetPath
+        self.product = product
+        self.orderId = orderId
+        self.submissionId = submissionId
+        self.stage = stage or (STAGE_CREATED if orderId else STAGE_QUEUED)
+        self.filesDone = 0
+        self.filesTotal = 0
+        self.bytesDone = 0
+        self.bytesTotal = 0
+        self.error = None
+        self._cancelRequested = threading.Event()
+
+    def cancel(self):
+        """Request cancellation, the upload stops at the next file"""
+        self._cancelRequested.set()
+
+    def isCancelRequested(self):
+        return self._cancelRequested.is_set()
+
+    def isFinished(self):
+        return self.stage in (STAGE_DONE, STAGE_FAILED, STAGE_CANCELLED)
+
+    def progressPercent(self):
+        """Upload progress by bytes, in percent"""
+        if self.bytesTotal:
+            return int(100 * self.bytesDone / self.bytesTotal)
+        if self.filesTotal:
+            return int(100 * self.filesDone / self.filesTotal)
+        return 0
+
+    def statusText(self):
+        if self.stage == STAGE_UPLOADING:
+            return (f"Uploading file {self.filesDone}/{self.filesTotal} "
+                    f"({self.bytesDone / 2**20:.1f} / {self.bytesTotal / 2**20:.1f} MB)")
+        if self.stage == STAGE_FAILED:
+            return f"Failed: {self.error}"
+        return {
+            STAGE_QUEUED: "Queued",
+            STAGE_CREATING: "Creating order...",
+            STAGE_CREATED: f"Order {self.orderId} created",
+            STAGE_UPLOADED: f"Order {self.orderId} uploaded",
+            STAGE_STARTING: "Running order...",
+            STAGE_DONE: f"Order {self.orderId} started",
+            STAGE_CANCELLED: "Cancelled",
+        }[self.stage]
+
+    def _checkCancelled(self):
+        if self._cancelRequested.is_set():
+            raise JobCancelled()
+
+    def _runStage(self, stage):
+        """Run one stage, errors and cancellation end the job"""
+        try:
+            self._checkCancelled()
+            stage()
+        except Exception as e:
+            if self._cancelRequested.is_set():
+                self.stage = STAGE_CANCELLED
+                logging.info(f"neuropacs submission of '{self.datasetPath}' cancelled")
+            else:
+                self.error = str(e)
+                self.stage = STAGE_FAILED
+                logging.error(f"Failed to run neuropacs analysis: {str(e)}")
+        return self
+
+    def _createOrder(self):
+        self.stage = STAGE_CREATING
+        self.orderId = self.npcs.new_job()
+        logging.info(f"neuropacs order '{self.orderId}' created")
+        self.stage = STAGE_CREATED
+
+    def _upload(self):
+        files = fileSizes(self.files) if self.files else datasetFiles(self.datasetPath)
+        if not files:
+            raise ValueError(f"No files located in '{self.datasetPath}'.")
+        self.filesTotal = len(files)
+        self.bytesTotal = sum(size for _, size in files)
+
+        def onUploadProgress(filesDone, bytesDone):
+            self.filesDone = filesDone
+            self.bytesDone = bytesDone
+
+        self.stage = STAGE_UPLOADING
+        uploader = DatasetUploader(self.npcs, journal=self.journal, compressionLevel=self.compressionLevel)
+        uploader.upload(self.orderId, files, onProgress=onUploadProgress, checkCancelled=self._checkCancelled)
+        logging.info("dataset uploaded")
+        self.stage = STAGE_UPLOADED
+
+    def _start(self):
+        self._checkCancelled()
+        self.stage = STAGE_STARTING
+        self.npcs.run_job(self.orderId, self.product)
+        logging.info(f"order {self.orderId} started")
+        self.stage = STAGE_DONE
+
+    def createOrder(self):
+        """Create the neuropacs order"""
+        return self._runStage(self._createOrder)
+
+    def uploadAndStart(self):
+        """Upload the dataset (unless done already) and run the order"""
+        def uploadAndStart():
+            if self.stage != STAGE_UPLOADED:
+                self._upload()
+            self._start()
+        return self._runStage(uploadAndStart)
+
+    def run(self):
+        """Run all remaining stages"""
+        if self.orderId is None:
+            self.createOrder()
+            if self.isFinished():
+                return self
+        return self.uploadAndStart()
+
+
+class JobEngine:
+    """Runs jobs in worker threads and reports their progress on the GUI thread.
+
+    A job is any object with run() and cancel() methods, another job method can be given
+    as function to submit(). onProgress(job) is called periodically while the job runs and
+    onFinished(job) once when it has finished.
+
+    submit() returns the concurrent.futures.Future of the job function, with the job as its
+    job attribute, for callers that wait for the result instead of using callbacks.
+    """
+
+    def __init__(self, maxWorkers=1, pollInterval=200):
+        self.maxWorkers = max(1, int(maxWorkers))
+        self._executor = None
+        self._jobs = []
+        self.timer = qt.QTimer()
+        self.timer.setInterval(pollInterval)
+        self.timer.timeout.connect(self._poll)
+
+    def _getExecutor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.maxWorkers, thread_name_prefix="neuropacs-job")
+        return self._executor
+
+    def submit(self, job, onProgress=None, onFinished=None, function=None):
+        future = self._getExecutor().submit(function or job.run)
+        future.job = job
+        self._jobs.append((job, future, onProgress, onFinished))
+        if not self.timer.isActive():
+            self.timer.start()
+        return future
+
+    def setMaxWorkers(self, maxWorkers):
+        """Change the number of worker threads, used for jobs submitted from now on"""
+        maxWorkers = max(1, int(maxWorkers))
+        if maxWorkers == self.maxWorkers:
+            return
+        self.maxWorkers = maxWorkers
+        if self._executor is not None:
+            # Running jobs keep their threads until they finish
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def activeJobs(self):
+        return [job for job, _, _, _ in self._jobs]
+
+    def cancelAll(self):
+        for job in self.activeJobs():
+            job.cancel()
+
+    def shutdown(self):
+        """Cancel running jobs and release the worker threads"""
+        self.cancelAll()
+        self.timer.stop()
+        self._jobs = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _poll(self):
+        for entry in list(self._jobs):
+            job, future, onProgress, onFinished = entry
+            try:
+                if not future.done():
+                    if onProgress:
+                        onProgress(job)
+                    continue
+                self._jobs.remove(entry)
+                if onFinished:
+                    onFinished(job)
+            except Exception as e:
+                logging.error(f"Failed to report neuropacs job progress: {str(e)}")
+        if not self._jobs:
+            self.timer.stop()
+
+
+class SubmissionQueue:
+    """Persistent queue of dataset submissions.
+
+    Orders for waiting datasets are created ahead on a separate worker while at most
+    maxUploads datasets are uploaded in parallel. Every stage change is written to the order
+    store, so that the queue resumes where it stopped after a restart.
+
+    onChanged() is called on the GUI thread whenever the progress of the queue changes and
+    onOrderStarted(job) once an order has been stored and started.
+    """
+
+    def __init__(self, store, maxUploads=2, onChanged=None, onOrderStarted=None, compressionLevel=DEFAULT_COMPRESSION_LEVEL):
+        self.store = store
+        self.npcs = None
+        self.maxUploads = max(1, int(maxUploads))
+        self.compressionLevel = compressionLevel
+        self.onChanged = onChanged
+        self.onOrderStarted = onOrderStarted
+        self.createEngine = JobEngine(maxWorkers=1)
+        self.uploadEngine = JobEngine(maxWorkers=self.maxUploads)
+        self._waiting = []   # jobs without an order
+        self._creating = []  # jobs whose order is being created
+        self._created = []   # jobs with an order, waiting for an upload slot
+        self._uploading = [] # jobs being uploaded and started
+        self.finishedCount = 0
+        self.failedJobs = []
+
+    def setClient(self, npcs):
+        self.npcs = npcs
+
+    def setStore(self, store):
+        self.store = store
+
+    def setMaxUploads(self, maxUploads):
+        self.maxUploads = max(1, int(maxUploads))
+        self.uploadEngine.setMaxWorkers(self.maxUploads)
+        self._schedule()
+
+    def setCompressionLevel(self, compressionLevel):
+        """Deflate level of uploads started from now on"""
+        self.compressionLevel = compressionLevel
+
+    def jobs(self):
+        return self._uploading + self._created + self._creating + self._waiting
+
+    def isActive(self):
+        return bool(self.jobs())
+
+    def enqueue(self, patientId, datasetPath, product, fingerprint=None, files=None):
+        """Add a dataset to the queue, the fingerprint (if known) is recorded once the order is started.
+
+        If files is given, only these files are uploaded instead of the whole dataset folder.
+        Returns the SubmissionJob.
+        """
+        submissionId = self.store.addSubmission(patientId, datasetPath, product, fingerprint, files)
+        job = SubmissionJob(self.npcs, patientId, datasetPath, product, submissionId=submissionId,
+                            journal=self.store, fingerprint=fingerprint, files=files)
+        self._waiting.append(job)
+        self._schedule()
+        return job
+
+    def resume(self, fingerprints=None):
+        """Re-queue the submissions left unfinished by a previous session or failed.
+
+        If fingerprints is given, only the submissions of datasets with these fingerprints are re-queued.
+        """
+        known = {job.submissionId for job in self.jobs()}
+        for submission in self.store.pendingSubmissions():
+            if submission["submission_id"] in known:
+                continue
+            if fingerprints is not None and submission["fingerprint"] not in fingerprints:
+                continue
+            # Interrupted and failed uploads continue with the files not acknowledged yet
+            job = SubmissionJob(self.npcs, submission["patient"], submission["dataset_path"], submission["product"],
+                                orderId=submission["order_id"], submissionId=submission["submission_id"], journal=self.store,
+                                fingerprint=submission["fingerprint"], files=self.store.submissionFiles(submission["submission_id"]))
+            (self._waiting if job.orderId is None else self._created).append(job)
+        self._schedule()
+        return len(self.jobs())
+
+    def cancelAll(self):
+        """Cancel running submissions and drop the waiting ones.
+
+        Orders created already are kept in the order store as cancelled orders.
+        """
+        for job in self._waiting + self._created:
+            job.cancel()
+            job.stage = STAGE_CANCELLED
+            self._keepCancelledOrder(job)
+            self._forget(job)
+        self._waiting = []
+        self._created = []
+        for job in self._creating + self._uploading:
+            job.cancel()
+        self._notify()
+
+    def shutdown(self):
+        """Stop the workers, unfinished submissions stay in the store and are resumed later"""
+        self.createEngine.shutdown()
+        self.uploadEngine.shutdown()
+
+    def progress(self):
+        """Overall upload progress of the running submissions, (bytesDone, bytesTotal)"""
+        bytesDone = sum(job.bytesDone for job in self._uploading)
+        bytesTotal = sum(job.bytesTotal for job in self._uploading)
+        return bytesDone, bytesTotal
+
+    def statusText(self):
+        if not self.isActive():
+            return ""
+        text = f"Uploading {len(self._uploading)} dataset(s)"
+        waiting = len(self._created) + len(self._creating) + len(self._waiting)
+        if waiting:
+            text += f", {waiting} waiting"
+        if len(self._uploading) == 1:
+            text += f": {self._uploading[0].statusText()}"
+        return text
+
+    def _schedule(self):
+        if self.npcs is None:
+            return
+
+        # Start uploads for datasets that already have an order
+        while self._created and len(self._uploading) < self.maxUploads:
+            job = self._created.pop(0)
+            job.npcs = self.npcs
+            job.compressionLevel = self.compressionLevel
+            self._uploading.append(job)
+            self.store.updateSubmission(job.submissionId, stage=STAGE_UPLOADING)
+            self.uploadEngine.submit(job, onProgress=self._onProgress, onFinished=self._onUploadFinished, function=job.uploadAndStart)
+
+        # Create orders ahead so that the next upload can start as soon as a slot frees up
+        while self._waiting and len(self._creating) + len(self._created) < self.maxUploads:
+            job = self._waiting.pop(0)
+            job.npcs = self.npcs
+            self._creating.append(job)
+            self.createEngine.submit(job, onFinished=self._onCreateFinished, function=job.createOrder)
+
+        self._notify()
+
+    def _onProgress(self, job):
+        self._notify()
+
+    def _onCreateFinished(self, job):
+        self._creating.remove(job)
+        if job.stage == STAGE_CREATED:
+            self.store.updateSubmission(job.submissionId, orderId=job.orderId, stage=STAGE_CREATED)
+            self._created.append(job)
+        else:
+            self._finish(job)
+        self._schedule()
+
+    def _onUploadFinished(self, job):
+        self._uploading.remove(job)
+        if job.stage == STAGE_DONE:
+            self.store.addOrder(job.orderId, job.patientId, job.datasetPath, job.product)
+            if job.fingerprint:
+                self.store.addFingerprint(job.fingerprint, job.orderId, job.patientId)
+            logging.info(f"order {job.orderId} successfully saved")
+        self._finish(job)
+        if job.stage == STAGE_DONE and self.onOrderStarted:
+            self.onOrderStarted(job)
+        self._schedule()
+
+    def _finish(self, job):
+        self.finishedCount += 1
+        if job.stage == STAGE_FAILED:
+            self.failedJobs.append(job)
+            if job.orderId is not None:
+                # Keep the submission so that a retry only uploads the missing files
+                self.store.updateSubmission(job.submissionId, stage=STAGE_FAILED)
+                return
+        if job.stage == STAGE_CANCELLED:
+            self._keepCancelledOrder(job)
+        self._forget(job)
+
+    def _keepCancelledOrder(self, job):
+        """Record the order of a cancelled submission, so that it is not lost on the server side"""
+        if job.orderId is None:
+            return
+        self.store.addOrder(job.orderId, job.patientId, job.datasetPath, job.product)
+        self.store.recordStatuses([(job.orderId, STATE_CANCELLED, "Cancelled before the analysis started", "")])
+        logging.info(f"order {job.orderId} kept as cancelled")
+
+    def _forget(self, job):
+        self.store.deleteSubmission(job.submissionId)
+        if job.orderId is not None:
+            self.store.clearUploadCheckpoints(job.orderId)
+
+    def _notify(self):
+        if self.onChanged:
+            self.onChanged()
@@ -0,0 +1,223 @@
+import concurrent.futures
+import logging
+import math
+import threading
+import time
+
+import qt
+
+
+class _StatusBatch:
+    """Status requests submitted together, collected as they complete.
+
+    A request that times out while running cannot be stopped and keeps its worker busy until
+    check_status returns, hungWorkers counts these workers.
+    """
+
+    def __init__(self, executor, npcs, orderIds, maxWorkers, timeout):
+        self.timeout = timeout
+        self.results = {}
+        self.hungWorkers = 0
+        self._startTimes = {}
+        self._startTimesLock = threading.Lock()
+        self._futures = {executor.submit(self._check, npcs, orderId): orderId for orderId in orderIds}
+        self._pending = set(self._futures)
+
+        # Queued requests only start their timeout once a worker picks them up, the overall
+        # deadline guards against workers that never return.
+        rounds = math.ceil(len(orderIds) / maxWorkers) + 1
+        self._deadline = time.monotonic() + rounds * timeout
+
+    def _check(self, npcs, orderId):
+        with self._startTimesLock:
+            self._startTimes[orderId] = time.monotonic()
+        return npcs.check_status(orderId)
+
+    def poll(self, wait=0):
+        """Collect finished requests, returns True once every order has a result"""
+        done, self._pending = concurrent.futures.wait(self._pending, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            orderId = self._futures[future]
+            try:
+                self.results[orderId] = (future.result(), None)
+            except Exception as e:
+                self.results[orderId] = (None, e)
+
+        now = time.monotonic()
+        for future in list(self._pending):
+            orderId = self._futures[future]
+            with self._startTimesLock:
+                started = self._startTimes.get(orderId)
+            if now > self._deadline or (started is not None and now - started > self.timeout):
+                if not future.cancel():
+                    self.hungWorkers += 1
+                self._pending.discard(future)
+                self.results[orderId] = (None, TimeoutError(f"Status check timed out after {self.timeout:g} s"))
+
+        return not self._pending
+
+
+class StatusFetcher:
+    """Check the status of many neuropacs orders through a bounded worker pool.
+
+    check_status has no timeout of its own. When requests time out while running, the pool is
+    left to the hung workers and a new pool is used for the next requests, so that hung requests
+    do not starve later polls. The hung threads only end when their request returns, a server
+    that never answers leaves up to maxWorkers threads behind per poll.
+    """
+
+    def __init__(self, maxWorkers=8, timeout=30.0):
+        self.maxWorkers = max(1, int(maxWorkers))
+        self.timeout = float(timeout)
+        self._executor = None
+
+    def setMaxWorkers(self, maxWorkers):
+        """Change the concurrency limit, the pool is recreated on next use"""
+        maxWorkers = max(1, int(maxWorkers))
+        if maxWorkers == self.maxWorkers:
+            return
+        self.maxWorkers = maxWorkers
+        self.shutdown()
+
+    def setTimeout(self, timeout):
+        """Change the per-request timeout (in seconds)"""
+        self.timeout = float(timeout)
+
+    def shutdown(self):
+        """Release the worker threads (running requests are left to finish)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _releaseHungWorkers(self, batch):
+        """Leave the pool to the workers of timed out requests, the next requests use a new pool"""
+        if not batch.hungWorkers or self._executor is None:
+            return
+        logging.warning(f"{batch.hungWorkers} order status request(s) did not return, using new status workers")
+        # Queued requests of other batches still run, the threads end once idle
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def _getExecutor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.maxWorkers, thread_name_prefix="neuropacs-status")
+        return self._executor
+
+    def _submit(self, npcs, orderIds):
+        return _StatusBatch(self._getExecutor(), npcs, orderIds, self.maxWorkers, self.timeout)
+
+    def fetch(self, npcs, orderIds):
+        """Check the status of all orders concurrently.
+
+        Returns a dict mapping each order ID to a (status, error) tuple, error is None
+        on success. Requests that take longer than the timeout are reported with a
+        TimeoutError. The Qt event loop is kept running while waiting.
+        """
+        orderIds = list(orderIds)
+        if not orderIds:
+            return {}
+
+        batch = self._submit(npcs, orderIds)
+        while not batch.poll(wait=0.05):
+            # Keep the GUI responsive while the requests are in flight
+            qt.QApplication.processEvents()
+        self._releaseHungWorkers(batch)
+        return batch.results
+
+    def fetchAsync(self, npcs, orderIds, callback, pollInterval=100):
+        """Check the status of all orders without blocking.
+
+        callback is called on the GUI thread with the same dict as returned by fetch().
+        """
+        orderIds = list(orderIds)
+        if not orderIds:
+            callback({})
+            return
+
+        batch = self._submit(npcs, orderIds)
+        timer = qt.QTimer()
+        timer.setInterval(pollInterval)
+
+        def onTimeout():
+            if not batch.poll():
+                return
+            timer.stop()
+            # Drop our reference to the timer before handing over the results
+            batch.timer = None
+            self._releaseHungWorkers(batch)
+            callback(batch.results)
+
+        # Keep the timer alive as long as the batch is pending
+        batch.timer = timer
+        timer.timeout.connect(onTimeout)
+        timer.start()
+
+
+class StatusPoller:
+    """Periodically re-check in-flight orders in the background.
+
+    getClient returns the neuropacs client, getOrderIds the orders to re-check and
+    onStatuses receives the fetched statuses on the GUI thread.
+    """
+
+    def __init__(self, fetcher, getClient, getOrderIds, onStatuses, interval=30):
+        self.fetcher = fetcher
+        self.getClient = getClient
+        self.getOrderIds = getOrderIds
+        self.onStatuses = onStatuses
+        self._busy = False
+        self.timer = qt.QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.setInterval(interval)
+
+    def setInterval(self, interval):
+        """Change the polling interval (in seconds)"""
+        self.timer.setInterval(max(1, int(interval)) * 1000)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def isActive(self):
+        return self.timer.isActive()
+
+    def poll(self):
+        """Re-check in-flight orders now, unless a previous check is still running"""
+        if self._busy:
+            return
+        npcs = self.getClient()
+        orderIds = list(self.getOrderIds())
+        if npcs is None or not orderIds:
+            return
+        self._busy = True
+        self.fetcher.fetchAsync(npcs, orderIds, self._onFetched)
+
+    def _onFetched(self, results):
+        self._busy = False
+        try:
+            self.onStatuses(results)
+        except Exception as e:
+            logging.error(f"Failed to apply polled order statuses: {str(e)}")
+
+
+# Terminal order states, orders in these states are never re-polled
+STATE_COMPLETE = "complete"
+STATE_FAILED = "failed"
+STATE_EXPIRED = "expired"
+# Orders cancelled by the user before they were started
+STATE_CANCELLED = "cancelled"
+
+
+def terminalState(status, error=None):
+    """Terminal state of a fetched order status, None while the order is still running"""
+    if error is not None:
+        return STATE_EXPIRED if "Bucket not found" in str(error) else None
+    if status.get("failed"):
+        return STATE_FAILED
+    if str(status.get("progress")) == "100":
+        return STATE_COMPLETE
+    return None
+
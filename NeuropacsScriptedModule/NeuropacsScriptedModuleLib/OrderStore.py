@@ -0,0 +1,485 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .OrderStatus import STATE_CANCELLED, STATE_COMPLETE, STATE_EXPIRED, STATE_FAILED
+
+# Orders in these states are never checked again
+TERMINAL_STATES = (STATE_COMPLETE, STATE_FAILED, STATE_EXPIRED, STATE_CANCELLED)
+_TERMINAL_PLACEHOLDERS = ", ".join("?" * len(TERMINAL_STATES))
+
+# State stored for orders that are still running
+STATE_RUNNING = "running"
+
+
+class OrderStore:
+    """neuropacs orders stored in an indexed SQLite database (WAL mode).
+
+    The connection is shared by all threads, every access is serialized by a lock.
+    """
+
+    SCHEMA_VERSION = 9
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        # Autocommit mode, multi-statement changes use explicit transactions
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._createSchema()
+
+    def _createSchema(self):
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id TEXT PRIMARY KEY,
+                patient TEXT NOT NULL,
+                dataset_path TEXT,
+                product TEXT,
+                created REAL NOT NULL,
+                last_status TEXT,
+                last_info TEXT,
+                last_progress TEXT
+            );
+            CREATE INDEX IF NOT EXISTS orders_created ON orders (created);
+            CREATE INDEX IF NOT EXISTS orders_last_status ON orders (last_status);
+            CREATE TABLE IF NOT EXISTS submissions (
+                submission_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient TEXT NOT NULL,
+                dataset_path TEXT NOT NULL,
+                product TEXT,
+                order_id TEXT,
+                stage TEXT NOT NULL,
+                created REAL NOT NULL,
+                fingerprint TEXT
+            );
+            CREATE TABLE IF NOT EXISTS upload_checkpoints (
+                order_id TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                archive_index INTEGER NOT NULL,
+                archive_name TEXT NOT NULL,
+                PRIMARY KEY (order_id, file_path)
+            );
+            CREATE TABLE IF NOT EXISTS dataset_fingerprints (
+                fingerprint TEXT NOT NULL,
+                order_id TEXT NOT NULL,
+                patient TEXT,
+                created REAL NOT NULL,
+                PRIMARY KEY (fingerprint, order_id)
+            );
+            CREATE TABLE IF NOT EXISTS datasets (
+                study_uid TEXT PRIMARY KEY,
+                patient_uid TEXT,
+                patient_name TEXT,
+                dataset_path TEXT NOT NULL,
+                series_uids TEXT,
+                study_series_uids TEXT
+            );
+            CREATE TABLE IF NOT EXISTS submission_files (
+                submission_id INTEGER NOT NULL,
+                file_path TEXT NOT NULL,
+                PRIMARY KEY (submission_id, file_path)
+            );
+            CREATE TABLE IF NOT EXISTS report_cache (
+                order_id TEXT NOT NULL,
+                format TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (order_id, format)
+            );
+            CREATE INDEX IF NOT EXISTS report_cache_last_used ON report_cache (last_used);
+            CREATE TABLE IF NOT EXISTS results (
+                order_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value_text TEXT,
+                value_number REAL,
+                PRIMARY KEY (order_id, key)
+            );
+            CREATE INDEX IF NOT EXISTS results_key_text ON results (key, value_text);
+            CREATE INDEX IF NOT EXISTS results_key_number ON results (key, value_number);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """)
+        # Columns added after the table was first created
+        submissionColumns = [row["name"] for row in self._connection.execute("PRAGMA table_info(submissions)")]
+        if "fingerprint" not in submissionColumns:
+            self._connection.execute("ALTER TABLE submissions ADD COLUMN fingerprint TEXT")
+        datasetColumns = [row["name"] for row in self._connection.execute("PRAGMA table_info(datasets)")]
+        if "series_uids" not in datasetColumns:
+            # Datasets indexed without their series are indexed again
+            self._connection.execute("ALTER TABLE datasets ADD COLUMN series_uids TEXT")
+            self._connection.execute("DELETE FROM datasets")
+            self._connection.execute("DELETE FROM meta WHERE key = 'datasetIndexSource'")
+        if "study_series_uids" not in datasetColumns:
+            # Compared with the series in the DICOM database, studies indexed without it are indexed again
+            self._connection.execute("ALTER TABLE datasets ADD COLUMN study_series_uids TEXT")
+            self._connection.execute("DELETE FROM meta WHERE key = 'datasetIndexSource'")
+        self._connection.execute("PRAGMA user_version=%d" % self.SCHEMA_VERSION)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _transaction(self):
+        return _Transaction(self._connection, self._lock)
+
+    # Metadata
+
+    def getMeta(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row["value"]
+
+    def setMeta(self, key, value):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # Orders
+
+    def addOrder(self, orderId, patient, datasetPath=None, product=None, created=None):
+        """Insert (or replace) a single order"""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO orders (order_id, patient, dataset_path, product, created) VALUES (?, ?, ?, ?, ?)",
+                (orderId, patient, datasetPath, product, time.time() if created is None else created))
+
+    def deleteOrders(self, orderIds):
+        """Delete the given orders"""
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM orders WHERE order_id = ?", [(orderId,) for orderId in orderIds])
+            connection.executemany("DELETE FROM results WHERE order_id = ?", [(orderId,) for orderId in orderIds])
+
+    def deleteOrder(self, orderId):
+        self.deleteOrders([orderId])
+
+    def __contains__(self, orderId):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM orders WHERE order_id = ?", (orderId,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def order(self, orderId):
+        """Order as a dict, None if the order does not exist"""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM orders WHERE order_id = ?", (orderId,)).fetchone()
+        return None if row is None else dict(row)
+
+    def orders(self):
+        """All orders as dicts, oldest first"""
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM orders ORDER BY created, rowid").fetchall()
+        return [dict(row) for row in rows]
+
+    def patient(self, orderId):
+        order = self.order(orderId)
+        return None if order is None else order["patient"]
+
+    # Status
+
+    def recordStatuses(self, statuses):
+        """Store the last known status of orders, statuses is a list of (orderId, state, info, progress)"""
+        with self._transaction() as connection:
+            connection.executemany(
+                "UPDATE orders SET last_status = ?, last_info = ?, last_progress = ? WHERE order_id = ?",
+                [(state, info, progress, orderId) for orderId, state, info, progress in statuses])
+
+    def terminalStatus(self, orderId):
+        """Last status (dict with state, info and progress) of an order in a terminal state, or None"""
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT last_status, last_info, last_progress FROM orders WHERE order_id = ? AND last_status IN ({_TERMINAL_PLACEHOLDERS})",
+                (orderId, *TERMINAL_STATES)).fetchone()
+        return None if row is None else {"state": row["last_status"], "info": row["last_info"], "progress": row["last_progress"]}
+
+    def activeOrderIds(self):
+        """Orders that have not reached a terminal state"""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT order_id FROM orders WHERE last_status IS NULL OR last_status NOT IN ({_TERMINAL_PLACEHOLDERS}) ORDER BY created, rowid",
+                TERMINAL_STATES).fetchall()
+        return [row["order_id"] for row in rows]
+
+    # Submission queue
+
+    def addSubmission(self, patient, datasetPath, product, fingerprint=None, files=None):
+        """Queue a dataset for submission, returns the submission ID.
+
+        files is the list of files to upload, the whole dataset folder is uploaded if it is not given.
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "INSERT INTO submissions (patient, dataset_path, product, stage, created, fingerprint) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (patient, datasetPath, product, time.time(), fingerprint))
+            submissionId = cursor.lastrowid
+            connection.executemany(
+                "INSERT OR IGNORE INTO submission_files (submission_id, file_path) VALUES (?, ?)",
+                [(submissionId, path) for path in files or []])
+        return submissionId
+
+    def updateSubmission(self, submissionId, orderId=None, stage=None):
+        """Record the order and/or stage of a queued submission"""
+        with self._lock:
+            if orderId is not None:
+                self._connection.execute("UPDATE submissions SET order_id = ? WHERE submission_id = ?", (orderId, submissionId))
+            if stage is not None:
+                self._connection.execute("UPDATE submissions SET stage = ? WHERE submission_id = ?", (stage, submissionId))
+
+    def deleteSubmission(self, submissionId):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM submissions WHERE submission_id = ?", (submissionId,))
+            connection.execute("DELETE FROM submission_files WHERE submission_id = ?", (submissionId,))
+
+    def submissionFiles(self, submissionId):
+        """Files to upload for a submission, None if the whole dataset folder is uploaded"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT file_path FROM submission_files WHERE submission_id = ? ORDER BY rowid", (submissionId,)).fetchall()
+        return [row["file_path"] for row in rows] or None
+
+    def pendingSubmissions(self):
+        """Queued submissions as dicts, in queue order"""
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM submissions ORDER BY submission_id").fetchall()
+        return [dict(row) for row in rows]
+
+    # Dataset fingerprints
+
+    def addFingerprint(self, fingerprint, orderId, patient=None):
+        """Remember that the dataset with this fingerprint was submitted as orderId"""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO dataset_fingerprints (fingerprint, order_id, patient, created) VALUES (?, ?, ?, ?)",
+                (fingerprint, orderId, patient, time.time()))
+
+    def ordersForFingerprint(self, fingerprint):
+        """Earlier submissions of a dataset as dicts (order_id, patient, created), newest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT order_id, patient, created FROM dataset_fingerprints WHERE fingerprint = ? ORDER BY created DESC",
+                (fingerprint,)).fetchall()
+        return [dict(row) for row in rows]
+
+    # DICOM dataset index
+
+    def indexedDatasets(self):
+        """Datasets of the DICOM database index as dicts (study_uid, patient_uid, patient_name, dataset_path, series_uids,
+        study_series_uids)"""
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM datasets").fetchall()
+        return [dict(row) for row in rows]
+
+    def updateIndexedDatasets(self, added, removedStudyUids):
+        """Add (dicts as returned by indexedDatasets) and remove datasets of the index in one transaction"""
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO datasets (study_uid, patient_uid, patient_name, dataset_path, series_uids, study_series_uids) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(row["study_uid"], row["patient_uid"], row["patient_name"], row["dataset_path"], row["series_uids"],
+                  row.get("study_series_uids")) for row in added])
+            connection.executemany("DELETE FROM datasets WHERE study_uid = ?", [(studyUid,) for studyUid in removedStudyUids])
+
+    def clearIndexedDatasets(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM datasets")
+
+    # Report cache index
+
+    def cachedReport(self, orderId, format):
+        """Cache entry of a report as a dict (order_id, format, sha256, size, last_used), or None"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM report_cache WHERE order_id = ? AND format = ?", (orderId, format)).fetchone()
+        return None if row is None else dict(row)
+
+    def cachedReports(self):
+        """All cache entries, least recently used first"""
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM report_cache ORDER BY last_used").fetchall()
+        return [dict(row) for row in rows]
+
+    def addCachedReport(self, orderId, format, sha256, size):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO report_cache (order_id, format, sha256, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (orderId, format, sha256, size, time.time()))
+
+    def touchCachedReport(self, orderId, format):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE report_cache SET last_used = ? WHERE order_id = ? AND format = ?", (time.time(), orderId, format))
+
+    def deleteCachedReports(self, keys):
+        """Delete cache entries given as (orderId, format), returns the SHA-256 no longer referenced"""
+        with self._transaction() as connection:
+            shas = {row["sha256"] for key in keys for row in connection.execute(
+                "SELECT sha256 FROM report_cache WHERE order_id = ? AND format = ?", key)}
+            connection.executemany("DELETE FROM report_cache WHERE order_id = ? AND format = ?", keys)
+            return [sha256 for sha256 in shas
+                    if connection.execute("SELECT 1 FROM report_cache WHERE sha256 = ?", (sha256,)).fetchone() is None]
+
+    # Report results
+
+    def setResults(self, orderId, items):
+        """Replace the results of an order, items is a list of (key, text value, numeric value or None)"""
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM results WHERE order_id = ?", (orderId,))
+            connection.executemany(
+                "INSERT OR REPLACE INTO results (order_id, key, value_text, value_number) VALUES (?, ?, ?, ?)",
+                [(orderId, key, text, number) for key, text, number in items])
+
+    def hasResults(self, orderId):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM results WHERE order_id = ? LIMIT 1", (orderId,)).fetchone() is not None
+
+    def resultOrderIds(self):
+        """Orders with results, oldest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT results.order_id FROM results LEFT JOIN orders ON orders.order_id = results.order_id "
+                "ORDER BY orders.created, results.order_id").fetchall()
+        return [row["order_id"] for row in rows]
+
+    def resultKeys(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT DISTINCT key FROM results ORDER BY key").fetchall()
+        return [row["key"] for row in rows]
+
+    def resultValues(self, orderIds=None, keys=None):
+        """Result values as a list of (orderId, key, text value, numeric value)"""
+        with self._lock:
+            rows = self._connection.execute("SELECT order_id, key, value_text, value_number FROM results").fetchall()
+        orderIds = None if orderIds is None else set(orderIds)
+        keys = None if keys is None else set(keys)
+        return [tuple(row) for row in rows
+                if (orderIds is None or row["order_id"] in orderIds) and (keys is None or row["key"] in keys)]
+
+    def filterResults(self, key, operator, text, number=None):
+        """Orders whose result for key compares to the given value (numerically if number is given)"""
+        if operator == "contains":
+            escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            condition, value = "value_text LIKE ? ESCAPE '\\'", f"%{escaped}%"
+        elif number is not None:
+            condition, value = f"value_number {'<>' if operator == '!=' else operator} ?", number
+        elif operator in ("=", "!="):
+            condition, value = f"value_text {'<>' if operator == '!=' else '='} ?", text
+        else:
+            raise ValueError(f"'{text}' is not a number.")
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT order_id FROM results WHERE key = ? AND {condition} ORDER BY order_id", (key, value)).fetchall()
+        return [row["order_id"] for row in rows]
+
+    def resultSummary(self, key, orderIds=None):
+        """Summary of one result as a dict with count, min, max, mean (of numeric values) and counts of text values"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT order_id, value_text, value_number FROM results WHERE key = ?", (key,)).fetchall()
+        if orderIds is not None:
+            orderIds = set(orderIds)
+            rows = [row for row in rows if row["order_id"] in orderIds]
+        numbers = [row["value_number"] for row in rows if row["value_number"] is not None]
+        textCounts = {}
+        for row in rows:
+            if row["value_number"] is None:
+                textCounts[row["value_text"]] = textCounts.get(row["value_text"], 0) + 1
+        return {
+            "count": len(rows),
+            "min": min(numbers) if numbers else None,
+            "max": max(numbers) if numbers else None,
+            "mean": sum(numbers) / len(numbers) if numbers else None,
+            "values": textCounts,
+        }
+
+    # Upload checkpoints
+
+    def acknowledgedUploadFiles(self, orderId):
+        """Files of an order acknowledged by the server, dict of file path to name in the archive"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT file_path, archive_name FROM upload_checkpoints WHERE order_id = ?", (orderId,)).fetchall()
+        return {row["file_path"]: row["archive_name"] for row in rows}
+
+    def nextUploadArchiveIndex(self, orderId):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(archive_index) FROM upload_checkpoints WHERE order_id = ?", (orderId,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def acknowledgeUploadArchive(self, orderId, archiveIndex, files):
+        """Record the files of an uploaded archive, files is a list of (file path, name in the archive)"""
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO upload_checkpoints (order_id, file_path, archive_index, archive_name) VALUES (?, ?, ?, ?)",
+                [(orderId, path, archiveIndex, name) for path, name in files])
+
+    def clearUploadCheckpoints(self, orderId):
+        with self._lock:
+            self._connection.execute("DELETE FROM upload_checkpoints WHERE order_id = ?", (orderId,))
+
+    # Migration
+
+    def isMigrated(self):
+        return self.getMeta("migrated") is not None
+
+    def migrateFromJson(self, configPath, statusCachePath=None, defaultOrders=None):
+        """Import the JSON order map (and status cache) used by earlier versions, only done once.
+
+        defaultOrders is imported instead if there is no JSON order map.
+        Returns the number of imported orders.
+        """
+        if self.isMigrated():
+            return 0
+
+        orderMap = defaultOrders or {}
+        if os.path.isfile(configPath) and os.path.getsize(configPath) > 0:
+            with open(configPath, "r") as configFile:
+                orderMap = json.load(configFile)
+
+        statuses = {}
+        if statusCachePath and os.path.isfile(statusCachePath):
+            try:
+                with open(statusCachePath, "r") as cacheFile:
+                    statuses = json.load(cacheFile)
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable status cache '{statusCachePath}': {str(e)}")
+
+        # Keep the order of the JSON map by spacing the creation times
+        now = time.time()
+        with self._transaction() as connection:
+            for index, (orderId, patient) in enumerate(orderMap.items()):
+                status = statuses.get(orderId, {})
+                connection.execute(
+                    "INSERT OR IGNORE INTO orders (order_id, patient, created, last_status, last_info, last_progress) VALUES (?, ?, ?, ?, ?, ?)",
+                    (orderId, patient, now + index * 1e-3, status.get("state"), status.get("info"), status.get("progress")))
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (configPath,))
+        return len(orderMap)
+
+
+class _Transaction:
+    """Context manager running statements in one transaction while holding the store lock"""
+
+    def __init__(self, connection, lock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.connection.execute("BEGIN")
+        return self.connection
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            self.connection.execute("ROLLBACK" if excType else "COMMIT")
+        finally:
+            self.lock.release()
+        return False
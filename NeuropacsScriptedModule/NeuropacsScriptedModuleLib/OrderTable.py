@@ -0,0 +1,141 @@
+import qt
+
+
+# Order table columns
+COLUMN_ORDER_ID = 0
+COLUMN_PATIENT_ID = 1
+COLUMN_INFO = 2
+COLUMN_PROGRESS = 3
+COLUMN_DOWNLOAD = 4
+COLUMN_DELETE = 5
+
+COLUMN_HEADERS = ["Order ID", "Patient ID", "Info", "Progress", "Download Report", "Delete"]
+
+# Item data role telling the button delegate whether the button can be clicked
+ButtonEnabledRole = qt.Qt.UserRole + 1
+
+
+class OrderTableModel(qt.QAbstractTableModel):
+    """Table model of neuropacs orders.
+
+    Each row is a plain list [orderId, patientId, info, progress], the download and delete
+    columns have no storage of their own and are painted by ButtonDelegate.
+    """
+
+    def __init__(self, parent=None):
+        qt.QAbstractTableModel.__init__(self, parent)
+        self._rows = []
+        self._rowOfOrder = {}
+
+    # Qt model interface
+
+    def rowCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMN_HEADERS)
+
+    def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+        if orientation == qt.Qt.Horizontal and role == qt.Qt.DisplayRole and 0 <= section < len(COLUMN_HEADERS):
+            return COLUMN_HEADERS[section]
+        return None
+
+    def data(self, index, role=qt.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        row = self._rows[index.row()]
+        column = index.column()
+        if role == qt.Qt.DisplayRole:
+            if column == COLUMN_DOWNLOAD:
+                return "Download"
+            if column == COLUMN_DELETE:
+                return "Delete"
+            return row[column]
+        if role == qt.Qt.ToolTipRole and column in (COLUMN_ORDER_ID, COLUMN_INFO):
+            return row[column]
+        if role == ButtonEnabledRole:
+            if column == COLUMN_DOWNLOAD:
+                return row[COLUMN_PROGRESS] == "100%"
+            if column == COLUMN_DELETE:
+                return True
+        return None
+
+    # Order access
+
+    def setOrders(self, rows):
+        """Replace all rows, each row is [orderId, patientId, info, progress]"""
+        self.beginResetModel()
+        self._rows = [list(row) for row in rows]
+        self._rowOfOrder = {row[COLUMN_ORDER_ID]: rowIndex for rowIndex, row in enumerate(self._rows)}
+        self.endResetModel()
+
+    def addOrder(self, row):
+        """Append one row [orderId, patientId, info, progress]"""
+        rowIndex = len(self._rows)
+        self.beginInsertRows(qt.QModelIndex(), rowIndex, rowIndex)
+        self._rows.append(list(row))
+        self._rowOfOrder[row[COLUMN_ORDER_ID]] = rowIndex
+        self.endInsertRows()
+
+    def orderIds(self):
+        return [row[COLUMN_ORDER_ID] for row in self._rows]
+
+    def orderAt(self, rowIndex):
+        return self._rows[rowIndex][COLUMN_ORDER_ID]
+
+    def progress(self, orderId):
+        rowIndex = self._rowOfOrder.get(orderId)
+        return None if rowIndex is None else self._rows[rowIndex][COLUMN_PROGRESS]
+
+    def updateOrder(self, orderId, info, progress):
+        """Update the status of one order, returns False if the order is not in the table"""
+        rowIndex = self._rowOfOrder.get(orderId)
+        if rowIndex is None:
+            return False
+        row = self._rows[rowIndex]
+        if row[COLUMN_INFO] == info and row[COLUMN_PROGRESS] == progress:
+            return True
+        row[COLUMN_INFO] = info
+        row[COLUMN_PROGRESS] = progress
+        self.dataChanged.emit(self.index(rowIndex, COLUMN_INFO), self.index(rowIndex, COLUMN_DOWNLOAD))
+        return True
+
+    def removeOrders(self, orderIds):
+        """Remove the rows of the given orders"""
+        rowIndices = sorted((self._rowOfOrder[orderId] for orderId in orderIds if orderId in self._rowOfOrder), reverse=True)
+        # Remove bottom-up so that the remaining row indices stay valid
+        for rowIndex in rowIndices:
+            self.beginRemoveRows(qt.QModelIndex(), rowIndex, rowIndex)
+            del self._rows[rowIndex]
+            self.endRemoveRows()
+        if rowIndices:
+            self._rowOfOrder = {row[COLUMN_ORDER_ID]: rowIndex for rowIndex, row in enumerate(self._rows)}
+
+
+class ButtonDelegate(qt.QStyledItemDelegate):
+    """Paints a push button in a table cell, no widget is created per row.
+
+    onClicked is called with the model index and the cell rectangle (in viewport coordinates).
+    """
+
+    def __init__(self, parent, onClicked, hasMenu=False):
+        qt.QStyledItemDelegate.__init__(self, parent)
+        self.onClicked = onClicked
+        self.hasMenu = hasMenu
+
+    def paint(self, painter, option, index):
+        buttonOption = qt.QStyleOptionButton()
+        buttonOption.rect = option.rect.adjusted(2, 2, -2, -2)
+        buttonOption.text = index.data()
+        buttonOption.state = qt.QStyle.State_Enabled if index.data(ButtonEnabledRole) else qt.QStyle.State_None
+        if self.hasMenu:
+            buttonOption.features = qt.QStyleOptionButton.HasMenu
+        qt.QApplication.style().drawControl(qt.QStyle.CE_PushButton, buttonOption, painter)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() != qt.QEvent.MouseButtonRelease or event.button() != qt.Qt.LeftButton:
+            return False
+        if not index.data(ButtonEnabledRole) or not option.rect.contains(event.pos()):
+            return False
+        self.onClicked(index, option.rect)
+        return True
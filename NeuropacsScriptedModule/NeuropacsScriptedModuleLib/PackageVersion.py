@@ -0,0 +1,88 @@
+import importlib.metadata
+import logging
+import os
+import re
+
+PYPI_URL = "https://pypi.org/pypi/{package}/json"
+
+
+def installedVersion(package):
+    """Installed version of a Python package, None if it is not installed"""
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def isNewer(version, than):
+    """Whether version is newer than another version (None for not installed)"""
+    import packaging.version
+    if version is None:
+        return False
+    return than is None or packaging.version.parse(version) > packaging.version.parse(than)
+
+
+def wheelVersions(directory, package):
+    """Versions of a package available as wheel files in a directory, oldest first"""
+    import packaging.version
+    # Wheel file names are {distribution}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+    distribution = re.sub(r"[-_.]+", "_", package).lower()
+    versions = set()
+    for filename in os.listdir(directory):
+        parts = filename[:-len(".whl")].split("-") if filename.endswith(".whl") else []
+        if len(parts) >= 5 and parts[0].lower() == distribution:
+            versions.add(parts[1])
+    return sorted(versions, key=packaging.version.parse)
+
+
+def installArguments(package, version=None, wheelDirectory=None):
+    """pip install arguments for a package, only from the wheel directory if one is given"""
+    requirement = f"{package}=={version}" if version else package
+    if wheelDirectory:
+        return ["--no-index", "--find-links", wheelDirectory, requirement]
+    return [requirement]
+
+
+class VersionCheckJob:
+    """Look up the latest version of a package on PyPI and in a local wheel directory (see JobEngine).
+
+    PyPI is not queried in offline mode. The request is given up after timeout seconds.
+    """
+
+    def __init__(self, package, timeout=5, offline=False, wheelDirectory=None):
+        self.package = package
+        self.timeout = timeout
+        self.offline = offline
+        self.wheelDirectory = wheelDirectory
+        self.installedVersion = None
+        self.latestVersion = None
+        self.fromWheels = False  # whether the latest version is available in the wheel directory
+        self.error = None
+
+    def cancel(self):
+        # The request is bounded by the timeout
+        pass
+
+    def run(self):
+        try:
+            self.installedVersion = installedVersion(self.package)
+            wheelVersion = None
+            if self.wheelDirectory and os.path.isdir(self.wheelDirectory):
+                versions = wheelVersions(self.wheelDirectory, self.package)
+                wheelVersion = versions[-1] if versions else None
+            pypiVersion = None if self.offline else self._pypiVersion()
+            if isNewer(pypiVersion, wheelVersion):
+                self.latestVersion = pypiVersion
+            else:
+                self.latestVersion = wheelVersion
+                self.fromWheels = wheelVersion is not None
+        except Exception as e:
+            self.error = str(e)
+            logging.warning(f"Failed to check the latest version of {self.package}: {str(e)}")
+        return self
+
+    def _pypiVersion(self):
+        import requests
+        response = requests.get(PYPI_URL.format(package=self.package), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["info"]["version"]
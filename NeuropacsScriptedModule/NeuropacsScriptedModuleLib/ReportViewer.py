@@ -0,0 +1,304 @@
+import collections
+import json
+import os
+import re
+
+import qt
+
+# Documents larger than this are loaded in chunks, JSON is then indented as it is loaded
+CHUNKED_LOAD_SIZE = 512 * 1024
+
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\],:]|[^"{}\[\],:\s]+|\s+')
+
+
+def decodeImage(data):
+    """Decode an image (PNG bytes) in memory, returns a QPixmap or None"""
+    pixmap = qt.QPixmap()
+    if not pixmap.loadFromData(qt.QByteArray(bytes(data))):
+        return None
+    return pixmap
+
+
+class ReportImageViewer(qt.QWidget):
+    """Shows a report image decoded in memory, scaled to fit the viewer or at full size"""
+
+    def __init__(self, parent=None):
+        qt.QWidget.__init__(self, parent)
+        self._pixmap = None
+        layout = qt.QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.fitCheckBox = qt.QCheckBox("Fit to window")
+        self.fitCheckBox.checked = True
+        self.fitCheckBox.toggled.connect(self._updateImage)
+        layout.addWidget(self.fitCheckBox)
+
+        self.imageLabel = qt.QLabel()
+        self.imageLabel.setAlignment(qt.Qt.AlignCenter)
+        self.scrollArea = qt.QScrollArea()
+        self.scrollArea.setWidget(self.imageLabel)
+        self.scrollArea.setAlignment(qt.Qt.AlignCenter)
+        self.scrollArea.widgetResizable = True
+        layout.addWidget(self.scrollArea)
+
+    def setImageData(self, data):
+        """Show an image given as PNG bytes, returns False if it cannot be decoded"""
+        pixmap = decodeImage(data)
+        if pixmap is None:
+            return False
+        self.setPixmap(pixmap)
+        return True
+
+    def setPixmap(self, pixmap):
+        self._pixmap = pixmap
+        self._updateImage()
+
+    def pixmap(self):
+        return self._pixmap
+
+    def resizeEvent(self, event):
+        qt.QWidget.resizeEvent(self, event)
+        if self.fitCheckBox.checked:
+            self._updateImage()
+
+    def _updateImage(self):
+        if self._pixmap is None:
+            self.imageLabel.clear()
+            return
+        size = self.scrollArea.viewport().size
+        if self.fitCheckBox.checked and size.width() > 0 and size.height() > 0:
+            self.imageLabel.setPixmap(self._pixmap.scaled(size, qt.Qt.KeepAspectRatio, qt.Qt.SmoothTransformation))
+        else:
+            self.imageLabel.setPixmap(self._pixmap)
+
+
+class JsonIndenter:
+    """Indents JSON text fed in chunks, like json.dumps(indent=2) without parsing the document.
+
+    Tokens cut by the end of a chunk are kept until the next one, text that is not JSON is
+    passed through once the tokens stop matching.
+    """
+
+    indent = "  "
+
+    def __init__(self):
+        self._pending = ""
+        self._depth = 0
+        self._opened = False
+
+    def feed(self, text, final=False):
+        """Indented text of the next chunk, final flushes the tokens kept back"""
+        text = self._pending + text
+        output = []
+        position = 0
+        while position < len(text):
+            match = _JSON_TOKEN.match(text, position)
+            if match is None or (match.end() == len(text) and not final):
+                break
+            position = match.end()
+            token = match.group()
+            if token.isspace():
+                continue
+            if token in ("}", "]"):
+                self._depth = max(0, self._depth - 1)
+                if not self._opened:
+                    output.append("\n" + self.indent * self._depth)
+            elif self._opened:
+                output.append("\n" + self.indent * self._depth)
+            self._opened = False
+            if token == ",":
+                output.append(",\n" + self.indent * self._depth)
+            elif token == ":":
+                output.append(": ")
+            else:
+                output.append(token)
+            if token in ("{", "["):
+                self._depth += 1
+                self._opened = True
+        if final:
+            output.append(text[position:])
+            text, position = "", 0
+        self._pending = text[position:]
+        return "".join(output)
+
+
+class ReportSyntaxHighlighter(qt.QSyntaxHighlighter):
+    """Highlights JSON or XML, one text block (line) at a time as Qt lays out the document"""
+
+    _RULES = {
+        "json": [
+            (re.compile(r"\b(?:true|false|null)\b"), "#8e24aa"),
+            (re.compile(r"-?\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b"), "#c62828"),
+            # Strings last, so that words and digits within them keep the string color
+            (re.compile(r'"(?:[^"\\]|\\.)*"(?=\s*:)'), "#1f5fa8"),  # keys
+            (re.compile(r':\s*("(?:[^"\\]|\\.)*")'), "#2e7d32"),  # string values
+        ],
+        "xml": [
+            (re.compile(r"</?[\w:.-]+|/?>"), "#1f5fa8"),  # tags
+            (re.compile(r"\b[\w:.-]+(?==)"), "#8e24aa"),  # attribute names
+            (re.compile(r'"[^"]*"|\'[^\']*\''), "#2e7d32"),  # attribute values
+            (re.compile(r"<!--.*?-->"), "#757575"),
+        ],
+    }
+
+    def __init__(self, document, format):
+        qt.QSyntaxHighlighter.__init__(self, document)
+        self.rules = []
+        for pattern, color in self._RULES.get(format, []):
+            textFormat = qt.QTextCharFormat()
+            textFormat.setForeground(qt.QBrush(qt.QColor(color)))
+            self.rules.append((pattern, textFormat))
+
+    def highlightBlock(self, text):
+        for pattern, textFormat in self.rules:
+            for match in pattern.finditer(text):
+                group = 1 if pattern.groups else 0
+                self.setFormat(match.start(group), match.end(group) - match.start(group), textFormat)
+
+
+class ReportTextView(qt.QPlainTextEdit):
+    """Read-only view of a text report, JSON/XML are syntax highlighted.
+
+    Large documents are appended in chunks from a timer, so that the application stays
+    responsive: JSON is indented chunk by chunk (see JsonIndenter) and the highlighter only
+    processes the lines of each new chunk.
+    """
+
+    chunkSize = 256 * 1024
+
+    def __init__(self, parent=None):
+        qt.QPlainTextEdit.__init__(self, parent)
+        self.setReadOnly(True)
+        self.setLineWrapMode(qt.QPlainTextEdit.NoWrap)
+        self.setFont(qt.QFontDatabase.systemFont(qt.QFontDatabase.FixedFont))
+        self.highlighter = None
+        self._file = None
+        self._indenter = None
+        self._onLoaded = None
+        self._timer = qt.QTimer(self)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._loadChunk)
+
+    def load(self, path, format, onLoaded=None):
+        """Show a report file, onLoaded() is called once the file has been read (or loading stopped)"""
+        self._close()
+        self.clear()
+        self._onLoaded = onLoaded
+        if self.highlighter is not None:
+            self.highlighter.setDocument(None)
+        self.highlighter = ReportSyntaxHighlighter(self.document(), format)
+        size = os.path.getsize(path)
+        if size <= CHUNKED_LOAD_SIZE:
+            with open(path, "r", encoding="utf-8", errors="replace") as reportFile:
+                text = reportFile.read()
+            if format == "json":
+                try:
+                    text = json.dumps(json.loads(text), indent=2)
+                except ValueError:
+                    pass
+            self.setPlainText(text)
+            self._close()
+            return
+        self._indenter = JsonIndenter() if format == "json" else None
+        self._file = open(path, "r", encoding="utf-8", errors="replace")
+        self._timer.start()
+
+    def _loadChunk(self):
+        chunk = self._file.read(self.chunkSize)
+        text = chunk if self._indenter is None else self._indenter.feed(chunk, final=not chunk)
+        if text:
+            cursor = qt.QTextCursor(self.document())
+            cursor.movePosition(qt.QTextCursor.End)
+            cursor.insertText(text)
+        if not chunk:
+            self._close()
+
+    def _close(self):
+        self._timer.stop()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._indenter = None
+        onLoaded, self._onLoaded = self._onLoaded, None
+        if onLoaded:
+            onLoaded()
+
+
+class ReportViewerDock(qt.QDockWidget):
+    """Dockable viewer showing reports in tabs.
+
+    Documents are identified by a key (order ID and format), showing a document again brings
+    its tab to the front. At most maxDocuments are kept open, the least recently shown
+    document is closed first.
+    """
+
+    def __init__(self, parent=None, maxDocuments=8):
+        qt.QDockWidget.__init__(self, "neuropacs reports", parent)
+        self.setObjectName("NeuropacsReportViewerDock")
+        self.maxDocuments = max(1, int(maxDocuments))
+        self._documents = collections.OrderedDict()  # key -> tab widget, least recently shown first
+        self.tabWidget = qt.QTabWidget()
+        self.tabWidget.setTabsClosable(True)
+        self.tabWidget.tabCloseRequested.connect(self._onTabCloseRequested)
+        self.setWidget(self.tabWidget)
+
+    def setMaxDocuments(self, maxDocuments):
+        self.maxDocuments = max(1, int(maxDocuments))
+        self._evict()
+
+    def hasDocument(self, key):
+        return key in self._documents
+
+    def showDocument(self, key):
+        """Bring an open document to the front"""
+        self._documents.move_to_end(key)
+        self.tabWidget.setCurrentWidget(self._documents[key])
+        self.show()
+        self.raise_()
+
+    def showImage(self, key, title, data):
+        """Show an image report given as PNG bytes"""
+        viewer = self._documents.get(key)
+        if viewer is None:
+            viewer = ReportImageViewer()
+            if not viewer.setImageData(data):
+                raise ValueError("Failed to decode the PNG report.")
+            self._addDocument(key, title, viewer)
+        self.showDocument(key)
+        return viewer
+
+    def showText(self, key, title, path, format, onLoaded=None):
+        """Show a text report (TXT/JSON/XML) stored in a file, onLoaded() is called once the file has been read"""
+        view = self._documents.get(key)
+        if view is None:
+            view = ReportTextView()
+            view.load(path, format, onLoaded)
+            self._addDocument(key, title, view)
+        elif onLoaded:
+            onLoaded()
+        self.showDocument(key)
+        return view
+
+    def closeDocument(self, key):
+        widget = self._documents.pop(key, None)
+        if widget is None:
+            return
+        self.tabWidget.removeTab(self.tabWidget.indexOf(widget))
+        if isinstance(widget, ReportTextView):
+            widget._close()
+        widget.deleteLater()
+
+    def _addDocument(self, key, title, widget):
+        self._documents[key] = widget
+        self.tabWidget.addTab(widget, title)
+        self._evict()
+
+    def _evict(self):
+        while len(self._documents) > self.maxDocuments:
+            self.closeDocument(next(iter(self._documents)))
+
+    def _onTabCloseRequested(self, index):
+        widget = self.tabWidget.widget(index)
+        for key, document in list(self._documents.items()):
+            if document == widget:
+                self.closeDocument(key)
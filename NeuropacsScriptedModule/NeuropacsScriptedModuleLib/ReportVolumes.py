@@ -0,0 +1,102 @@
+import collections
+import logging
+
+import vtk
+
+# Node attribute identifying the report volume of an order
+ORDER_ATTRIBUTE = "neuropacs.orderId"
+
+
+def decodeVolume(data):
+    """Decode a PNG report (bytes) in memory into vtkImageData, the first row is the top of the image"""
+    data = bytes(data)
+    reader = vtk.vtkPNGReader()
+    reader.SetMemoryBuffer(data)
+    reader.SetMemoryBufferLength(len(data))
+    reader.SetFileLowerLeft(True)
+    reader.Update()
+    if reader.GetErrorCode() or reader.GetOutput().GetNumberOfPoints() == 0:
+        raise ValueError("Failed to decode the PNG report.")
+    # Detach the image from the reader and its memory buffer
+    imageData = vtk.vtkImageData()
+    imageData.DeepCopy(reader.GetOutput())
+    return imageData
+
+
+class ReportVolumes:
+    """Volume nodes of PNG reports shown in the slice views, one node per order.
+
+    Showing the report of an order again reuses its node. Once more than maxCount nodes or
+    more than maxMemory bytes of image data are in the scene, the least recently shown nodes
+    are removed (the last shown node is always kept).
+    """
+
+    def __init__(self, scene, maxCount=10, maxMemory=512 * 2**20):
+        self.scene = scene
+        self.maxCount = max(1, int(maxCount))
+        self.maxMemory = int(maxMemory)
+        self._nodeIds = collections.OrderedDict()  # orderId -> node ID, least recently shown first
+
+    def setLimits(self, maxCount, maxMemory):
+        self.maxCount = max(1, int(maxCount))
+        self.maxMemory = int(maxMemory)
+        self._evict()
+
+    def node(self, orderId):
+        """Volume node of the report of an order, None if it is not in the scene (anymore)"""
+        nodeId = self._nodeIds.get(orderId)
+        if nodeId is None:
+            return None
+        node = self.scene.GetNodeByID(nodeId)
+        # The user may have removed the node, or closed the scene and node IDs were reused
+        if node is None or node.GetAttribute(ORDER_ATTRIBUTE) != orderId:
+            del self._nodeIds[orderId]
+            return None
+        return node
+
+    def show(self, orderId, data=None):
+        """Volume node of the report of an order, created from the PNG bytes if needed"""
+        node = self.node(orderId)
+        if node is None:
+            if data is None:
+                raise ValueError(f"Report of order {orderId} is not loaded.")
+            node = self._createNode(orderId, decodeVolume(data))
+            self._nodeIds[orderId] = node.GetID()
+        self._nodeIds.move_to_end(orderId)
+        self._evict()
+        return node
+
+    def _createNode(self, orderId, imageData):
+        className = "vtkMRMLVectorVolumeNode" if imageData.GetNumberOfScalarComponents() > 1 else "vtkMRMLScalarVolumeNode"
+        node = self.scene.AddNewNodeByClass(className, f"neuropacs report {orderId}")
+        node.SetAttribute(ORDER_ATTRIBUTE, orderId)
+        # Same orientation as PNG files loaded by Slicer
+        node.SetIJKToRASDirections(-1, 0, 0, 0, -1, 0, 0, 0, 1)
+        node.SetAndObserveImageData(imageData)
+        node.CreateDefaultDisplayNodes()
+        return node
+
+    def memorySize(self):
+        """Bytes of image data of the report volumes in the scene"""
+        size = 0
+        for orderId in list(self._nodeIds):
+            node = self.node(orderId)
+            if node is not None and node.GetImageData() is not None:
+                size += node.GetImageData().GetActualMemorySize() * 1024
+        return size
+
+    def _evict(self):
+        while len(self._nodeIds) > 1 and (len(self._nodeIds) > self.maxCount or self.memorySize() > self.maxMemory):
+            self.removeOrders([next(iter(self._nodeIds))])
+
+    def removeOrders(self, orderIds):
+        """Remove the report volumes of orders from the scene"""
+        for orderId in orderIds:
+            node = self.node(orderId)
+            self._nodeIds.pop(orderId, None)
+            if node is not None:
+                logging.debug(f"Removing report volume of order {orderId}")
+                self.scene.RemoveNode(node)
+
+    def clear(self):
+        self.removeOrders(list(self._nodeIds))
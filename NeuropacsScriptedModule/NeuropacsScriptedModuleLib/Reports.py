@@ -0,0 +1,382 @@
+import collections
+import hashlib
+import io
+import logging
+import os
+import threading
+import uuid
+
+import qt
+
+from .Jobs import JobCancelled, JobEngine
+
+# Report formats offered by neuropacs
+REPORT_FORMATS = ("png", "txt", "json", "xml")
+TEXT_FORMATS = ("txt", "json", "xml")
+
+# Report download stages
+DOWNLOAD_FETCHING = "fetching"
+DOWNLOAD_WRITING = "writing"
+DOWNLOAD_DONE = "done"
+DOWNLOAD_FAILED = "failed"
+DOWNLOAD_CANCELLED = "cancelled"
+
+# Smallest report cache offered in the settings, in bytes
+MIN_REPORT_CACHE_SIZE = 50 * 2**20
+
+
+def reportData(results):
+    """Report returned by the neuropacs client as a bytes-like object, without copying it"""
+    if isinstance(results, io.BytesIO):
+        return results.getbuffer()
+    if isinstance(results, (bytes, bytearray, memoryview)):
+        return results
+    return str(results).encode("utf-8")
+
+
+def writeChunked(data, path, onProgress=None, checkCancelled=None, chunkSize=2**20):
+    """Write data to path in chunks, returns its SHA-256.
+
+    The data is written to a temporary file next to path that replaces path once complete,
+    so that an interrupted write never leaves a truncated report behind.
+    """
+    data = memoryview(data).cast("B")
+    digest = hashlib.sha256()
+    partialPath = path + ".part"
+    try:
+        with open(partialPath, "wb") as file:
+            for offset in range(0, len(data), chunkSize):
+                if checkCancelled:
+                    checkCancelled()
+                chunk = data[offset:offset + chunkSize]
+                file.write(chunk)
+                digest.update(chunk)
+                if onProgress:
+                    onProgress(offset + len(chunk), len(data))
+        os.replace(partialPath, path)
+    except BaseException:
+        if os.path.exists(partialPath):
+            os.remove(partialPath)
+        raise
+    finally:
+        data.release()
+    return digest.hexdigest()
+
+
+def copyChunked(sourcePath, path, onProgress=None, checkCancelled=None, chunkSize=2**20):
+    """Copy a file in chunks, returns its SHA-256 (see writeChunked)"""
+    digest = hashlib.sha256()
+    total = os.path.getsize(sourcePath)
+    done = 0
+    partialPath = path + ".part"
+    try:
+        with open(sourcePath, "rb") as source, open(partialPath, "wb") as file:
+            for chunk in iter(lambda: source.read(chunkSize), b""):
+                if checkCancelled:
+                    checkCancelled()
+                file.write(chunk)
+                digest.update(chunk)
+                done += len(chunk)
+                if onProgress:
+                    onProgress(done, total)
+        os.replace(partialPath, path)
+    except BaseException:
+        if os.path.exists(partialPath):
+            os.remove(partialPath)
+        raise
+    return digest.hexdigest()
+
+
+class ReportCache:
+    """Content-addressed cache of downloaded reports, keyed by order and format.
+
+    Report files are named by their SHA-256 in the cache directory, the index (with the
+    time each report was last used) is kept in the order store. Once the reports take more
+    than maxSize bytes the least recently used ones are evicted.
+
+    Report files returned with pin=True are never evicted or deleted until they are released
+    (see release()), so they can be read while other reports are added to the cache.
+
+    onAdded(orderId, format, path) is called (in the thread that added the report) for every
+    report added to the cache.
+    """
+
+    def __init__(self, directory, store, maxSize, onAdded=None):
+        self.directory = directory
+        self.store = store
+        self.maxSize = maxSize
+        self.onAdded = onAdded
+        self._lock = threading.RLock()
+        # Pin count of report files in use, by SHA-256
+        self._pins = collections.Counter()
+        # Pinned report files removed from the index, deleted once released
+        self._orphans = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def _blobPath(self, sha256):
+        return os.path.join(self.directory, sha256)
+
+    def get(self, orderId, format, touch=True, pin=False):
+        """Path of the cached report, None if it is not cached"""
+        with self._lock:
+            entry = self.store.cachedReport(orderId, format)
+            if entry is None:
+                return None
+            path = self._blobPath(entry["sha256"])
+            if not os.path.isfile(path):
+                self.store.deleteCachedReports([(orderId, format)])
+                return None
+            if touch:
+                self.store.touchCachedReport(orderId, format)
+            if pin:
+                self._pins[entry["sha256"]] += 1
+            return path
+
+    def put(self, orderId, format, data, onProgress=None, checkCancelled=None, pin=False):
+        """Add a report (bytes-like), returns the path of the cached file"""
+        incomingPath = os.path.join(self.directory, f".incoming-{uuid.uuid4().hex}")
+        sha256 = writeChunked(data, incomingPath, onProgress, checkCancelled)
+        with self._lock:
+            path = self._blobPath(sha256)
+            if os.path.isfile(path):
+                os.remove(incomingPath)
+            else:
+                os.replace(incomingPath, path)
+            self._orphans.discard(sha256)
+            # The new report is not evicted before onAdded and the caller are done with it
+            self._pins[sha256] += 1
+            self.store.addCachedReport(orderId, format, sha256, os.path.getsize(path))
+            self._evict()
+        try:
+            if self.onAdded:
+                try:
+                    self.onAdded(orderId, format, path)
+                except Exception as e:
+                    logging.error(f"Failed to process {format} report of order {orderId}: {str(e)}")
+        finally:
+            if not pin:
+                self.release(path)
+        return path
+
+    def release(self, path):
+        """Release a report file pinned by get() or put()"""
+        sha256 = os.path.basename(path)
+        with self._lock:
+            if self._pins[sha256] > 1:
+                self._pins[sha256] -= 1
+                return
+            del self._pins[sha256]
+            if sha256 in self._orphans:
+                self._orphans.discard(sha256)
+                self._deleteBlob(sha256)
+            self._evict()
+
+    def setMaxSize(self, maxSize):
+        with self._lock:
+            self.maxSize = maxSize
+            self._evict()
+
+    def removeOrders(self, orderIds):
+        """Drop the cached reports of deleted orders"""
+        with self._lock:
+            keys = [(entry["order_id"], entry["format"]) for entry in self.store.cachedReports() if entry["order_id"] in orderIds]
+            self._remove(keys)
+
+    def _remove(self, keys):
+        for sha256 in self.store.deleteCachedReports(keys):
+            if self._pins[sha256]:
+                self._orphans.add(sha256)
+            else:
+                self._deleteBlob(sha256)
+
+    def _deleteBlob(self, sha256):
+        try:
+            os.remove(self._blobPath(sha256))
+        except OSError as e:
+            logging.warning(f"Failed to remove cached report {sha256}: {str(e)}")
+
+    def _evict(self):
+        """Remove least recently used reports that are not pinned until the cache fits in maxSize"""
+        entries = self.store.cachedReports()
+        sizes = {entry["sha256"]: entry["size"] for entry in entries}
+        totalSize = sum(sizes.values())
+        evicted = []
+        for entry in entries:
+            if totalSize <= self.maxSize:
+                break
+            key = (entry["order_id"], entry["format"])
+            if self._pins[entry["sha256"]]:
+                continue
+            evicted.append(key)
+            # A file is only freed once no other report refers to the same content
+            if not any(other["sha256"] == entry["sha256"] and (other["order_id"], other["format"]) not in evicted for other in entries):
+                totalSize -= sizes[entry["sha256"]]
+        if evicted:
+            logging.info(f"Evicting {len(evicted)} reports from the report cache")
+            self._remove(evicted)
+
+
+class ReportDownloadJob:
+    """Download a report of an order to a file in a worker thread (see JobEngine).
+
+    The neuropacs client returns the decrypted report as a whole, it is written to the file
+    in chunks and released right after. bytesDone and bytesTotal track the writing.
+
+    If a cache is given (see ReportCache), cached reports are copied from there without any
+    request and downloaded reports are added to it. path may be None to only fill the cache,
+    it is then set to the cached file, which stays pinned in the cache until release() is called.
+    """
+
+    def __init__(self, npcs, orderId, format, path, cache=None):
+        self.npcs = npcs
+        self.cache = cache
+        self.orderId = orderId
+        self.format = format
+        self.path = path
+        self.fromCache = False
+        self.stage = DOWNLOAD_FETCHING
+        self.bytesDone = 0
+        self.bytesTotal = 0
+        self.sha256 = None
+        self.error = None
+        self._pinnedPath = None
+        self._cancelRequested = threading.Event()
+
+    def release(self):
+        """Let the cache evict the report file once it has been read (only needed if path was None)"""
+        pinnedPath, self._pinnedPath = self._pinnedPath, None
+        if pinnedPath is not None:
+            self.cache.release(pinnedPath)
+
+    def cancel(self):
+        self._cancelRequested.set()
+
+    def _checkCancelled(self):
+        if self._cancelRequested.is_set():
+            raise JobCancelled()
+
+    def progressPercent(self):
+        return int(100 * self.bytesDone / self.bytesTotal) if self.bytesTotal else 0
+
+    def statusText(self):
+        if self.stage == DOWNLOAD_FETCHING:
+            return f"Downloading report of order {self.orderId}..."
+        if self.stage == DOWNLOAD_WRITING:
+            return f"Saving report ({self.bytesDone / 2**20:.1f} / {self.bytesTotal / 2**20:.1f} MB)"
+        if self.stage == DOWNLOAD_FAILED:
+            return f"Failed: {self.error}"
+        return ""
+
+    def _onWriteProgress(self, bytesDone, bytesTotal):
+        self.bytesDone = bytesDone
+        self.bytesTotal = bytesTotal
+
+    def run(self):
+        try:
+            self._checkCancelled()
+            cachedPath = self.cache.get(self.orderId, self.format, pin=True) if self.cache is not None else None
+            self._pinnedPath = cachedPath
+            self.fromCache = cachedPath is not None
+            if cachedPath is None:
+                results = self.npcs.get_results(self.orderId, self.format)
+                self._checkCancelled()
+                self.stage = DOWNLOAD_WRITING
+                if self.cache is not None:
+                    cachedPath = self.cache.put(self.orderId, self.format, reportData(results), self._onWriteProgress, self._checkCancelled, pin=True)
+                    self._pinnedPath = cachedPath
+                else:
+                    self.sha256 = writeChunked(reportData(results), self.path, self._onWriteProgress, self._checkCancelled)
+                del results
+
+            if cachedPath is not None:
+                if self.path is None:
+                    self.path = cachedPath
+                    self.sha256 = os.path.basename(cachedPath)
+                else:
+                    self.stage = DOWNLOAD_WRITING
+                    self.sha256 = copyChunked(cachedPath, self.path, self._onWriteProgress, self._checkCancelled)
+                    self.release()
+            logging.info(f"Report of order {self.orderId} saved to '{self.path}' (sha256 {self.sha256})")
+            self.stage = DOWNLOAD_DONE
+        except Exception as e:
+            self.release()
+            if self._cancelRequested.is_set():
+                self.stage = DOWNLOAD_CANCELLED
+            else:
+                self.error = str(e)
+                self.stage = DOWNLOAD_FAILED
+                logging.error(f"Failed to download report of order {self.orderId}: {str(e)}")
+        return self
+
+
+class ReportPrefetcher:
+    """Downloads the reports of completed orders into the report cache, one at a time.
+
+    Prefetching is paused while isBusy() returns True (for example while the user downloads
+    a report) and reports that are cached already are skipped. getClient() and getCache()
+    return the current neuropacs client and ReportCache.
+    """
+
+    def __init__(self, getClient, getCache, formats=REPORT_FORMATS, isBusy=None, retryInterval=2000):
+        self.getClient = getClient
+        self.getCache = getCache
+        self.formats = list(formats)
+        self.isBusy = isBusy
+        self.enabled = False
+        self.engine = JobEngine(maxWorkers=1)
+        self._pending = collections.deque()
+        self.timer = qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(retryInterval)
+        self.timer.timeout.connect(self._schedule)
+
+    def setEnabled(self, enabled):
+        self.enabled = bool(enabled)
+        if self.enabled:
+            self._schedule()
+        else:
+            self._pending.clear()
+
+    def setFormats(self, formats):
+        self.formats = list(formats)
+
+    def enqueue(self, orderIds):
+        """Prefetch the reports of orders that just completed"""
+        if not self.enabled:
+            return
+        for orderId in orderIds:
+            for format in self.formats:
+                if (orderId, format) not in self._pending:
+                    self._pending.append((orderId, format))
+        self._schedule()
+
+    def pendingCount(self):
+        return len(self._pending) + len(self.engine.activeJobs())
+
+    def shutdown(self):
+        self.timer.stop()
+        self._pending.clear()
+        self.engine.cancelAll()
+        self.engine.shutdown()
+
+    def _schedule(self):
+        if not self.enabled or self.engine.activeJobs() or not self._pending:
+            return
+        if self.isBusy and self.isBusy():
+            self.timer.start()
+            return
+        npcs = self.getClient()
+        cache = self.getCache()
+        if npcs is None or cache is None:
+            return
+        while self._pending:
+            orderId, format = self._pending.popleft()
+            if cache.store.cachedReport(orderId, format) is None:
+                self.engine.submit(ReportDownloadJob(npcs, orderId, format, None, cache=cache), onFinished=self._onFinished)
+                return
+
+    def _onFinished(self, job):
+        job.release()
+        if job.stage == DOWNLOAD_DONE:
+            logging.info(f"Prefetched {job.format} report of order {job.orderId}")
+        self._schedule()
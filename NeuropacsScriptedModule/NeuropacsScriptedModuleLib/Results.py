@@ -0,0 +1,158 @@
+import csv
+import json
+import logging
+import numbers
+
+# Columns of the results table before the report keys
+ORDER_COLUMNS = ["order_id", "patient"]
+
+# Comparison operators supported by ResultsTable.filterOrders
+FILTER_OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "contains")
+
+
+def flattenReport(value, prefix=""):
+    """Flatten a parsed JSON report into a list of (key, value).
+
+    Keys of nested objects are joined with "." and list items get their index, for example
+    {"results": {"scores": [0.1, 0.9]}} becomes [("results.scores[0]", 0.1), ("results.scores[1]", 0.9)].
+    """
+    if isinstance(value, dict):
+        items = []
+        for key, item in value.items():
+            items.extend(flattenReport(item, f"{prefix}.{key}" if prefix else str(key)))
+        return items
+    if isinstance(value, list):
+        items = []
+        for index, item in enumerate(value):
+            items.extend(flattenReport(item, f"{prefix}[{index}]"))
+        return items
+    return [(prefix or "value", value)]
+
+
+def _numberValue(value):
+    """Numeric value of a report value (numbers may be written as strings), None if not numeric"""
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, numbers.Number):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip().rstrip("%"))
+        except ValueError:
+            return None
+    return None
+
+
+class ResultsTable:
+    """Results of JSON reports, one row per order and one column per flattened report key.
+
+    The values are kept in the order store (indexed by key and value), so that filters and
+    summaries are answered by SQLite queries. columns() returns the table column by column,
+    ready for numpy.array or pandas.DataFrame.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def addReport(self, orderId, report):
+        """Store the results of a JSON report, given as text or parsed"""
+        if isinstance(report, (bytes, bytearray, memoryview)):
+            report = bytes(report).decode("utf-8")
+        if isinstance(report, str):
+            report = json.loads(report)
+        items = [(key, None if value is None else str(value), _numberValue(value)) for key, value in flattenReport(report)]
+        self.store.setResults(orderId, items)
+        return len(items)
+
+    def addReportFile(self, orderId, path):
+        with open(path, "r", encoding="utf-8") as reportFile:
+            return self.addReport(orderId, reportFile.read())
+
+    def addCachedReports(self, cache):
+        """Add the results of cached JSON reports of orders without results, returns the number of reports added"""
+        added = 0
+        for entry in self.store.cachedReports():
+            if entry["format"] != "json" or self.hasResults(entry["order_id"]):
+                continue
+            path = cache.get(entry["order_id"], "json", touch=False, pin=True)
+            if path is None:
+                continue
+            try:
+                self.addReportFile(entry["order_id"], path)
+                added += 1
+            except Exception as e:
+                logging.warning(f"Failed to read results of order {entry['order_id']}: {str(e)}")
+            finally:
+                cache.release(path)
+        return added
+
+    def hasResults(self, orderId):
+        return self.store.hasResults(orderId)
+
+    def orderIds(self):
+        return self.store.resultOrderIds()
+
+    def keys(self):
+        return self.store.resultKeys()
+
+    def columns(self, orderIds=None, keys=None, numbers=True):
+        """Results as a dict of column name to list of values (None where an order has no value).
+
+        Numeric values are returned as floats, other values as strings. All values are returned
+        as their text in the report if numbers is False.
+        """
+        if orderIds is None:
+            orderIds = self.orderIds()
+        if keys is None:
+            keys = self.keys()
+        rowOfOrder = {orderId: row for row, orderId in enumerate(orderIds)}
+        columns = dict(zip(ORDER_COLUMNS, (list(orderIds), [self.store.patient(orderId) for orderId in orderIds])))
+        # Report keys named like the order columns are prefixed
+        columnOfKey = {key: f"report.{key}" if key in ORDER_COLUMNS else key for key in keys}
+        for key in keys:
+            columns[columnOfKey[key]] = [None] * len(orderIds)
+        for orderId, key, text, number in self.store.resultValues(orderIds, keys):
+            columns[columnOfKey[key]][rowOfOrder[orderId]] = text if number is None or not numbers else number
+        return columns
+
+    def filterOrders(self, key, operator, value):
+        """Orders whose result for key compares to value, for example ("results.diagnosis", "=", "PSP")"""
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator '{operator}'.")
+        return self.store.filterResults(key, operator, value, _numberValue(value))
+
+    def summary(self, key, orderIds=None):
+        """Summary of one result: count, min, max and mean of numeric values and the count of each text value"""
+        return self.store.resultSummary(key, orderIds)
+
+    def writeCsv(self, path, orderIds=None):
+        columns = self.columns(orderIds)
+        names = list(columns)
+        with open(path, "w", newline="", encoding="utf-8") as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(names)
+            writer.writerows(zip(*(columns[name] for name in names)))
+        logging.info(f"Results of {len(columns['order_id'])} orders written to '{path}'")
+
+    def writeParquet(self, path, orderIds=None):
+        """Write the results as a Parquet file, requires pandas and pyarrow.
+
+        Parquet columns have a single type: columns with only numeric values are written as
+        floats (NaN where an order has no value), other columns as the text of their values.
+        """
+        import pandas
+        columns = self.columns(orderIds)
+        texts = None
+        data = {}
+        for name, values in columns.items():
+            if all(value is None or isinstance(value, float) for value in values):
+                data[name] = pandas.Series(values, dtype="float64")
+                continue
+            if texts is None:
+                texts = self.columns(orderIds, numbers=False)
+            data[name] = pandas.Series(texts[name], dtype="object")
+        try:
+            pandas.DataFrame(data).to_parquet(path, index=False)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Results could not be written as a Parquet file: {str(e)}") from e
+        logging.info(f"Results of {len(columns['order_id'])} orders written to '{path}'")
@@ -0,0 +1,147 @@
+import importlib.util
+
+import qt
+import slicer
+
+from .Results import FILTER_OPERATORS
+
+
+class ResultsTableModel(qt.QAbstractTableModel):
+    """Read-only table model of the columns returned by ResultsTable.columns()"""
+
+    def __init__(self, parent=None):
+        qt.QAbstractTableModel.__init__(self, parent)
+        self._names = []
+        self._columns = {}
+        self._rowCount = 0
+
+    def rowCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else self._rowCount
+
+    def columnCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(self._names)
+
+    def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+        if orientation == qt.Qt.Horizontal and role == qt.Qt.DisplayRole and 0 <= section < len(self._names):
+            return self._names[section]
+        return None
+
+    def data(self, index, role=qt.Qt.DisplayRole):
+        if not index.isValid() or role not in (qt.Qt.DisplayRole, qt.Qt.ToolTipRole):
+            return None
+        value = self._columns[self._names[index.column()]][index.row()]
+        if value is None:
+            return ""
+        if isinstance(value, float):
+            return f"{value:g}"
+        return str(value)
+
+    def setColumns(self, columns):
+        self.beginResetModel()
+        self._names = list(columns)
+        self._columns = columns
+        self._rowCount = len(columns["order_id"]) if columns else 0
+        self.endResetModel()
+
+
+class ResultsDialog(qt.QDialog):
+    """Cohort results of the JSON reports with filtering, summaries and export"""
+
+    def __init__(self, resultsTable, parent=None):
+        qt.QDialog.__init__(self, parent)
+        self.resultsTable = resultsTable
+        self.orderIds = None  # None shows all orders
+        self.setWindowTitle("neuropacs cohort results")
+        self.resize(900, 500)
+        layout = qt.QVBoxLayout(self)
+
+        # Filter
+        filterLayout = qt.QHBoxLayout()
+        self.keyComboBox = qt.QComboBox()
+        self.keyComboBox.addItems(resultsTable.keys())
+        self.keyComboBox.currentIndexChanged.connect(self.updateSummary)
+        filterLayout.addWidget(self.keyComboBox, 1)
+        self.operatorComboBox = qt.QComboBox()
+        self.operatorComboBox.addItems(list(FILTER_OPERATORS))
+        filterLayout.addWidget(self.operatorComboBox)
+        self.valueLineEdit = qt.QLineEdit()
+        self.valueLineEdit.placeholderText = "Value"
+        self.valueLineEdit.returnPressed.connect(self.applyFilter)
+        filterLayout.addWidget(self.valueLineEdit, 1)
+        filterButton = qt.QPushButton("Filter")
+        filterButton.clicked.connect(self.applyFilter)
+        filterLayout.addWidget(filterButton)
+        clearButton = qt.QPushButton("Show all")
+        clearButton.clicked.connect(self.clearFilter)
+        filterLayout.addWidget(clearButton)
+        layout.addLayout(filterLayout)
+
+        self.summaryLabel = qt.QLabel()
+        self.summaryLabel.wordWrap = True
+        layout.addWidget(self.summaryLabel)
+
+        self.model = ResultsTableModel(self)
+        self.tableView = qt.QTableView()
+        self.tableView.setModel(self.model)
+        self.tableView.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.tableView.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+        layout.addWidget(self.tableView)
+
+        # Export
+        buttonLayout = qt.QHBoxLayout()
+        buttonLayout.addStretch(1)
+        csvButton = qt.QPushButton("Export CSV...")
+        csvButton.clicked.connect(self.exportCsv)
+        buttonLayout.addWidget(csvButton)
+        parquetButton = qt.QPushButton("Export Parquet...")
+        parquetButton.clicked.connect(self.exportParquet)
+        buttonLayout.addWidget(parquetButton)
+        closeButton = qt.QPushButton("Close")
+        closeButton.clicked.connect(self.accept)
+        buttonLayout.addWidget(closeButton)
+        layout.addLayout(buttonLayout)
+
+        self.updateTable()
+
+    def updateTable(self):
+        self.model.setColumns(self.resultsTable.columns(self.orderIds))
+        self.updateSummary()
+
+    def updateSummary(self):
+        shown = self.model.rowCount()
+        text = f"{shown} orders"
+        key = self.keyComboBox.currentText
+        if key:
+            summary = self.resultsTable.summary(key, self.orderIds)
+            if summary["min"] is not None:
+                text += f" | {key}: min {summary['min']:g}, max {summary['max']:g}, mean {summary['mean']:g}"
+            if summary["values"]:
+                counts = sorted(summary["values"].items(), key=lambda item: -item[1])
+                text += f" | {key}: " + ", ".join(f"{value} ({count})" for value, count in counts[:10])
+        self.summaryLabel.text = text
+
+    def applyFilter(self):
+        with slicer.util.tryWithErrorDisplay("Invalid filter."):
+            self.orderIds = self.resultsTable.filterOrders(
+                self.keyComboBox.currentText, self.operatorComboBox.currentText, self.valueLineEdit.text)
+            self.updateTable()
+
+    def clearFilter(self):
+        self.orderIds = None
+        self.updateTable()
+
+    def exportCsv(self):
+        path = qt.QFileDialog.getSaveFileName(self, "Export Results", "neuropacs_results.csv", "CSV files (*.csv)")
+        if path:
+            with slicer.util.tryWithErrorDisplay("Failed to export results.", waitCursor=True):
+                self.resultsTable.writeCsv(path, self.orderIds)
+
+    def exportParquet(self):
+        if importlib.util.find_spec("pandas") is None or importlib.util.find_spec("pyarrow") is None:
+            if not slicer.util.confirmOkCancelDisplay("Parquet export requires the pandas and pyarrow Python packages. Install them now?"):
+                return
+            slicer.util.pip_install("pandas pyarrow")
+        path = qt.QFileDialog.getSaveFileName(self, "Export Results", "neuropacs_results.parquet", "Parquet files (*.parquet)")
+        if path:
+            with slicer.util.tryWithErrorDisplay("Failed to export results.", waitCursor=True):
+                self.resultsTable.writeParquet(path, self.orderIds)
@@ -0,0 +1,40 @@
+import collections
+import contextlib
+import logging
+import time
+
+
+class StartupTimings:
+    """Durations of the module startup stages, in seconds, in the order they finished.
+
+    Stages running on the GUI thread are measured with measure(), stages that finish later in
+    the background are measured from start() to finish().
+    """
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self._startTimes = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def start(self, stage):
+        self._startTimes[stage] = time.perf_counter()
+
+    def finish(self, stage):
+        """Record a stage begun with start(), ignored if it was not started or is recorded already"""
+        start = self._startTimes.pop(stage, None)
+        if start is not None:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        self.durations[stage] = seconds
+        logging.info(f"neuropacs startup stage '{stage}' took {seconds * 1000:.0f} ms")
+
+    def summary(self):
+        return ", ".join(f"{stage}: {seconds * 1000:.0f} ms" for stage, seconds in self.durations.items())
@@ -0,0 +1,206 @@
+import inspect
+import io
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from .PackageVersion import installedVersion
+
+# Deflate level of the uploaded archives
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+class _MultipartClient:
+    """Access to the multipart upload requests of the neuropacs client.
+
+    The client only exposes whole-folder uploads, the requests used for each zip archive are
+    private methods of the Neuropacs class. They are only used if they take the expected
+    arguments, other neuropacs versions fall back to the whole-folder upload.
+    """
+
+    # Private method name and number of arguments
+    METHODS = {"new_multipart_upload": 3, "upload_part": 6, "complete_multipart_upload": 6}
+
+    def __init__(self, npcs):
+        self.npcs = npcs
+
+    @staticmethod
+    def isSupported(npcs):
+        for name, argumentCount in _MultipartClient.METHODS.items():
+            method = getattr(npcs, "_Neuropacs__" + name, None)
+            if method is None:
+                return False
+            try:
+                inspect.signature(method).bind(*range(argumentCount))
+            except (TypeError, ValueError):
+                return False
+        return True
+
+    def uploadArchive(self, orderId, archiveIndex, data, final):
+        """Upload one zip archive as a single-part multipart upload"""
+        zipIndex = str(archiveIndex)
+        partNumber = archiveIndex + 1
+        uploadId = self.npcs._Neuropacs__new_multipart_upload(orderId, zipIndex, orderId)
+        eTag = self.npcs._Neuropacs__upload_part(uploadId, orderId, zipIndex, orderId, partNumber, data)
+        self.npcs._Neuropacs__complete_multipart_upload(
+            orderId, orderId, zipIndex, uploadId, [{"PartNumber": partNumber, "ETag": eTag}], 1 if final else 0)
+
+
+def uniqueArchiveName(usedNames, filename):
+    """Unique name of a file in the uploaded archives (some scanners produce duplicate file names)"""
+    base, extension = os.path.splitext(filename)
+    name = filename
+    counter = 1
+    while name in usedNames:
+        name = f"{base}_{counter}{extension}"
+        counter += 1
+    usedNames.add(name)
+    return name
+
+
+class _Archive:
+    """A zip archive built in memory, with the files it contains"""
+
+    def __init__(self, index, data, files, final):
+        self.index = index
+        self.data = data
+        self.files = files  # list of (path, name in the archive, size)
+        self.final = final
+
+
+class DatasetUploader:
+    """Upload a list of files to a neuropacs order as a sequence of zip archives.
+
+    The archives are compressed in a separate thread while the previous archive is being
+    uploaded, at most prefetchArchives archives are kept in memory ahead of the upload.
+    compressionLevel is the deflate level (0 stores the files uncompressed, 9 is the smallest).
+
+    If a journal is given, every acknowledged archive is recorded in it so that an
+    interrupted upload only sends the files that were not acknowledged yet. The journal
+    provides acknowledgedUploadFiles(orderId), nextUploadArchiveIndex(orderId) and
+    acknowledgeUploadArchive(orderId, archiveIndex, files) (see OrderStore).
+
+    If the installed neuropacs package does not provide the multipart upload requests, the
+    files are uploaded at once with upload_dataset_from_path, without resuming.
+    """
+
+    prefetchArchives = 1
+
+    def __init__(self, npcs, journal=None, maxArchiveSize=None, compressionLevel=DEFAULT_COMPRESSION_LEVEL):
+        self.npcs = npcs
+        self.journal = journal
+        self.maxArchiveSize = maxArchiveSize or getattr(npcs, "max_zip_size", 15 * 1024 * 1024)
+        self.compressionLevel = max(0, min(9, int(compressionLevel)))
+
+    def upload(self, orderId, files, onProgress=None, checkCancelled=None):
+        """Upload files, a list of (path, size) tuples.
+
+        onProgress(filesDone, bytesDone) is called after each acknowledged archive, files
+        skipped because they were acknowledged earlier count as done. checkCancelled() is
+        called before each file and may raise to abort the upload.
+        """
+        if not _MultipartClient.isSupported(self.npcs):
+            logging.warning(f"neuropacs {installedVersion('neuropacs')} does not support file-level uploads,"
+                            " the dataset is uploaded at once")
+            self._uploadFolder(orderId, files, onProgress, checkCancelled)
+            return
+        client = _MultipartClient(self.npcs)
+
+        acknowledged = self.journal.acknowledgedUploadFiles(orderId) if self.journal is not None else {}
+        archiveIndex = self.journal.nextUploadArchiveIndex(orderId) if self.journal is not None else 0
+        usedNames = set(acknowledged.values())
+
+        remaining = [(path, size) for path, size in files if path not in acknowledged]
+        filesDone = len(files) - len(remaining)
+        bytesDone = sum(size for path, size in files if path in acknowledged)
+        if acknowledged:
+            logging.info(f"Resuming upload of order {orderId}: {filesDone} of {len(files)} files already uploaded")
+        if onProgress:
+            onProgress(filesDone, bytesDone)
+        if not remaining:
+            return
+
+        archives = queue.Queue(maxsize=self.prefetchArchives)
+        stopped = threading.Event()
+        compressor = threading.Thread(
+            target=self._compress, args=(remaining, archiveIndex, usedNames, archives, stopped, checkCancelled),
+            name=f"neuropacs-compress-{orderId}", daemon=True)
+        compressor.start()
+        try:
+            while True:
+                archive = archives.get()
+                if isinstance(archive, BaseException):
+                    raise archive
+                if checkCancelled:
+                    checkCancelled()
+                client.uploadArchive(orderId, archive.index, archive.data, archive.final)
+                if self.journal is not None:
+                    self.journal.acknowledgeUploadArchive(orderId, archive.index, [(path, name) for path, name, _ in archive.files])
+                filesDone += len(archive.files)
+                bytesDone += sum(size for _, _, size in archive.files)
+                if onProgress:
+                    onProgress(filesDone, bytesDone)
+                if archive.final:
+                    break
+        finally:
+            stopped.set()
+            # Unblock the compressor if it waits for room in the queue
+            while compressor.is_alive():
+                try:
+                    archives.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _uploadFolder(self, orderId, files, onProgress, checkCancelled):
+        """Upload files with the public whole-folder upload, from a temporary folder holding only these files"""
+        with tempfile.TemporaryDirectory(prefix="neuropacs-upload-") as folder:
+            usedNames = set()
+            for path, _ in files:
+                if checkCancelled:
+                    checkCancelled()
+                target = os.path.join(folder, uniqueArchiveName(usedNames, os.path.basename(path)))
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copyfile(path, target)
+            if checkCancelled:
+                checkCancelled()
+            self.npcs.upload_dataset_from_path(orderId, folder)
+        if onProgress:
+            onProgress(len(files), sum(size for _, size in files))
+
+    def _newArchive(self):
+        buffer = io.BytesIO()
+        if self.compressionLevel == 0:
+            return buffer, zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED)
+        return buffer, zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=self.compressionLevel)
+
+    def _compress(self, files, archiveIndex, usedNames, archives, stopped, checkCancelled):
+        """Compress files into archives of about maxArchiveSize bytes (runs in the compressor thread)"""
+        try:
+            archiveBuffer, archive = self._newArchive()
+            archiveFiles = []
+            for fileIndex, (path, size) in enumerate(files):
+                if stopped.is_set():
+                    return
+                if checkCancelled:
+                    checkCancelled()
+                name = uniqueArchiveName(usedNames, os.path.basename(path))
+                archive.write(path, name)
+                archiveFiles.append((path, name, size))
+
+                final = fileIndex == len(files) - 1
+                if not final and archiveBuffer.tell() < self.maxArchiveSize:
+                    continue
+
+                archive.close()
+                archives.put(_Archive(archiveIndex, archiveBuffer.getvalue(), archiveFiles, final))
+                archiveIndex += 1
+                archiveBuffer, archive = self._newArchive()
+                archiveFiles = []
+        except BaseException as e:
+            archives.put(e)
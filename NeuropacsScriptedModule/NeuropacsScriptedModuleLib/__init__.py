@@ -0,0 +1,124 @@
+from .Batch import (
+    API_KEY_VARIABLE,
+    DEFAULT_TIMEOUT_HOURS,
+    EXIT_ERROR,
+    EXIT_FAILED,
+    EXIT_OK,
+    EXIT_TIMEOUT,
+    MAX_STATUS_FAILURES,
+    BatchDataset,
+    BatchRun,
+    ProgressLog,
+    directoryDatasets,
+    readStudyList,
+)
+from .Credentials import (
+    KEYRING_SERVICE,
+    SESSION_LIFETIME,
+    ConnectJob,
+    CredentialStore,
+    sessionIsValid,
+)
+from .DatasetIndex import (
+    SERIES_TAGS,
+    DatasetIndex,
+    isDiffusionSeries,
+)
+from .Export import (
+    BulkExportJob,
+    exportFilename,
+)
+from .Fingerprint import (
+    FingerprintJob,
+    datasetFingerprint,
+    fileHash,
+)
+from .Jobs import (
+    STAGE_CANCELLED,
+    STAGE_CREATED,
+    STAGE_CREATING,
+    STAGE_DONE,
+    STAGE_FAILED,
+    STAGE_QUEUED,
+    STAGE_STARTING,
+    STAGE_UPLOADED,
+    STAGE_UPLOADING,
+    JobCancelled,
+    JobEngine,
+    SubmissionJob,
+    SubmissionQueue,
+    datasetFiles,
+    fileSizes,
+)
+from .OrderStatus import (
+    STATE_CANCELLED,
+    STATE_COMPLETE,
+    STATE_EXPIRED,
+    STATE_FAILED,
+    StatusFetcher,
+    StatusPoller,
+    terminalState,
+)
+from .OrderStore import (
+    STATE_RUNNING,
+    TERMINAL_STATES,
+    OrderStore,
+)
+from .OrderTable import (
+    COLUMN_DELETE,
+    COLUMN_DOWNLOAD,
+    COLUMN_INFO,
+    COLUMN_ORDER_ID,
+    COLUMN_PATIENT_ID,
+    COLUMN_PROGRESS,
+    ButtonDelegate,
+    OrderTableModel,
+)
+from .PackageVersion import (
+    PYPI_URL,
+    VersionCheckJob,
+    installArguments,
+    installedVersion,
+    isNewer,
+    wheelVersions,
+)
+from .Reports import (
+    DOWNLOAD_CANCELLED,
+    DOWNLOAD_DONE,
+    DOWNLOAD_FAILED,
+    DOWNLOAD_FETCHING,
+    DOWNLOAD_WRITING,
+    MIN_REPORT_CACHE_SIZE,
+    REPORT_FORMATS,
+    TEXT_FORMATS,
+    ReportCache,
+    ReportDownloadJob,
+    ReportPrefetcher,
+    copyChunked,
+    reportData,
+    writeChunked,
+)
+from .ReportViewer import (
+    CHUNKED_LOAD_SIZE,
+    JsonIndenter,
+    ReportImageViewer,
+    ReportSyntaxHighlighter,
+    ReportTextView,
+    ReportViewerDock,
+    decodeImage,
+)
+from .ReportVolumes import (
+    ReportVolumes,
+    decodeVolume,
+)
+from .Results import (
+    FILTER_OPERATORS,
+    ResultsTable,
+    flattenReport,
+)
+from .ResultsDialog import (
+    ResultsDialog,
+    ResultsTableModel,
+)
+from .Startup import StartupTimings
+from .Upload import DEFAULT_COMPRESSION_LEVEL, DatasetUploader
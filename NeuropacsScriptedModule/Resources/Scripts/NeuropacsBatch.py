@@ -0,0 +1,15 @@
+"""Submit studies to neuropacs and export their reports without the Slicer main window.
+
+Example:
+
+    Slicer --no-main-window --python-script NeuropacsBatch.py --studies studies.csv --output reports --log progress.jsonl
+
+Run with --help for all options. Orders are kept in the order store of the neuropacs module,
+so that they are shown in the module afterwards.
+"""
+
+import slicer
+
+from NeuropacsScriptedModuleLib.Batch import main
+
+slicer.util.exit(main())
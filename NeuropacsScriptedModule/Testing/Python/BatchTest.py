@@ -0,0 +1,143 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import qt
+
+from NeuropacsScriptedModuleLib.Batch import (
+    DEFAULT_TIMEOUT_HOURS,
+    EXIT_FAILED,
+    EXIT_OK,
+    EXIT_TIMEOUT,
+    BatchDataset,
+    BatchRun,
+    ProgressLog,
+    parseArguments,
+)
+from NeuropacsScriptedModuleLib.OrderStatus import STATE_COMPLETE, STATE_EXPIRED, STATE_FAILED
+
+
+class FakeSubmissionQueue:
+    maxUploads = 2
+
+    def jobs(self):
+        return []
+
+
+class FakeStatusPoller:
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def poll(self):
+        pass
+
+
+class FakeLogic:
+    """The parts of the module logic used by a batch run without pending datasets"""
+
+    def __init__(self):
+        self.onQueueChanged = None
+        self.onOrderStarted = None
+        self.onStatuses = None
+        self.submissionQueue = FakeSubmissionQueue()
+        self.statusPoller = FakeStatusPoller()
+
+
+class FakeExportJob:
+
+    def __init__(self, error=None, failed=()):
+        self.error = error
+        self.failed = list(failed)
+
+
+class BatchRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logPath = os.path.join(self.directory, "progress.jsonl")
+        self.log = ProgressLog(self.logPath)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def events(self):
+        self.log.close()
+        with open(self.logPath, encoding="utf-8") as logFile:
+            return [json.loads(line) for line in logFile]
+
+    def createRun(self, count=2, **kwargs):
+        datasets = [BatchDataset(f"p{index}", f"/data/p{index}") for index in range(count)]
+        for index, dataset in enumerate(datasets):
+            dataset.orderId = f"o{index}"
+        run = BatchRun(FakeLogic(), datasets, self.log, **kwargs)
+        run._loop = qt.QEventLoop()
+        return run
+
+    def test_exitCodes(self):
+        run = self.createRun()
+        for dataset in run.datasets:
+            dataset.state = STATE_COMPLETE
+        self.assertEqual(run._summarize(), EXIT_OK)
+        run.exportJob = FakeExportJob(failed=[("o1", "png", "Not found")])
+        self.assertEqual(run._summarize(), EXIT_FAILED)
+        run.exportJob = FakeExportJob()
+        run.datasets[1].state = STATE_EXPIRED
+        self.assertEqual(run._summarize(), EXIT_FAILED)
+        run.datasets[1].state = None
+        run.timedOut = True
+        self.assertEqual(run._summarize(), EXIT_TIMEOUT)
+        done = self.events()[-1]
+        self.assertEqual((done["event"], done["states"], done["exit_code"]), ("done", {STATE_COMPLETE: 1, "running": 1}, EXIT_TIMEOUT))
+
+    def test_skippedDatasets(self):
+        run = self.createRun()
+        for dataset in run.datasets:
+            dataset.state = STATE_FAILED
+            dataset.error = "Study not found in the DICOM database."
+        self.assertEqual(run.run(), EXIT_FAILED)
+        self.assertEqual([event["event"] for event in self.events()], ["start", "skipped", "skipped", "done"])
+
+    def test_statusFailures(self):
+        run = self.createRun(maxStatusFailures=3)
+        error = TimeoutError("timed out")
+        for _ in range(2):
+            run._onStatuses({"o0": (None, error), "o1": (None, error)})
+        # A successful check resets the count
+        run._onStatuses({"o0": (None, error), "o1": ({"info": "Running", "progress": 50}, None)})
+        run._onStatuses({"o1": (None, error)})
+        self.assertEqual(run.datasets[0].state, STATE_FAILED)
+        self.assertIn("Status unavailable after 3 attempts", run.datasets[0].error)
+        self.assertIsNone(run.datasets[1].state)
+        self.assertEqual(run.datasets[1].statusFailures, 1)
+        run.datasets[1].state = STATE_COMPLETE
+        self.assertEqual(run._summarize(), EXIT_FAILED)
+        failed = [event for event in self.events() if event["event"] == "failed"]
+        self.assertEqual([event["order_id"] for event in failed], ["o0"])
+
+    def test_expiredOrder(self):
+        run = self.createRun(count=1)
+        run._onStatuses({"o0": (None, Exception("Bucket not found"))})
+        self.assertEqual(run.datasets[0].state, STATE_EXPIRED)
+
+
+class ParseArgumentsTest(unittest.TestCase):
+
+    def test_defaults(self):
+        args = parseArguments(["--directory", "/data"])
+        self.assertEqual(args.timeout, DEFAULT_TIMEOUT_HOURS)
+        self.assertEqual(args.max_status_failures, 10)
+        self.assertEqual(args.formats, ["png", "txt", "json", "xml"])
+
+    def test_formats(self):
+        self.assertEqual(parseArguments(["--directory", "/data", "--formats", "PNG, json"]).formats, ["png", "json"])
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            parseArguments(["--directory", "/data", "--formats", "pdf"])
@@ -0,0 +1,108 @@
+import importlib.util
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from NeuropacsScriptedModuleLib import Credentials
+from NeuropacsScriptedModuleLib.Credentials import ConnectJob, CredentialStore, sessionIsValid
+
+
+class FakeClient:
+
+    def __init__(self, apiKey):
+        self.apiKey = apiKey
+        self.connection_id = None
+        self.aes_key = None
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        self.connection_id = f"connection {self.connections}"
+        self.aes_key = "new key"
+
+
+def credentials(connected=None, connectionId="stored connection"):
+    return {"api_key": "key", "connection_id": connectionId, "aes_key": "stored key",
+            "connected": time.time() if connected is None else connected}
+
+
+class ConnectJobTest(unittest.TestCase):
+
+    def test_sessionIsValid(self):
+        self.assertTrue(sessionIsValid(credentials()))
+        self.assertFalse(sessionIsValid(credentials(connected=time.time() - Credentials.SESSION_LIFETIME - 1)))
+        self.assertFalse(sessionIsValid(credentials(connectionId=None)))
+
+    def test_reused(self):
+        validated = []
+        job = ConnectJob(FakeClient, credentials(), validate=validated.append).run()
+        self.assertIsNone(job.error)
+        self.assertTrue(job.reused)
+        self.assertEqual(job.npcs.connections, 0)
+        self.assertEqual((job.npcs.connection_id, job.npcs.aes_key), ("stored connection", "stored key"))
+        self.assertEqual(validated, [job.npcs])
+
+    def test_rejectedSession(self):
+        def validate(npcs):
+            raise RuntimeError("Unauthorized")
+
+        job = ConnectJob(FakeClient, credentials(), validate=validate).run()
+        self.assertIsNone(job.error)
+        self.assertFalse(job.reused)
+        self.assertEqual(job.npcs.connections, 1)
+        self.assertEqual(job.npcs.connection_id, "connection 1")
+
+    def test_expiredSession(self):
+        validated = []
+        job = ConnectJob(FakeClient, credentials(connected=0), validate=validated.append).run()
+        self.assertFalse(job.reused)
+        self.assertEqual(job.npcs.connections, 1)
+        self.assertEqual(validated, [])
+
+    def test_connectFails(self):
+        class FailingClient(FakeClient):
+            def connect(self):
+                raise RuntimeError("Invalid API key")
+
+        job = ConnectJob(FailingClient, credentials(connected=0)).run()
+        self.assertIsNone(job.npcs)
+        self.assertEqual(job.error, "Invalid API key")
+
+
+@unittest.skipUnless(importlib.util.find_spec("cryptography") is not None, "requires cryptography")
+class FileCredentialStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = CredentialStore(os.path.join(self.directory, "slicer_neuropacs.credentials"))
+        patcher = mock.patch.object(Credentials, "_keyring", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_saveAndLoad(self):
+        self.assertEqual(self.store.backend(), "file")
+        self.assertIsNone(self.store.load())
+        self.store.save("secret-api-key", "connection", "aes")
+        loaded = self.store.load()
+        self.assertEqual((loaded["api_key"], loaded["connection_id"], loaded["aes_key"]), ("secret-api-key", "connection", "aes"))
+        with open(self.store.path, "rb") as dataFile:
+            self.assertNotIn(b"secret-api-key", dataFile.read())
+
+    @unittest.skipIf(os.name == "nt", "POSIX file permissions")
+    def test_privateFiles(self):
+        self.store.save("key")
+        for path in (self.store.path, self.store.path + ".key"):
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+    def test_clear(self):
+        self.store.save("key")
+        self.store.clear()
+        self.assertIsNone(self.store.load())
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,231 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from NeuropacsScriptedModuleLib.DatasetIndex import (
+    TAG_DIFFUSION_B_VALUE,
+    TAG_IMAGE_TYPE,
+    TAG_MODALITY,
+    TAG_SERIES_DESCRIPTION,
+    DatasetIndex,
+    isDiffusionSeries,
+)
+from NeuropacsScriptedModuleLib.OrderStore import OrderStore
+
+DWI_TAGS = {TAG_MODALITY: "MR", TAG_IMAGE_TYPE: "ORIGINAL\\PRIMARY", TAG_SERIES_DESCRIPTION: "ep2d_diff"}
+T1_TAGS = {TAG_MODALITY: "MR", TAG_IMAGE_TYPE: "ORIGINAL\\PRIMARY", TAG_SERIES_DESCRIPTION: "t1_mprage"}
+
+
+class FakeDicomDatabase:
+    """The parts of ctkDICOMDatabase used by DatasetIndex, series are added and removed by the test"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.databaseFilename = os.path.join(directory, "ctkDICOM.sql")
+        self.isOpen = True
+        self.tagsToPrecache = []
+        self.patientNames = {}
+        self.studies = {}  # studyUid -> patientUid
+        self.series = {}  # seriesUid -> (studyUid, files, tags)
+
+    def addSeries(self, patientUid, studyUid, seriesUid, tags, fileCount=2):
+        self.patientNames[patientUid] = f"name of {patientUid}"
+        self.studies[studyUid] = patientUid
+        folder = os.path.join(self.directory, studyUid, seriesUid)
+        files = [os.path.join(folder, f"{index}.dcm") for index in range(fileCount)]
+        self.series[seriesUid] = (studyUid, files, tags)
+
+    def removeSeries(self, seriesUid):
+        del self.series[seriesUid]
+
+    def removeStudy(self, studyUid):
+        for seriesUid in self.seriesForStudy(studyUid):
+            self.removeSeries(seriesUid)
+        del self.studies[studyUid]
+
+    def patients(self):
+        return sorted(self.patientNames)
+
+    def nameForPatient(self, patientUid):
+        return self.patientNames[patientUid]
+
+    def studiesForPatient(self, patientUid):
+        return [studyUid for studyUid, patient in self.studies.items() if patient == patientUid]
+
+    def patientForStudy(self, studyUid):
+        return self.studies[studyUid]
+
+    def seriesForStudy(self, studyUid):
+        return [seriesUid for seriesUid, (study, _, _) in self.series.items() if study == studyUid]
+
+    def studyForSeries(self, seriesUid):
+        return self.series[seriesUid][0]
+
+    def filesForSeries(self, seriesUid, hits=-1):
+        files = self.series[seriesUid][1]
+        return files if hits < 0 else files[:hits]
+
+    def fileValue(self, path, tag):
+        for _, files, tags in self.series.values():
+            if path in files:
+                return tags.get(tag, "")
+        return ""
+
+
+class IsDiffusionSeriesTest(unittest.TestCase):
+
+    def test_description(self):
+        self.assertTrue(isDiffusionSeries(DWI_TAGS))
+        for description in ("DTI 64 directions", "ax DWI", "Trace", "dw b1000"):
+            self.assertTrue(isDiffusionSeries(dict(DWI_TAGS, **{TAG_SERIES_DESCRIPTION: description})), description)
+        self.assertFalse(isDiffusionSeries(T1_TAGS))
+
+    def test_bValue(self):
+        tags = dict(T1_TAGS, **{TAG_SERIES_DESCRIPTION: "sequence 7", TAG_DIFFUSION_B_VALUE: "1000"})
+        self.assertTrue(isDiffusionSeries(tags))
+        # Siemens private b-value tag
+        self.assertTrue(isDiffusionSeries(dict(T1_TAGS, **{"0019,100C": "0"})))
+
+    def test_derivedMaps(self):
+        for imageType in ("DERIVED\\PRIMARY\\ADC", "DERIVED\\PRIMARY\\FA", "derived\\primary\\eadc"):
+            self.assertFalse(isDiffusionSeries(dict(DWI_TAGS, **{TAG_IMAGE_TYPE: imageType})), imageType)
+        self.assertTrue(isDiffusionSeries(dict(DWI_TAGS, **{TAG_IMAGE_TYPE: "DERIVED\\PRIMARY\\TRACEW"})))
+
+    def test_modality(self):
+        self.assertFalse(isDiffusionSeries(dict(DWI_TAGS, **{TAG_MODALITY: "CT"})))
+        self.assertFalse(isDiffusionSeries({TAG_SERIES_DESCRIPTION: "ep2d_diff"}))
+        self.assertTrue(isDiffusionSeries(dict(DWI_TAGS, **{TAG_MODALITY: " mr "})))
+
+
+class DatasetIndexTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = FakeDicomDatabase(self.directory)
+        self.store = OrderStore(os.path.join(self.directory, "orders.db"))
+        self.index = DatasetIndex(self.database, self.store)
+
+    def tearDown(self):
+        self.index.timer.stop()
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def runPass(self, force=True):
+        self.index.refresh(force=force)
+        self.processPending()
+
+    def processPending(self):
+        if not self.index.isBuilding():
+            self.index.timer.start()
+        while self.index.isBuilding():
+            self.index._processSlice()
+
+    def seriesOf(self, studyUid):
+        """Diffusion series of an indexed study, as seen by a new index loaded from the store"""
+        row = DatasetIndex(None, self.store).dataset(studyUid)
+        return row["series_uids"].split() if row["series_uids"] else []
+
+
+class ReconcileTest(DatasetIndexTestBase):
+
+    def test_seriesAddedToIndexedStudy(self):
+        self.database.addSeries("p1", "s1", "t1", T1_TAGS)
+        self.runPass()
+        self.assertEqual(self.seriesOf("s1"), [])
+        # Re-import adds the diffusion series
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.runPass()
+        self.assertEqual(self.seriesOf("s1"), ["dwi"])
+        self.assertEqual(self.index.dataset("s1")["dataset_path"], os.path.join(self.directory, "s1", "dwi"))
+        self.assertEqual(self.index.datasetFiles("s1"), self.database.filesForSeries("dwi"))
+
+    def test_seriesRemovedFromIndexedStudy(self):
+        self.database.addSeries("p1", "s1", "t1", T1_TAGS)
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.runPass()
+        self.assertEqual(self.seriesOf("s1"), ["dwi"])
+        self.database.removeSeries("dwi")
+        self.runPass()
+        self.assertEqual(self.seriesOf("s1"), [])
+        self.assertEqual(self.index.dataset("s1")["dataset_path"], os.path.join(self.directory, "s1", "t1"))
+
+    def test_allSeriesRemoved(self):
+        self.database.addSeries("p1", "s1", "t1", T1_TAGS)
+        self.database.addSeries("p2", "s2", "dwi", DWI_TAGS)
+        self.runPass()
+        self.database.removeSeries("t1")
+        self.runPass()
+        self.assertEqual(self.index.datasets(), [("name of p2", "s2")])
+        self.assertIsNone(DatasetIndex(None, self.store).dataset("s1"))
+
+    def test_unchangedStudiesNotIndexedAgain(self):
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.runPass()
+        indexed = []
+        indexStudy = self.index._indexStudy
+        self.index._indexStudy = lambda *args: indexed.append(args[0]) or indexStudy(*args)
+        self.runPass()
+        self.assertEqual(indexed, [])
+
+
+class NotificationTest(DatasetIndexTestBase):
+
+    def notifyEnd(self):
+        """The import burst is over"""
+        self.index._onUpdateTimeout()
+        self.processPending()
+
+    def test_studyAddedBeforeSeries(self):
+        self.runPass()
+        # The study is notified and indexed while only its first series is in the database
+        self.database.addSeries("p1", "s1", "t1", T1_TAGS)
+        self.index._onStudyAdded("s1")
+        self.index._onSeriesAdded("t1")
+        self.notifyEnd()
+        self.assertEqual(self.seriesOf("s1"), [])
+        # The diffusion series is inserted later in the import
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.index._onSeriesAdded("dwi")
+        self.notifyEnd()
+        self.assertEqual(self.seriesOf("s1"), ["dwi"])
+        self.assertEqual(self.index.dataset("s1")["dataset_path"], os.path.join(self.directory, "s1", "dwi"))
+
+    def test_studyWithoutSeries(self):
+        self.runPass()
+        self.database.studies["s1"] = "p1"
+        self.database.patientNames["p1"] = "name of p1"
+        self.index._onStudyAdded("s1")
+        self.notifyEnd()
+        self.assertIsNone(self.index.dataset("s1"))
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.index._onSeriesAdded("dwi")
+        self.notifyEnd()
+        self.assertEqual(self.seriesOf("s1"), ["dwi"])
+
+    def test_importDoesNotReconcile(self):
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.runPass()
+        listed = []
+        listPatientStudies = self.index._listPatientStudies
+        self.index._listPatientStudies = lambda patientUid: listed.append(patientUid) or listPatientStudies(patientUid)
+        self.database.addSeries("p2", "s2", "dwi2", DWI_TAGS)
+        self.index._onStudyAdded("s2")
+        self.index._onSeriesAdded("dwi2")
+        self.index._onDatabaseChanged()
+        self.notifyEnd()
+        self.assertEqual(listed, [])
+        self.assertEqual(self.seriesOf("s2"), ["dwi2"])
+
+    def test_studyRemoved(self):
+        self.database.addSeries("p1", "s1", "dwi", DWI_TAGS)
+        self.database.addSeries("p1", "s3", "dwi3", DWI_TAGS)
+        self.runPass()
+        # A study is removed while another one is imported
+        self.database.removeStudy("s1")
+        self.database.addSeries("p2", "s2", "dwi2", DWI_TAGS)
+        self.index._onStudyAdded("s2")
+        self.index._onSeriesAdded("dwi2")
+        self.index._onDatabaseChanged()
+        self.notifyEnd()
+        self.assertEqual(self.index.datasets(), [("name of p1", "s3"), ("name of p2", "s2")])
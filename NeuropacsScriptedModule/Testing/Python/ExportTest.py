@@ -0,0 +1,129 @@
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+from NeuropacsScriptedModuleLib.Export import INDEX_FILENAME, BulkExportJob, exportFilename
+from NeuropacsScriptedModuleLib.OrderStore import OrderStore
+from NeuropacsScriptedModuleLib.Reports import ReportCache
+
+
+def reportOf(orderId, format):
+    return f"{format} report of {orderId}".ljust(1000, ".")
+
+
+class FakeClient:
+    """Returns reports after a short delay, so that downloads overlap"""
+
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def get_results(self, orderId, format):
+        with self._lock:
+            self.requests.append((orderId, format))
+        time.sleep(self.delay)
+        return reportOf(orderId, format)
+
+
+class BulkExportJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = OrderStore(os.path.join(self.directory, "orders.db"))
+        # Room for about two reports, downloads evict each other
+        self.cache = ReportCache(os.path.join(self.directory, "reports"), self.store, 2500)
+        self.client = FakeClient()
+        self.orders = [(f"o{index}", f"patient {index}") for index in range(12)]
+        self.formats = ["txt", "json"]
+        self.destination = os.path.join(self.directory, "export")
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def export(self, destination=None, orders=None):
+        return BulkExportJob(self.client, self.cache, orders or self.orders, self.formats, destination or self.destination, maxWorkers=4).run()
+
+    def test_tinyCache(self):
+        job = self.export()
+        self.assertIsNone(job.error)
+        self.assertEqual(job.failed, [])
+        self.assertEqual(job.filesDone, job.filesTotal)
+        for orderId, patient in self.orders:
+            for format in self.formats:
+                with open(os.path.join(self.destination, exportFilename(orderId, patient, format))) as reportFile:
+                    self.assertEqual(reportFile.read(), reportOf(orderId, format))
+        # Nothing is left pinned and the cache is back within its size
+        self.assertEqual(+self.cache._pins, {})
+        self.assertLessEqual(sum(entry["size"] for entry in self.store.cachedReports()), self.cache.maxSize)
+        with open(os.path.join(self.destination, INDEX_FILENAME), newline="") as indexFile:
+            self.assertEqual(len(list(csv.DictReader(indexFile))), job.filesTotal)
+
+    def test_zip(self):
+        destination = os.path.join(self.directory, "export.zip")
+        job = self.export(destination)
+        self.assertEqual(job.failed, [])
+        with zipfile.ZipFile(destination) as archive:
+            self.assertEqual(len(archive.namelist()), job.filesTotal + 1)
+            self.assertEqual(archive.read(exportFilename("o3", "patient 3", "json")).decode(), reportOf("o3", "json"))
+
+    def test_zipResume(self):
+        destination = os.path.join(self.directory, "export.zip")
+        self.export(destination, orders=self.orders[:5])
+        # Members exported by a run that lost its manifest are not written again
+        os.remove(os.path.splitext(destination)[0] + ".manifest.json")
+        self.client.requests = []
+        job = self.export(destination, orders=self.orders[:7])
+        self.assertEqual(job.filesSkipped, 10)
+        self.assertEqual(sorted(self.client.requests), sorted((orderId, format) for orderId, _ in self.orders[5:7] for format in self.formats))
+        with zipfile.ZipFile(destination) as archive:
+            names = archive.namelist()
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(len(names), 7 * len(self.formats) + 1)
+        self.assertFalse(os.path.exists(destination + ".part"))
+
+    def test_zipInterrupted(self):
+        destination = os.path.join(self.directory, "export.zip")
+        self.export(destination, orders=self.orders[:5])
+        # An interrupted run leaves a partial zip without central directory
+        with zipfile.ZipFile(destination + ".part", "w") as archive:
+            archive.writestr(exportFilename("o5", "patient 5", "txt"), reportOf("o5", "txt"))
+        with open(destination + ".part", "rb") as partialFile:
+            data = partialFile.read()
+        with open(destination + ".part", "wb") as partialFile:
+            partialFile.write(data[:data.rfind(b"PK\x01\x02")])
+        job = self.export(destination)
+        self.assertIsNone(job.error)
+        self.assertEqual(job.filesSkipped, 10)
+        self.assertEqual(job.filesDone, job.filesTotal)
+        with zipfile.ZipFile(destination) as archive:
+            self.assertEqual(len(archive.namelist()), job.filesTotal + 1)
+            self.assertEqual(archive.read(exportFilename("o5", "patient 5", "txt")).decode(), reportOf("o5", "txt"))
+        self.assertFalse(os.path.exists(destination + ".part"))
+
+    def test_resume(self):
+        self.export(orders=self.orders[:5])
+        self.client.requests = []
+        job = self.export()
+        self.assertEqual(job.filesSkipped, 10)
+        self.assertEqual(job.filesDone, job.filesTotal)
+        self.assertEqual(sorted(self.client.requests), sorted((orderId, format) for orderId, _ in self.orders[5:] for format in self.formats))
+        # A deleted file is exported again
+        os.remove(os.path.join(self.destination, exportFilename("o0", "patient 0", "txt")))
+        job = self.export()
+        self.assertEqual(job.filesSkipped, job.filesTotal - 1)
+
+    def test_fileFailure(self):
+        # A directory in the way of one report
+        os.makedirs(os.path.join(self.destination, exportFilename("o1", "patient 1", "txt")))
+        job = self.export()
+        self.assertIsNone(job.error)
+        self.assertEqual([(orderId, format) for orderId, format, _ in job.failed], [("o1", "txt")])
+        self.assertEqual(job.filesDone, job.filesTotal - 1)
+        self.assertEqual(+self.cache._pins, {})
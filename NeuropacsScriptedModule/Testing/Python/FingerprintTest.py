@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from NeuropacsScriptedModuleLib.Fingerprint import FingerprintJob, datasetFingerprint, fileHash
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    def test_fileHash(self):
+        path = self.writeFile("a", b"abc")
+        self.assertEqual(fileHash(path), "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad")
+        # Chunked reading gives the same hash
+        self.assertEqual(fileHash(path, chunkSize=1), fileHash(path))
+
+    def test_independentOfNamesAndOrder(self):
+        first = [self.writeFile("1/a", b"one"), self.writeFile("1/b", b"two")]
+        second = [self.writeFile("2/y", b"two"), self.writeFile("2/x", b"one")]
+        self.assertEqual(datasetFingerprint(first), datasetFingerprint(second))
+
+    def test_contentChanges(self):
+        first = [self.writeFile("1/a", b"one"), self.writeFile("1/b", b"two")]
+        second = [self.writeFile("2/a", b"one"), self.writeFile("2/b", b"three")]
+        self.assertNotEqual(datasetFingerprint(first), datasetFingerprint(second))
+        self.assertNotEqual(datasetFingerprint(first), datasetFingerprint(first[:1]))
+
+    def test_jobOfFolder(self):
+        self.writeFile("dataset/a", b"one")
+        self.writeFile("dataset/series/b", b"two")
+        job = FingerprintJob("patient", os.path.join(self.directory, "dataset")).run()
+        self.assertIsNone(job.error)
+        files = [os.path.join(self.directory, "dataset", "a"), os.path.join(self.directory, "dataset", "series", "b")]
+        self.assertEqual(job.fingerprint, datasetFingerprint(files))
+
+    def test_jobCancelled(self):
+        path = self.writeFile("a", b"one")
+        job = FingerprintJob("patient", self.directory, files=[path])
+        job.cancel()
+        job.run()
+        self.assertIsNone(job.fingerprint)
+        self.assertIsNone(job.error)
@@ -0,0 +1,98 @@
+import concurrent.futures
+import threading
+import time
+import unittest
+
+from NeuropacsScriptedModuleLib.OrderStatus import STATE_COMPLETE, STATE_EXPIRED, STATE_FAILED, StatusFetcher, _StatusBatch, terminalState
+
+
+class FakeClient:
+    """Client whose status requests for slowOrders block until released"""
+
+    def __init__(self, slowOrders=()):
+        self.slowOrders = set(slowOrders)
+        self.released = threading.Event()
+
+    def check_status(self, orderId):
+        if orderId in self.slowOrders:
+            self.released.wait(5)
+        return {"info": f"status of {orderId}", "progress": 50}
+
+
+class TerminalStateTest(unittest.TestCase):
+
+    def test_running(self):
+        self.assertIsNone(terminalState({"progress": 50, "failed": False}))
+
+    def test_complete(self):
+        self.assertEqual(terminalState({"progress": 100}), STATE_COMPLETE)
+        self.assertEqual(terminalState({"progress": "100"}), STATE_COMPLETE)
+
+    def test_failed(self):
+        self.assertEqual(terminalState({"progress": 30, "failed": True}), STATE_FAILED)
+
+    def test_errors(self):
+        self.assertEqual(terminalState(None, Exception("Bucket not found")), STATE_EXPIRED)
+        # Other errors are retried
+        self.assertIsNone(terminalState(None, TimeoutError("timed out")))
+
+
+class StatusBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def waitForBatch(self, batch, limit=5):
+        deadline = time.monotonic() + limit
+        while not batch.poll(wait=0.02):
+            self.assertLess(time.monotonic(), deadline, "status batch never finished")
+
+    def test_results(self):
+        batch = _StatusBatch(self.executor, FakeClient(), ["a", "b", "c"], maxWorkers=2, timeout=5)
+        self.waitForBatch(batch)
+        self.assertEqual(set(batch.results), {"a", "b", "c"})
+        self.assertTrue(all(error is None for _, error in batch.results.values()))
+
+    def test_requestTimeout(self):
+        client = FakeClient(slowOrders=["slow"])
+        try:
+            batch = _StatusBatch(self.executor, client, ["slow", "fast"], maxWorkers=2, timeout=0.2)
+            self.waitForBatch(batch)
+        finally:
+            client.released.set()
+        self.assertIsNone(batch.results["fast"][1])
+        self.assertIsInstance(batch.results["slow"][1], TimeoutError)
+        self.assertEqual(batch.hungWorkers, 1)
+
+    def test_overallDeadline(self):
+        # Both workers block, the queued request never starts and is given up at the batch deadline
+        client = FakeClient(slowOrders=["slow1", "slow2", "queued"])
+        try:
+            batch = _StatusBatch(self.executor, client, ["slow1", "slow2", "queued"], maxWorkers=2, timeout=0.2)
+            start = time.monotonic()
+            self.waitForBatch(batch)
+            elapsed = time.monotonic() - start
+        finally:
+            client.released.set()
+        self.assertTrue(all(isinstance(error, TimeoutError) for _, error in batch.results.values()))
+        # Two rounds of requests plus one, see _StatusBatch
+        self.assertLess(elapsed, 3 * 0.2 + 1)
+
+
+class StatusFetcherTest(unittest.TestCase):
+
+    def test_hungWorkers(self):
+        fetcher = StatusFetcher(maxWorkers=1, timeout=0.2)
+        client = FakeClient(slowOrders=["slow"])
+        try:
+            results = fetcher.fetch(client, ["slow"])
+            self.assertIsInstance(results["slow"][1], TimeoutError)
+            # The hung worker does not block the next poll
+            results = fetcher.fetch(client, ["fast"])
+            self.assertIsNone(results["fast"][1])
+        finally:
+            client.released.set()
+            fetcher.shutdown()
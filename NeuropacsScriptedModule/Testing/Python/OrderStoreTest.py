@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from NeuropacsScriptedModuleLib.OrderStore import OrderStore
+
+
+class OrderStoreMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "orders.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def createDatabase(self, script):
+        connection = sqlite3.connect(self.path)
+        connection.executescript(script)
+        connection.commit()
+        connection.close()
+
+    def test_newDatabase(self):
+        store = OrderStore(self.path)
+        try:
+            self.assertEqual(store._connection.execute("PRAGMA user_version").fetchone()[0], OrderStore.SCHEMA_VERSION)
+            self.assertEqual(len(store), 0)
+            self.assertFalse(store.isMigrated())
+        finally:
+            store.close()
+
+    def test_ordersOnlySchema(self):
+        # First version: only the orders table
+        self.createDatabase("""
+            CREATE TABLE orders (order_id TEXT PRIMARY KEY, patient TEXT NOT NULL, dataset_path TEXT, product TEXT,
+                                 created REAL NOT NULL, last_status TEXT, last_info TEXT, last_progress TEXT);
+            INSERT INTO orders (order_id, patient, created, last_status) VALUES ('o1', 'p1', 1, 'complete');
+            INSERT INTO orders (order_id, patient, created) VALUES ('o2', 'p2', 2);
+            PRAGMA user_version=1;
+            """)
+        store = OrderStore(self.path)
+        try:
+            self.assertEqual([order["order_id"] for order in store.orders()], ["o1", "o2"])
+            self.assertEqual(store.activeOrderIds(), ["o2"])
+            self.assertEqual(store.terminalStatus("o1")["state"], "complete")
+            # Tables of later versions are usable
+            submissionId = store.addSubmission("p3", "/data/p3", "product", fingerprint="f", files=["/data/p3/a.dcm"])
+            self.assertEqual(store.submissionFiles(submissionId), ["/data/p3/a.dcm"])
+            store.addCachedReport("o1", "json", "0" * 64, 10)
+            self.assertEqual(store.cachedReport("o1", "json")["size"], 10)
+            self.assertEqual(store._connection.execute("PRAGMA user_version").fetchone()[0], OrderStore.SCHEMA_VERSION)
+        finally:
+            store.close()
+
+    def test_addedColumns(self):
+        # Submissions without fingerprints and datasets without their series
+        self.createDatabase("""
+            CREATE TABLE submissions (submission_id INTEGER PRIMARY KEY AUTOINCREMENT, patient TEXT NOT NULL,
+                                      dataset_path TEXT NOT NULL, product TEXT, order_id TEXT, stage TEXT NOT NULL, created REAL NOT NULL);
+            INSERT INTO submissions (patient, dataset_path, stage, created) VALUES ('p1', '/data/p1', 'queued', 1);
+            CREATE TABLE datasets (study_uid TEXT PRIMARY KEY, patient_uid TEXT, patient_name TEXT, dataset_path TEXT NOT NULL);
+            INSERT INTO datasets VALUES ('1.2.3', 'pid', 'p1', '/data/p1');
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            INSERT INTO meta VALUES ('datasetIndexSource', 'ctkDICOM.sql:1');
+            PRAGMA user_version=5;
+            """)
+        store = OrderStore(self.path)
+        try:
+            submissions = store.pendingSubmissions()
+            self.assertEqual(len(submissions), 1)
+            self.assertIsNone(submissions[0]["fingerprint"])
+            # Datasets indexed without their series are indexed again
+            self.assertEqual(store.indexedDatasets(), [])
+            datasetColumns = [row["name"] for row in store._connection.execute("PRAGMA table_info(datasets)")]
+            self.assertIn("study_series_uids", datasetColumns)
+            self.assertIsNone(store.getMeta("datasetIndexSource"))
+        finally:
+            store.close()
+
+    def test_reopen(self):
+        store = OrderStore(self.path)
+        store.addOrder("o1", "p1")
+        store.close()
+        store = OrderStore(self.path)
+        try:
+            self.assertIn("o1", store)
+        finally:
+            store.close()
+
+
+class MigrateFromJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.configPath = os.path.join(self.directory, "slicer_neuropacs.config")
+        self.statusPath = os.path.join(self.directory, "slicer_neuropacs.status.json")
+        self.store = OrderStore(os.path.join(self.directory, "slicer_neuropacs.db"))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def writeJson(self, path, data):
+        with open(path, "w") as jsonFile:
+            json.dump(data, jsonFile)
+
+    def test_import(self):
+        self.writeJson(self.configPath, {"o2": "p2", "o1": "p1", "o3": "p3"})
+        self.writeJson(self.statusPath, {"o1": {"state": "complete", "info": "Done", "progress": "100%"}})
+        self.assertEqual(self.store.migrateFromJson(self.configPath, self.statusPath), 3)
+        # The order of the JSON map is kept
+        self.assertEqual([order["order_id"] for order in self.store.orders()], ["o2", "o1", "o3"])
+        self.assertEqual(self.store.patient("o3"), "p3")
+        self.assertEqual(self.store.terminalStatus("o1"), {"state": "complete", "info": "Done", "progress": "100%"})
+        self.assertEqual(self.store.activeOrderIds(), ["o2", "o3"])
+        self.assertTrue(self.store.isMigrated())
+
+    def test_onlyOnce(self):
+        self.writeJson(self.configPath, {"o1": "p1"})
+        self.assertEqual(self.store.migrateFromJson(self.configPath), 1)
+        self.store.deleteOrder("o1")
+        self.assertEqual(self.store.migrateFromJson(self.configPath), 0)
+        self.assertEqual(len(self.store), 0)
+
+    def test_defaultOrders(self):
+        self.assertEqual(self.store.migrateFromJson(self.configPath, defaultOrders={"TEST": "TEST"}), 1)
+        self.assertIn("TEST", self.store)
+
+    def test_unreadableStatusCache(self):
+        self.writeJson(self.configPath, {"o1": "p1"})
+        with open(self.statusPath, "w") as statusFile:
+            statusFile.write("{not json")
+        self.assertEqual(self.store.migrateFromJson(self.configPath, self.statusPath), 1)
+        self.assertEqual(self.store.activeOrderIds(), ["o1"])
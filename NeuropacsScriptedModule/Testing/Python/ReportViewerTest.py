@@ -0,0 +1,28 @@
+import json
+import unittest
+
+from NeuropacsScriptedModuleLib.ReportViewer import JsonIndenter
+
+REPORT = ('{"order": "o1", "results": {"scores": [0.1, -0.0025, 12], "diagnosis": "PSP, \\"probable\\"",'
+          ' "flags": {}, "notes": [], "ok": true, "missing": null}, "text": "a: {b} [c]"}')
+
+
+def indentInChunks(text, chunkSize):
+    indenter = JsonIndenter()
+    chunks = [indenter.feed(text[offset:offset + chunkSize]) for offset in range(0, len(text), chunkSize)]
+    return "".join(chunks) + indenter.feed("", final=True)
+
+
+class JsonIndenterTest(unittest.TestCase):
+
+    def test_likeJsonDumps(self):
+        expected = json.dumps(json.loads(REPORT), indent=2)
+        for chunkSize in (1, 2, 3, 7, 16, len(REPORT)):
+            self.assertEqual(indentInChunks(REPORT, chunkSize), expected, chunkSize)
+
+    def test_indentedInput(self):
+        indented = json.dumps(json.loads(REPORT), indent=4)
+        self.assertEqual(indentInChunks(indented, 10), json.dumps(json.loads(REPORT), indent=2))
+
+    def test_notJson(self):
+        self.assertEqual(indentInChunks('N/A "unterminated', 4), 'N/A"unterminated')
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from NeuropacsScriptedModuleLib.Jobs import JobCancelled
+from NeuropacsScriptedModuleLib.OrderStore import OrderStore
+from NeuropacsScriptedModuleLib.Reports import (
+    DOWNLOAD_DONE,
+    ReportCache,
+    ReportDownloadJob,
+    copyChunked,
+    reportData,
+    writeChunked,
+)
+
+
+class ChunkedWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "report")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_hash(self):
+        data = os.urandom(10000)
+        progress = []
+        sha256 = writeChunked(data, self.path, onProgress=lambda done, total: progress.append((done, total)), chunkSize=4096)
+        self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(progress, [(4096, 10000), (8192, 10000), (10000, 10000)])
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), data)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+    def test_copy(self):
+        data = os.urandom(5000)
+        writeChunked(data, self.path)
+        copyPath = os.path.join(self.directory, "copy")
+        self.assertEqual(copyChunked(self.path, copyPath, chunkSize=1000), hashlib.sha256(data).hexdigest())
+        with open(copyPath, "rb") as file:
+            self.assertEqual(file.read(), data)
+
+    def test_cancelled(self):
+        writeChunked(b"old report", self.path)
+
+        def checkCancelled():
+            raise JobCancelled()
+
+        with self.assertRaises(JobCancelled):
+            writeChunked(b"new report", self.path, checkCancelled=checkCancelled)
+        # The previous file is kept and no partial file is left behind
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), b"old report")
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+    def test_reportData(self):
+        self.assertEqual(bytes(reportData(io.BytesIO(b"png"))), b"png")
+        self.assertEqual(bytes(reportData("text")), b"text")
+        self.assertEqual(bytes(reportData({"a": 1})), b"{'a': 1}")
+
+
+class FakeClient:
+    """Returns a report made of the order ID and format"""
+
+    def __init__(self):
+        self.requests = []
+
+    def get_results(self, orderId, format):
+        self.requests.append((orderId, format))
+        return f"{orderId}.{format}".ljust(100, "-")
+
+
+class ReportCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = OrderStore(os.path.join(self.directory, "orders.db"))
+        # Room for two reports of 100 bytes
+        self.cache = ReportCache(os.path.join(self.directory, "reports"), self.store, 250)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def put(self, orderId, format="txt", **kwargs):
+        return self.cache.put(orderId, format, f"{orderId}.{format}".ljust(100, "-").encode(), **kwargs)
+
+    def test_putAndGet(self):
+        path = self.put("o1")
+        self.assertEqual(self.cache.get("o1", "txt"), path)
+        self.assertEqual(os.path.basename(path), hashlib.sha256(b"o1.txt".ljust(100, b"-")).hexdigest())
+        self.assertIsNone(self.cache.get("o1", "png"))
+
+    def test_sharedContent(self):
+        first = self.cache.put("o1", "txt", b"same")
+        second = self.cache.put("o2", "txt", b"same")
+        self.assertEqual(first, second)
+        self.cache.removeOrders(["o1"])
+        self.assertTrue(os.path.isfile(second))
+        self.cache.removeOrders(["o2"])
+        self.assertFalse(os.path.isfile(second))
+
+    def test_evictLeastRecentlyUsed(self):
+        self.put("o1")
+        self.put("o2")
+        self.cache.get("o1", "txt")
+        self.put("o3")
+        self.assertIsNotNone(self.cache.get("o1", "txt"))
+        self.assertIsNone(self.cache.get("o2", "txt"))
+        self.assertIsNotNone(self.cache.get("o3", "txt"))
+
+    def test_pinnedNotEvicted(self):
+        pinned = self.put("o1", pin=True)
+        for orderId in ("o2", "o3", "o4"):
+            self.put(orderId)
+        self.assertTrue(os.path.isfile(pinned))
+        self.assertEqual(self.cache.get("o1", "txt", touch=False), pinned)
+        # Evicted once released
+        self.cache.release(pinned)
+        self.put("o5")
+        self.assertIsNone(self.cache.get("o1", "txt"))
+        self.assertFalse(os.path.isfile(pinned))
+
+    def test_pinnedRemoved(self):
+        self.put("o1")
+        pinned = self.cache.get("o1", "txt", pin=True)
+        self.cache.removeOrders(["o1"])
+        self.assertIsNone(self.cache.get("o1", "txt"))
+        # The file is deleted once released
+        self.assertTrue(os.path.isfile(pinned))
+        self.cache.release(pinned)
+        self.assertFalse(os.path.isfile(pinned))
+
+    def test_onAddedBeforeEviction(self):
+        read = []
+
+        def onAdded(orderId, format, path):
+            with open(path, "rb") as reportFile:
+                read.append(reportFile.read(2))
+
+        self.cache.maxSize = 50
+        self.cache.onAdded = onAdded
+        self.put("o1")
+        self.put("o2")
+        self.assertEqual(read, [b"o1", b"o2"])
+        # Reports are evicted once released
+        self.assertEqual(self.store.cachedReports(), [])
+
+    def test_downloadJobKeepsPin(self):
+        client = FakeClient()
+        job = ReportDownloadJob(client, "o1", "txt", None, cache=self.cache).run()
+        self.assertEqual(job.stage, DOWNLOAD_DONE)
+        for orderId in ("o2", "o3", "o4"):
+            ReportDownloadJob(client, orderId, "txt", None, cache=self.cache).run().release()
+        with open(job.path, "rb") as reportFile:
+            self.assertEqual(reportFile.read(6), b"o1.txt")
+        job.release()
+        job.release()
+        ReportDownloadJob(client, "o5", "txt", None, cache=self.cache).run().release()
+        self.assertFalse(os.path.isfile(job.path))
+
+    def test_downloadJobFromCache(self):
+        client = FakeClient()
+        ReportDownloadJob(client, "o1", "txt", None, cache=self.cache).run().release()
+        path = os.path.join(self.directory, "o1.txt")
+        job = ReportDownloadJob(client, "o1", "txt", path, cache=self.cache).run()
+        self.assertTrue(job.fromCache)
+        self.assertEqual(client.requests, [("o1", "txt")])
+        with open(path, "rb") as reportFile:
+            self.assertEqual(hashlib.sha256(reportFile.read()).hexdigest(), job.sha256)
+        # Nothing is left pinned
+        self.assertEqual(+self.cache._pins, {})
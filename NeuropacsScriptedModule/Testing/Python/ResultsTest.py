@@ -0,0 +1,93 @@
+import importlib.util
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from NeuropacsScriptedModuleLib.OrderStore import OrderStore
+from NeuropacsScriptedModuleLib.Results import ResultsTable, _numberValue, flattenReport
+
+
+class FlattenReportTest(unittest.TestCase):
+
+    def test_nested(self):
+        report = {"results": {"scores": [0.1, 0.9], "diagnosis": "PSP"}, "version": 2}
+        self.assertEqual(flattenReport(report), [
+            ("results.scores[0]", 0.1), ("results.scores[1]", 0.9), ("results.diagnosis", "PSP"), ("version", 2)])
+
+    def test_scalar(self):
+        self.assertEqual(flattenReport(5), [("value", 5)])
+
+    def test_numberValue(self):
+        self.assertEqual(_numberValue("42%"), 42.0)
+        self.assertEqual(_numberValue(" 0.5 "), 0.5)
+        self.assertEqual(_numberValue(True), 1.0)
+        self.assertIsNone(_numberValue("N/A"))
+        self.assertIsNone(_numberValue(None))
+
+
+hasParquet = importlib.util.find_spec("pandas") is not None and importlib.util.find_spec("pyarrow") is not None
+
+
+class ResultsTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = OrderStore(os.path.join(self.directory, "orders.db"))
+        self.table = ResultsTable(self.store)
+        for orderId, patient, report in [
+                ("o1", "p1", {"diagnosis": "PSP", "score": 0.8}),
+                ("o2", "p2", '{"diagnosis": "MSAp", "score": "0.3"}'),
+                ("o3", "p3", {"diagnosis": "PD", "score": "N/A"})]:
+            self.store.addOrder(orderId, patient)
+            self.table.addReport(orderId, report)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_columns(self):
+        columns = self.table.columns()
+        self.assertEqual(columns["order_id"], ["o1", "o2", "o3"])
+        self.assertEqual(columns["patient"], ["p1", "p2", "p3"])
+        self.assertEqual(columns["diagnosis"], ["PSP", "MSAp", "PD"])
+        self.assertEqual(columns["score"], [0.8, 0.3, "N/A"])
+
+    def test_filters(self):
+        self.assertEqual(sorted(self.table.filterOrders("diagnosis", "=", "PSP")), ["o1"])
+        self.assertEqual(sorted(self.table.filterOrders("diagnosis", "!=", "PSP")), ["o2", "o3"])
+        self.assertEqual(sorted(self.table.filterOrders("score", ">", "0.5")), ["o1"])
+        self.assertEqual(sorted(self.table.filterOrders("score", "<=", "0.8")), ["o1", "o2"])
+        self.assertEqual(sorted(self.table.filterOrders("diagnosis", "contains", "P")), ["o1", "o2", "o3"])
+        with self.assertRaises(ValueError):
+            self.table.filterOrders("score", "~", "1")
+
+    def test_summary(self):
+        summary = self.table.summary("score")
+        self.assertEqual(summary["count"], 3)
+        self.assertEqual(summary["values"], {"N/A": 1})
+        self.assertAlmostEqual(summary["min"], 0.3)
+        self.assertAlmostEqual(summary["max"], 0.8)
+
+    def test_replaceResults(self):
+        self.table.addReport("o1", {"diagnosis": "MSAp"})
+        self.assertEqual(sorted(self.table.filterOrders("diagnosis", "=", "MSAp")), ["o1", "o2"])
+        self.assertEqual(self.table.columns(["o1"])["score"], [None])
+
+    def test_textColumns(self):
+        self.assertEqual(self.table.columns(numbers=False)["score"], ["0.8", "0.3", "N/A"])
+
+    @unittest.skipUnless(hasParquet, "requires pandas and pyarrow")
+    def test_parquet(self):
+        import pandas
+        self.table.addReport("o2", {"diagnosis": "MSAp", "score": "0.3", "volume": 12})
+        path = os.path.join(self.directory, "results.parquet")
+        self.table.writeParquet(path)
+        frame = pandas.read_parquet(path)
+        self.assertEqual(list(frame["order_id"]), ["o1", "o2", "o3"])
+        # A column mixing numbers and text is written as text
+        self.assertEqual(list(frame["score"]), ["0.8", "0.3", "N/A"])
+        self.assertEqual(frame["volume"].dtype, "float64")
+        self.assertTrue(math.isnan(frame["volume"][0]))
+        self.assertEqual(frame["volume"][1], 12.0)
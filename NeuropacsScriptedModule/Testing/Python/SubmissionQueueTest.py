@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from NeuropacsScriptedModuleLib.Jobs import STAGE_CREATED, SubmissionQueue
+from NeuropacsScriptedModuleLib.OrderStatus import STATE_CANCELLED
+from NeuropacsScriptedModuleLib.OrderStore import OrderStore
+
+
+class SubmissionQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = OrderStore(os.path.join(self.directory, "orders.db"))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_cancelAll(self):
+        created = self.store.addSubmission("patient 1", "/data/1", "product")
+        self.store.updateSubmission(created, orderId="o1", stage=STAGE_CREATED)
+        self.store.addSubmission("patient 2", "/data/2", "product")
+        # Without client nothing is scheduled, the submissions wait
+        queue = SubmissionQueue(self.store)
+        self.assertEqual(queue.resume(), 2)
+        queue.cancelAll()
+        self.assertFalse(queue.isActive())
+        self.assertEqual(self.store.pendingSubmissions(), [])
+        # The order created on the server is kept, but never polled
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.order("o1")["last_status"], STATE_CANCELLED)
+        self.assertEqual(self.store.activeOrderIds(), [])
+
+    def test_resumeFingerprints(self):
+        self.store.addSubmission("patient 1", "/data/1", "product", fingerprint="f1")
+        self.store.addSubmission("patient 2", "/data/2", "product", fingerprint="f2")
+        queue = SubmissionQueue(self.store)
+        self.assertEqual(queue.resume(fingerprints={"f2"}), 1)
+        self.assertEqual([job.fingerprint for job in queue.jobs()], ["f2"])
+        # Resuming again does not queue a submission twice
+        self.assertEqual(queue.resume(), 2)